@@ -25,6 +25,7 @@ export class DynamoDBConstruct extends Construct {
 
   public readonly byUserIdIndex: string = "byUserId";
   public readonly bySessionIdIndex: string = "bySessionId";
+  public readonly bySessionIdAndTimestampIndex: string = "bySessionIdAndTimestamp";
   public readonly byTimestampIndex: string = "byTimestamp";
 
   constructor(scope: Construct, id: string) {
@@ -80,6 +81,13 @@ export class DynamoDBConstruct extends Construct {
       indexName: this.bySessionIdIndex,
       partitionKey: { name: "sessionId", type: dynamodb.AttributeType.STRING },
     });
+    // latest messages of a session first, for windowed chat history
+    messagesTable.addGlobalSecondaryIndex({
+      indexName: this.bySessionIdAndTimestampIndex,
+      partitionKey: sessionIdAttr,
+      sortKey: timestampAttr,
+      projectionType: dynamodb.ProjectionType.ALL,
+    });
 
     const promptTable = new DynamoDBTable(this, "Prompt", userIdAttr, sortKeyAttr).table;
     const indexTable = new DynamoDBTable(this, "Index", groupNameAttr, indexIdAttr).table;
@@ -136,6 +136,11 @@ export class EtlStack extends NestedStack {
         chatbotTable.tableArn,
       ],
     );
+    // the glue job deletes the file manifests of deleted files
+    const workspaceDeleteStatement = this.iamHelper.createPolicyStatement(
+      ["dynamodb:DeleteItem"],
+      [chatbotTable.tableArn],
+    );
 
     const endpointRole = new iam.Role(this, "etl-endpoint-role", {
       assumedBy: new iam.ServicePrincipal("sagemaker.amazonaws.com"),
@@ -362,6 +367,14 @@ export class EtlStack extends NestedStack {
     glueRole.addToPolicy(this.iamHelper.s3Statement);
     glueRole.addToPolicy(this.iamHelper.logStatement);
     glueRole.addToPolicy(dynamodbStatement);
+    glueRole.addToPolicy(workspaceDeleteStatement);
+    // the glue job deletes the embedding store shards it merged
+    glueRole.addToPolicy(
+      this.iamHelper.createPolicyStatement(
+        ["s3:DeleteObject"],
+        [s3Bucket.arnForObjects("embedding-store/*")],
+      ),
+    );
     glueRole.addToPolicy(this.iamHelper.glueStatement);
 
     // Create glue job to process files specified in s3 bucket and prefix
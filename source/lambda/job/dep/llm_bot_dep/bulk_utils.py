@@ -0,0 +1,358 @@
+"""
+Refresh-free bulk loading into OpenSearch
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+
+from opensearchpy.helpers import BulkIndexError, parallel_bulk, streaming_bulk
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# a bulk request is sent once it holds BULK_CHUNK_SIZE actions or BULK_MAX_CHUNK_BYTES
+BULK_CHUNK_SIZE = 500
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_THREAD_COUNT = 4
+# item statuses worth another attempt, 429 is returned when the write queue of a node is full
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+_STOP = object()
+
+
+class BulkLoadMode:
+    """
+    Index settings for the duration of a bulk load.
+
+    begin() disables the periodic refresh and the replicas of the index, so
+    that bulk requests do not keep creating small segments and every document
+    is only indexed once. end() restores the previous settings, refreshes the
+    index once and optionally force merges it before the replicas are rebuilt.
+    Only meant for an index that nothing else reads or writes during the load,
+    e.g. one created by the load itself: concurrent loads of the same index
+    would restore its settings while the others still write, and searches run
+    without replicas until end().
+
+    Args:
+        client: The OpenSearch client.
+        index_name (str): The index being loaded.
+        enabled (bool): Change the index settings, otherwise end() only refreshes the index.
+        force_merge_segments (int): Force merge to this many segments per shard at the end, None to skip.
+    """
+
+    def __init__(
+        self,
+        client,
+        index_name: str,
+        enabled: bool = True,
+        force_merge_segments: Optional[int] = None,
+    ):
+        self.client = client
+        self.index_name = index_name
+        self.enabled = enabled
+        self.force_merge_segments = force_merge_segments
+        self._original_settings = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end()
+
+    def begin(self) -> None:
+        """Switch the index to bulk load settings, nothing is done before the index exists"""
+        with self._lock:
+            if not self.enabled or self._original_settings is not None:
+                return
+            if not self.client.indices.exists(index=self.index_name):
+                return
+            response = self.client.indices.get_settings(index=self.index_name)
+            settings = response[self.index_name]["settings"]["index"]
+            original_settings = {
+                "refresh_interval": settings.get("refresh_interval"),
+                "number_of_replicas": settings.get("number_of_replicas"),
+            }
+            if original_settings["refresh_interval"] == "-1":
+                # another load is running, the settings are left to the load that switched them
+                logger.warning(
+                    "Index %s is already in bulk load mode, its settings are not changed",
+                    self.index_name,
+                )
+                return
+            try:
+                self.client.indices.put_settings(
+                    index=self.index_name,
+                    body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+                )
+            except Exception as e:
+                # e.g. serverless collections do not expose these settings
+                logger.warning("Failed to switch %s to bulk load mode: %s", self.index_name, e)
+                return
+            self._original_settings = original_settings
+            logger.info(
+                "Index %s in bulk load mode, previous settings: %s",
+                self.index_name,
+                original_settings,
+            )
+
+    def end(self) -> None:
+        """Restore the index settings, refresh and optionally force merge the index"""
+        with self._lock:
+            original_settings = self._original_settings
+            self._original_settings = None
+        if not self.client.indices.exists(index=self.index_name):
+            return
+        if original_settings is not None:
+            self.client.indices.put_settings(
+                index=self.index_name,
+                body={"index": {"refresh_interval": original_settings["refresh_interval"]}},
+            )
+        self.client.indices.refresh(index=self.index_name)
+        if self.force_merge_segments:
+            start_time = time.time()
+            self.client.indices.forcemerge(
+                index=self.index_name,
+                max_num_segments=self.force_merge_segments,
+                request_timeout=3600,
+            )
+            logger.info(
+                "Force merged %s in %.1fs", self.index_name, time.time() - start_time
+            )
+        if original_settings is not None:
+            self.client.indices.put_settings(
+                index=self.index_name,
+                body={"index": {"number_of_replicas": original_settings["number_of_replicas"]}},
+            )
+        logger.info("Index %s refreshed after bulk load", self.index_name)
+
+
+def bulk_index(
+    client,
+    actions,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+    thread_count: int = BULK_THREAD_COUNT,
+) -> int:
+    """
+    Send actions with parallel_bulk in size bounded requests, without refresh.
+
+    Args:
+        client: The OpenSearch client.
+        actions (Iterable[dict]): Actions in the format of opensearchpy.helpers.bulk, can be a generator.
+        chunk_size (int): Maximum number of actions per bulk request.
+        max_chunk_bytes (int): Maximum size of a bulk request.
+        thread_count (int): Number of concurrent bulk requests.
+
+    Returns:
+        int: Number of indexed actions, BulkIndexError is raised if any failed.
+    """
+    succeeded, errors = 0, []
+    for ok, result in parallel_bulk(
+        client,
+        actions,
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=False,
+    ):
+        if ok:
+            succeeded += 1
+        else:
+            errors.append(result)
+    if errors:
+        raise BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+    return succeeded
+
+
+class _Submission:
+    def __init__(self, size: int, callback: Optional[Callable]):
+        self.remaining = size
+        self.error = None
+        self.callback = callback
+
+
+class BulkIndexer:
+    """
+    Stream bulk actions to OpenSearch from any number of producer threads.
+
+    Submitted actions are sent by parallel_bulk in requests of at most
+    chunk_size actions and max_chunk_bytes, no request refreshes the index.
+    Items rejected with a retryable status are sent again with backoff. The
+    callback of a submission is called once all of its actions are
+    acknowledged, with the error of the first failed action or None.
+
+    Args:
+        client: The OpenSearch client.
+        chunk_size (int): Maximum number of actions per bulk request.
+        max_chunk_bytes (int): Maximum size of a bulk request.
+        thread_count (int): Number of concurrent bulk requests.
+        queue_size (int): Submissions buffered before submit() blocks.
+        max_retries (int): Attempts for rejected items after the first one.
+    """
+
+    def __init__(
+        self,
+        client,
+        chunk_size: int = BULK_CHUNK_SIZE,
+        max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+        thread_count: int = BULK_THREAD_COUNT,
+        queue_size: int = 64,
+        max_retries: int = 3,
+    ):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.metrics = {"succeeded": 0, "failed": 0, "retried": 0}
+        self._queue = queue.Queue(maxsize=queue_size)
+        # actions handed to parallel_bulk, its results come back in the same order
+        self._in_flight = collections.deque()
+        self._error = None
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run, name="bulk-indexer", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self, actions: List[dict], callback: Optional[Callable[[Optional[Exception]], None]] = None
+    ) -> None:
+        """Queue actions in the format of opensearchpy.helpers.bulk"""
+        if not actions:
+            if callback is not None:
+                callback(None)
+            return
+        submission = _Submission(len(actions), callback)
+        if self._error is not None:
+            for _ in actions:
+                self._complete(submission, self._error)
+            return
+        self._queue.put((actions, submission))
+        if self._error is not None:
+            self._drain_queue()
+
+    def close(self) -> None:
+        """Send the buffered actions and wait until every submission is acknowledged"""
+        self._queue.put(_STOP)
+        self._thread.join()
+        elapsed = time.time() - self._start_time
+        logger.info(
+            "Bulk indexer closed after %.1fs, %.1f docs/s, metrics: %s",
+            elapsed,
+            self.metrics["succeeded"] / elapsed if elapsed else 0.0,
+            self.metrics,
+        )
+
+    def _actions(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            actions, submission = item
+            for action in actions:
+                self._in_flight.append((action, submission))
+                yield action
+
+    def _run(self) -> None:
+        retries = []
+        try:
+            for ok, result in parallel_bulk(
+                self.client,
+                self._actions(),
+                thread_count=self.thread_count,
+                chunk_size=self.chunk_size,
+                max_chunk_bytes=self.max_chunk_bytes,
+                raise_on_error=False,
+                raise_on_exception=False,
+            ):
+                action, submission = self._in_flight.popleft()
+                error, retryable = self._check_result(ok, result)
+                if retryable:
+                    retries.append((action, submission))
+                else:
+                    self._complete(submission, error)
+                if len(retries) >= self.chunk_size:
+                    self._retry(retries)
+                    retries = []
+            self._retry(retries)
+        except Exception as e:
+            logger.error("Bulk indexer stopped: %s", e)
+            # fail everything not acknowledged so that no callback is left waiting
+            self._error = e
+            for _, submission in retries:
+                self._complete(submission, e)
+            while self._in_flight:
+                _, submission = self._in_flight.popleft()
+                self._complete(submission, e)
+            self._drain_queue()
+
+    def _retry(self, retries: List[tuple]) -> None:
+        for attempt in range(self.max_retries):
+            if not retries:
+                return
+            time.sleep(min(2 ** (attempt + 1), 30))
+            self.metrics["retried"] += len(retries)
+            pending = []
+            # without retries of its own streaming_bulk yields the results in order
+            results = streaming_bulk(
+                self.client,
+                (action for action, _ in retries),
+                chunk_size=self.chunk_size,
+                max_chunk_bytes=self.max_chunk_bytes,
+                max_retries=0,
+                raise_on_error=False,
+                raise_on_exception=False,
+            )
+            for (action, submission), (ok, result) in zip(retries, results):
+                error, retryable = self._check_result(ok, result)
+                if retryable:
+                    pending.append((action, submission))
+                else:
+                    self._complete(submission, error)
+            retries = pending
+        for action, submission in retries:
+            self._complete(
+                submission, RuntimeError(f"bulk request rejected after {self.max_retries} retries")
+            )
+
+    @staticmethod
+    def _check_result(ok: bool, result: dict) -> tuple:
+        """Return the error of a bulk item result, and whether it is worth another attempt"""
+        op_type, info = next(iter(result.items()))
+        status = info.get("status")
+        if ok or (op_type == "delete" and status == 404):
+            return None, False
+        if status in RETRYABLE_STATUS or "exception" in info:
+            return None, True
+        return RuntimeError(f"bulk {op_type} of {info.get('_id')} failed: {info.get('error')}"), False
+
+    def _drain_queue(self) -> None:
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _STOP:
+                continue
+            actions, submission = item
+            for _ in actions:
+                self._complete(submission, self._error)
+
+    def _complete(self, submission: _Submission, error: Optional[Exception]) -> None:
+        if error is None:
+            self.metrics["succeeded"] += 1
+        else:
+            self.metrics["failed"] += 1
+            if submission.error is None:
+                submission.error = error
+        submission.remaining -= 1
+        if submission.remaining == 0 and submission.callback is not None:
+            try:
+                submission.callback(submission.error)
+            except Exception as e:
+                logger.error("Bulk callback failed: %s", e)
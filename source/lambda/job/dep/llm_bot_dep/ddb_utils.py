@@ -5,6 +5,8 @@ from typing import List
 
 
 WORKSPACE_OBJECT_TYPE = "workspace"
+# per-file ingestion manifests share the workspace partition, object_type is file_manifest#<s3 path>
+FILE_MANIFEST_OBJECT_TYPE = "file_manifest"
 
 
 def to_opensearch_index_name(s: str) -> str:
@@ -155,3 +157,54 @@ class WorkspaceManager:
             logging.info(f"Updated workspace with response: {response}")
 
         return open_search_index_name
+
+    def touch_workspace(self, workspace_id: str):
+        """Refresh updated_at once the index content has been rewritten.
+        Online retrievers use it as the index generation of their caches.
+        """
+        timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        response = self.workspace_table.update_item(
+            Key={
+                "workspace_id": workspace_id,
+                "object_type": WORKSPACE_OBJECT_TYPE,
+            },
+            UpdateExpression="SET updated_at = :uat",
+            ExpressionAttributeValues={":uat": timestamp},
+        )
+
+        logging.info(f"Touched workspace with response: {response}")
+
+    def get_file_manifest(self, workspace_id: str, file_path: str):
+        response = self.workspace_table.get_item(
+            Key={
+                "workspace_id": workspace_id,
+                "object_type": f"{FILE_MANIFEST_OBJECT_TYPE}#{file_path}",
+            }
+        )
+        return response.get("Item")
+
+    def put_file_manifest(
+        self, workspace_id: str, file_path: str, fingerprint: str, chunks: dict = None
+    ):
+        """Record the chunks indexed for a file.
+        chunks maps content hash to number of chunks, None when the file has too many chunks to list.
+        The item has no created_at so it stays out of the by_object_type_idx index.
+        """
+        item = {
+            "workspace_id": workspace_id,
+            "object_type": f"{FILE_MANIFEST_OBJECT_TYPE}#{file_path}",
+            "file_path": file_path,
+            "fingerprint": fingerprint,
+            "updated_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        }
+        if chunks is not None:
+            item["chunks"] = chunks
+        self.workspace_table.put_item(Item=item)
+
+    def delete_file_manifest(self, workspace_id: str, file_path: str):
+        self.workspace_table.delete_item(
+            Key={
+                "workspace_id": workspace_id,
+                "object_type": f"{FILE_MANIFEST_OBJECT_TYPE}#{file_path}",
+            }
+        )
@@ -0,0 +1,338 @@
+"""
+Persistent store of chunk embeddings, reused across ingestion jobs
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# keys are sha256 digests of the text
+KEY_DTYPE = "S32"
+VECTOR_DTYPE = np.float16
+KEYS_SUFFIX = ".keys.npy"
+VECTORS_SUFFIX = ".vectors.npy"
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class _Shard:
+    """Sorted keys of a shard, its vectors are only read once one of them is looked up"""
+
+    def __init__(self, name: str, keys: np.ndarray, vectors: Optional[np.ndarray] = None):
+        self.name = name
+        self.keys = keys
+        self.vectors = vectors
+        self.lock = threading.Lock()
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """Row of every key in the shard, -1 where it is missing"""
+        if not len(self.keys):
+            return np.full(len(keys), -1)
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions >= len(self.keys)] = 0
+        found = self.keys[positions] == keys
+        return np.where(found, positions, -1)
+
+
+class EmbeddingStore:
+    """
+    Embeddings of chunk texts for one endpoint and model type, stored as shard
+    files of float16 vectors.
+
+    Every flush writes one shard, <root>/<namespace>/<shard>.keys.npy with the
+    sorted sha256 digests of the texts and <shard>.vectors.npy with their
+    vectors in the same order, the namespace being derived from the endpoint
+    and model type. The keys of all shards are loaded on first lookup and
+    searched in memory, the vectors of a shard are only downloaded and memory
+    mapped once one of its keys is hit. compact() merges the small shards left
+    by past flushes into one. With an S3 URI shards are synchronized with S3,
+    so that other jobs can reuse them.
+
+    Args:
+        endpoint_name (str): Embedding endpoint, or model name for local models.
+        model_type (str): Embedding model type, e.g. m3 or bce.
+        local_path (str): Local directory holding the shards.
+        s3_uri (str): Optional s3://bucket/prefix the shards are synchronized with.
+        flush_size (int): Write a shard once this many new embeddings are buffered.
+        compact_shards (int): compact() merges the small shards once there are more of them.
+    """
+
+    def __init__(
+        self,
+        endpoint_name: str,
+        model_type: str,
+        local_path: str = "/tmp/embedding_store",
+        s3_uri: Optional[str] = None,
+        flush_size: int = 2048,
+        s3_client=None,
+        compact_shards: int = 16,
+    ):
+        self.namespace = re.sub(r"[^A-Za-z0-9._-]", "_", f"{endpoint_name}-{model_type}")
+        self.local_path = os.path.join(local_path, self.namespace)
+        self.flush_size = flush_size
+        self.compact_shards = compact_shards
+        # shards with at least this many keys are not merged again
+        self.compact_size = flush_size * compact_shards
+        self.s3_bucket = None
+        self.s3_prefix = None
+        if s3_uri:
+            parsed = urlparse(s3_uri)
+            self.s3_bucket = parsed.netloc
+            self.s3_prefix = f"{parsed.path.strip('/')}/{self.namespace}".lstrip("/")
+            if s3_client is None:
+                import boto3
+
+                s3_client = boto3.client("s3")
+        self.s3_client = s3_client
+        self.metrics = {"hits": 0, "misses": 0, "written": 0, "shards_downloaded": 0}
+        self._shards: Dict[str, _Shard] = {}
+        self._pending: Dict[bytes, np.ndarray] = {}
+        self._loaded = False
+        # guards the shard list, the pending embeddings and the metrics, never held during S3 requests
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Stored embedding of every text, None where it is missing"""
+        self._load_keys()
+        keys = [text_key(text) for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._pending.get(key)
+                if vector is not None:
+                    results[i] = vector.astype(np.float32).tolist()
+            shards = list(self._shards.values())
+        key_array = np.array(keys, dtype=KEY_DTYPE)
+        for shard in shards:
+            missing = [i for i, result in enumerate(results) if result is None]
+            if not missing:
+                break
+            rows = shard.find(key_array[missing])
+            hits = [(i, row) for i, row in zip(missing, rows) if row >= 0]
+            if not hits:
+                continue
+            vectors = self._shard_vectors(shard)
+            if vectors is None:
+                continue
+            for i, row in hits:
+                results[i] = vectors[row].astype(np.float32).tolist()
+        hits = sum(result is not None for result in results)
+        with self._lock:
+            self.metrics["hits"] += hits
+            self.metrics["misses"] += len(results) - hits
+        return results
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]]) -> None:
+        """Buffer new embeddings, a shard is written once flush_size are buffered"""
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                # visible to lookups before the shard is written
+                self._pending.setdefault(text_key(text), np.asarray(embedding, dtype=VECTOR_DTYPE))
+            if len(self._pending) < self.flush_size:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered embeddings as one shard"""
+        with self._flush_lock:
+            with self._lock:
+                pending = dict(self._pending)
+            if not pending:
+                return
+            keys = np.array(list(pending), dtype=KEY_DTYPE)
+            vectors = np.stack(list(pending.values()))
+            shard = self._write_shard(keys, vectors)
+            with self._lock:
+                self._shards[shard.name] = shard
+                for key in pending:
+                    self._pending.pop(key, None)
+                self.metrics["written"] += len(pending)
+            logger.info(f"embedding store flushed {len(pending)} embeddings, metrics: {self.metrics}")
+
+    def compact(self) -> None:
+        """Merge the small shards into one once there are more than compact_shards of them"""
+        self._load_keys()
+        with self._flush_lock:
+            with self._lock:
+                small = [shard for shard in self._shards.values() if len(shard.keys) < self.compact_size]
+            if len(small) <= self.compact_shards:
+                return
+            merged_keys, merged_vectors, merged_shards = [], [], []
+            for shard in small:
+                vectors = self._shard_vectors(shard)
+                if vectors is None:
+                    continue
+                # a shard is only merged once its keys file is deleted, so that a job
+                # that cannot delete shards never uploads another copy of them
+                if not self._delete_file(shard.name + KEYS_SUFFIX):
+                    break
+                merged_keys.append(shard.keys)
+                merged_vectors.append(np.asarray(vectors))
+                merged_shards.append(shard)
+            if not merged_keys:
+                return
+            keys = np.concatenate(merged_keys)
+            keys, first_rows = np.unique(keys, return_index=True)
+            # a concurrent job that listed the merged shards misses their vectors, it embeds the texts again
+            merged = self._write_shard(keys, np.concatenate(merged_vectors)[first_rows])
+            with self._lock:
+                self._shards[merged.name] = merged
+                for shard in merged_shards:
+                    self._shards.pop(shard.name, None)
+            for shard in merged_shards:
+                self._delete_file(shard.name + VECTORS_SUFFIX)
+            logger.info(
+                f"embedding store compacted {len(merged_shards)} shards into {merged.name}, {len(keys)} embeddings"
+            )
+
+    def _shard_path(self, shard_name: str) -> str:
+        return os.path.join(self.local_path, shard_name)
+
+    def _s3_key(self, file_name: str) -> str:
+        return f"{self.s3_prefix}/{file_name}"
+
+    def _load_keys(self) -> None:
+        """Download the keys files of all shards once, vectors files are downloaded on the first hit"""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            os.makedirs(self.local_path, exist_ok=True)
+            if self.s3_bucket:
+                self._download_keys()
+            shards = {}
+            for file_name in sorted(os.listdir(self.local_path)):
+                if not file_name.endswith(KEYS_SUFFIX):
+                    continue
+                shard_name = file_name[: -len(KEYS_SUFFIX)]
+                try:
+                    keys = np.load(self._shard_path(shard_name) + KEYS_SUFFIX)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"skip unreadable embedding shard {shard_name}: {e}")
+                    continue
+                shards[shard_name] = _Shard(shard_name, keys)
+            with self._lock:
+                for shard_name, shard in shards.items():
+                    self._shards.setdefault(shard_name, shard)
+            self._loaded = True
+            logger.info(f"embedding store loaded the keys of {len(shards)} shards")
+
+    def _download_keys(self) -> None:
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        prefix = f"{self.s3_prefix}/"
+        try:
+            for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix, Delimiter="/"):
+                for obj in page.get("Contents", []):
+                    file_name = obj["Key"][len(prefix):]
+                    local_file = os.path.join(self.local_path, file_name)
+                    if file_name.endswith(KEYS_SUFFIX) and not os.path.exists(local_file):
+                        self.s3_client.download_file(self.s3_bucket, obj["Key"], local_file)
+        except Exception as e:
+            logger.warning(f"embedding store keys download failed: {e}")
+
+    def _shard_vectors(self, shard: _Shard) -> Optional[np.ndarray]:
+        """Vectors of a shard, downloaded under the lock of the shard only"""
+        if shard.vectors is not None:
+            return shard.vectors
+        with shard.lock:
+            if shard.vectors is not None:
+                return shard.vectors
+            local_file = self._shard_path(shard.name) + VECTORS_SUFFIX
+            try:
+                if not os.path.exists(local_file):
+                    if not self.s3_bucket:
+                        raise FileNotFoundError(local_file)
+                    # written under another name first, a partial download is never loaded
+                    download_file = f"{local_file}.{uuid.uuid4().hex[:8]}"
+                    self.s3_client.download_file(
+                        self.s3_bucket, self._s3_key(shard.name + VECTORS_SUFFIX), download_file
+                    )
+                    os.replace(download_file, local_file)
+                    with self._lock:
+                        self.metrics["shards_downloaded"] += 1
+                vectors = np.load(local_file, mmap_mode="r")
+            except Exception as e:
+                logger.warning(f"skip embedding shard {shard.name} without readable vectors: {e}")
+                with self._lock:
+                    self._shards.pop(shard.name, None)
+                return None
+            shard.vectors = vectors
+            return vectors
+
+    def _write_shard(self, keys: np.ndarray, vectors: np.ndarray) -> _Shard:
+        order = np.argsort(keys)
+        keys, vectors = keys[order], vectors[order]
+        os.makedirs(self.local_path, exist_ok=True)
+        shard_name = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        shard_path = self._shard_path(shard_name)
+        # vectors first, a shard is only picked up once its keys file exists
+        np.save(shard_path + VECTORS_SUFFIX, vectors)
+        np.save(shard_path + KEYS_SUFFIX, keys)
+        if self.s3_bucket:
+            for suffix in [VECTORS_SUFFIX, KEYS_SUFFIX]:
+                try:
+                    self.s3_client.upload_file(
+                        shard_path + suffix, self.s3_bucket, self._s3_key(shard_name + suffix)
+                    )
+                except Exception as e:
+                    logger.warning(f"embedding store shard upload failed: {e}")
+        return _Shard(shard_name, keys, np.load(shard_path + VECTORS_SUFFIX, mmap_mode="r"))
+
+    def _delete_file(self, file_name: str) -> bool:
+        """Delete a shard file from S3 and locally, False if the S3 delete failed"""
+        if self.s3_bucket:
+            try:
+                self.s3_client.delete_object(Bucket=self.s3_bucket, Key=self._s3_key(file_name))
+            except Exception as e:
+                logger.warning(f"embedding store delete of {file_name} failed: {e}")
+                return False
+        try:
+            os.remove(os.path.join(self.local_path, file_name))
+        except FileNotFoundError:
+            pass
+        return True
+
+
+def embed_with_store(
+    store: Optional[EmbeddingStore],
+    embed_fn: Callable[[List[str]], List[List[float]]],
+    texts: List[str],
+) -> List[List[float]]:
+    """
+    Embed texts, only texts missing from the store are sent to embed_fn.
+
+    Args:
+        store (EmbeddingStore): The embedding store, None embeds every text.
+        embed_fn (Callable): Embeds a list of texts, e.g. Embeddings.embed_documents.
+        texts (List[str]): Texts to embed.
+
+    Returns:
+        List[List[float]]: One embedding per text.
+    """
+    if store is None:
+        return embed_fn(texts)
+    embeddings = store.get_many(texts)
+    miss_positions = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if miss_positions:
+        miss_texts = [texts[i] for i in miss_positions]
+        miss_embeddings = embed_fn(miss_texts)
+        for i, embedding in zip(miss_positions, miss_embeddings):
+            embeddings[i] = embedding
+        store.put_many(miss_texts, miss_embeddings)
+    return embeddings
@@ -0,0 +1,62 @@
+"""
+Content addressed chunk ids and per-file manifests for incremental ingestion
+"""
+
+import hashlib
+import json
+import re
+import unicodedata
+from typing import Dict
+
+# manifests list every chunk hash, bigger files keep no chunk list to stay below the DynamoDB item size limit
+MAX_MANIFEST_CHUNKS = 8000
+
+_whitespace_pattern = re.compile(r"\s+")
+
+
+def normalize_chunk_text(text: str) -> str:
+    """Normalize unicode forms and whitespace so that cosmetic changes keep the same hash"""
+    text = unicodedata.normalize("NFKC", text)
+    return _whitespace_pattern.sub(" ", text).strip()
+
+
+def chunk_content_hash(text: str, embedding_model: str) -> str:
+    """
+    Hash of a chunk as it is embedded.
+
+    Args:
+        text (str): The chunk text sent to the embedding model.
+        embedding_model (str): The embedding model endpoint, vectors of different models are not interchangeable.
+
+    Returns:
+        str: 32 hex characters of sha256.
+    """
+    content = f"{embedding_model}\n{normalize_chunk_text(text)}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+
+def chunk_doc_id(file_path: str, content_hash: str, occurrence: int) -> str:
+    """OpenSearch document id of the occurrence-th chunk of file_path with content_hash"""
+    file_hash = hashlib.sha256(file_path.encode("utf-8")).hexdigest()[:16]
+    return f"{file_hash}-{content_hash}-{occurrence}"
+
+
+def file_fingerprint(
+    etag: str, embedding_model: str, chunk_size: int, chunk_overlap: int, splitter: str = None
+) -> str:
+    """Fingerprint of a file and the settings it was ingested with, unchanged files are skipped on update"""
+    settings = [etag, embedding_model, chunk_size, chunk_overlap]
+    # the default character splitter is left out to keep the fingerprints of earlier jobs
+    if splitter:
+        settings.append(splitter)
+    content = json.dumps(settings)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def manifest_doc_ids(file_path: str, chunk_counts: Dict[str, int]) -> set:
+    """Document ids recorded by a manifest"""
+    return {
+        chunk_doc_id(file_path, content_hash, occurrence)
+        for content_hash, count in chunk_counts.items()
+        for occurrence in range(int(count))
+    }
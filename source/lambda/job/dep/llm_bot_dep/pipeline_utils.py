@@ -0,0 +1,231 @@
+"""
+Staged producer/consumer pipeline used by the ingestion jobs
+"""
+
+import logging
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+_STOP = object()
+
+
+class PipelineTask:
+    """A unit of work tracked through all stages, e.g. one S3 file.
+
+    Every item flowing through the pipeline belongs to a task. The task is
+    done once none of its items is queued or being processed any more, a
+    failure in any stage marks the task failed and its remaining items are
+    skipped by the following stages.
+
+    Args:
+        name (str): Name used in the log, e.g. the S3 key.
+        context (dict): Free form data shared by the stages of the task.
+    """
+
+    def __init__(self, name: str, context: Optional[dict] = None):
+        self.name = name
+        self.context = context if context is not None else {}
+        self.error = None
+        self._pending = 0
+        self._on_done = None
+        self._lock = threading.Lock()
+
+    def _add_pending(self, num: int) -> bool:
+        """Update the pending item count, return True when it drops to zero"""
+        with self._lock:
+            self._pending += num
+            return self._pending == 0
+
+    def hold(self) -> Callable[[Optional[Exception]], None]:
+        """
+        Keep the task open for work a stage hands off to another thread, e.g.
+        asynchronous bulk requests. The task is done once the returned
+        release(error=None) is called, a non None error fails the task.
+        """
+        self._add_pending(1)
+
+        def release(error: Optional[Exception] = None) -> None:
+            if error is not None and self.error is None:
+                self.error = error
+            if self._add_pending(-1) and self._on_done is not None:
+                self._on_done(self)
+
+        return release
+
+
+class PipelineStage:
+    """
+    A stage of the pipeline.
+
+    Args:
+        name (str): Stage name used in the throughput log.
+        fn (Callable): fn(payload, task) returning an iterable of payloads for the next stage,
+            or None. The outputs of the last stage are dropped.
+        workers (int): Number of threads running fn.
+        queue_size (int): Capacity of the input queue, producers block when it is full.
+    """
+
+    def __init__(self, name: str, fn: Callable, workers: int = 1, queue_size: int = 16):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        # seconds spent in fn, waiting for input and blocked on a full output queue
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.blocked_time = 0.0
+        self._finished_workers = 0
+        self._lock = threading.Lock()
+
+    def stats(self, elapsed: float) -> str:
+        throughput = self.items_in / elapsed if elapsed else 0.0
+        return (
+            f"{self.name}: in={self.items_in} out={self.items_out} errors={self.errors} "
+            f"queued={self.queue.qsize()} {throughput:.2f} items/s "
+            f"busy={self.busy_time:.1f}s idle={self.idle_time:.1f}s blocked={self.blocked_time:.1f}s"
+        )
+
+
+class StagedPipeline:
+    """
+    Run stages concurrently, connected by bounded queues.
+
+    Each stage has its own worker threads, so slow stages (endpoint calls,
+    bulk requests) overlap with the others. A full queue blocks the upstream
+    stage, which bounds the memory held by in-flight documents.
+
+    Args:
+        stages (List[PipelineStage]): Stages in processing order.
+        on_task_done (Callable): Called with the task once all its items are processed.
+        log_interval (int): Seconds between throughput logs, 0 to only log at the end.
+    """
+
+    def __init__(
+        self,
+        stages: List[PipelineStage],
+        on_task_done: Optional[Callable[[PipelineTask], None]] = None,
+        log_interval: int = 60,
+    ):
+        self.stages = stages
+        self.on_task_done = on_task_done
+        self.log_interval = log_interval
+        self._start_time = None
+
+    def run(self, source: Iterable[Tuple[PipelineTask, Any]]) -> None:
+        """
+        Feed (task, payload) pairs to the first stage and wait until every stage is drained.
+        """
+        self._start_time = time.time()
+        threads = []
+        for stage_index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage_index,),
+                    name=f"{stage.name}-{i}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        stop_event = threading.Event()
+        monitor = None
+        if self.log_interval:
+            monitor = threading.Thread(target=self._monitor, args=(stop_event,), daemon=True)
+            monitor.start()
+
+        first_stage = self.stages[0]
+        for task, payload in source:
+            task._on_done = self._finish_task
+            task._add_pending(1)
+            first_stage.queue.put((task, payload))
+        for _ in range(first_stage.workers):
+            first_stage.queue.put(_STOP)
+
+        for thread in threads:
+            thread.join()
+        stop_event.set()
+        if monitor is not None:
+            monitor.join()
+        self.log_stats()
+
+    def log_stats(self) -> None:
+        elapsed = time.time() - self._start_time
+        logger.info("Pipeline stats after %.1fs", elapsed)
+        for stage in self.stages:
+            logger.info("  %s", stage.stats(elapsed))
+
+    def _monitor(self, stop_event: threading.Event) -> None:
+        while not stop_event.wait(self.log_interval):
+            self.log_stats()
+
+    def _work(self, stage_index: int) -> None:
+        stage = self.stages[stage_index]
+        next_stage = (
+            self.stages[stage_index + 1] if stage_index + 1 < len(self.stages) else None
+        )
+        while True:
+            wait_start = time.time()
+            item = stage.queue.get()
+            with stage._lock:
+                stage.idle_time += time.time() - wait_start
+            if item is _STOP:
+                break
+            task, payload = item
+            with stage._lock:
+                stage.items_in += 1
+            if task.error is None:
+                self._process(stage, next_stage, task, payload)
+            if task._add_pending(-1):
+                self._finish_task(task)
+
+        with stage._lock:
+            stage._finished_workers += 1
+            last_worker = stage._finished_workers == stage.workers
+        # the last worker to exit lets the next stage stop once it has drained its queue
+        if last_worker and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(_STOP)
+
+    def _process(self, stage, next_stage, task, payload) -> None:
+        busy_start = time.time()
+        blocked_time = 0.0
+        try:
+            outputs = stage.fn(payload, task)
+            for output in outputs or []:
+                with stage._lock:
+                    stage.items_out += 1
+                if next_stage is None:
+                    continue
+                task._add_pending(1)
+                put_start = time.time()
+                next_stage.queue.put((task, output))
+                blocked_time += time.time() - put_start
+        except Exception as e:
+            task.error = e
+            with stage._lock:
+                stage.errors += 1
+            logger.error("Stage %s failed on %s: %s", stage.name, task.name, e)
+            traceback.print_exc()
+        finally:
+            with stage._lock:
+                stage.busy_time += time.time() - busy_start - blocked_time
+                stage.blocked_time += blocked_time
+
+    def _finish_task(self, task: PipelineTask) -> None:
+        if self.on_task_done is None:
+            return
+        try:
+            self.on_task_done(task)
+        except Exception as e:
+            logger.error("Failed to finish task %s: %s", task.name, e)
+            traceback.print_exc()
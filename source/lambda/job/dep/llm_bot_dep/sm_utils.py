@@ -1,14 +1,25 @@
 import json
 import io
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, Iterator, List, Mapping, Optional
 from langchain.llms.sagemaker_endpoint import LLMContentHandler, SagemakerEndpoint
 from langchain.embeddings import SagemakerEndpointEmbeddings
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
+from langchain_core.embeddings import Embeddings
 from langchain.callbacks.manager import CallbackManagerForLLMRun
 from langchain.llms.utils import enforce_stop_tokens
 from typing import Dict, List, Optional, Any,Iterator
 from langchain_core.outputs import GenerationChunk
 import boto3
+from botocore.config import Config
 from langchain_core.pydantic_v1 import Extra, root_validator
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import (
@@ -364,35 +375,342 @@ class SagemakerEndpointChat(BaseChatModel):
         return text
         
 
-def SagemakerEndpointVectorOrCross(prompt: str, endpoint_name: str, region_name: str, model_type: str, stop: List[str], target_model=None, **kwargs) -> SagemakerEndpoint:
-    """
-    original class invocation:
-        response = self.client.invoke_endpoint(
-            EndpointName=self.endpoint_name,
-            Body=body,
-            ContentType=content_type,
-            Accept=accepts,
-            **_endpoint_kwargs,
+class EmbeddingCache:
+    """Base class of embedding cache backends, embeddings are stored by cache key"""
+    name = "base"
+
+    def get(self, key: str) -> Optional[List[float]]:
+        raise NotImplementedError
+
+    def set(self, key: str, embedding: List[float]) -> None:
+        raise NotImplementedError
+
+
+class LRUEmbeddingCache(EmbeddingCache):
+    """In-process LRU cache, shared across warm invocations of the same container"""
+    name = "memory"
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._data.get(key)
+            if embedding is not None:
+                self._data.move_to_end(key)
+            return embedding
+
+    def set(self, key, embedding):
+        with self._lock:
+            self._data[key] = embedding
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class LocalDiskEmbeddingCache(EmbeddingCache):
+    """SQLite file cache, embeddings are packed as float32"""
+    name = "disk"
+
+    def __init__(self, path: str = "/tmp/embedding_cache.db", ttl: int = 0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding (cache_key TEXT PRIMARY KEY, vector BLOB, expire_at REAL)"
         )
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, expire_at FROM embedding WHERE cache_key = ?", (key,)
+            ).fetchone()
+        if row is None or (row[1] and row[1] < time.time()):
+            return None
+        return array("f", row[0]).tolist()
+
+    def set(self, key, embedding):
+        expire_at = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embedding VALUES (?, ?, ?)",
+                (key, array("f", embedding).tobytes(), expire_at),
+            )
+            self._conn.commit()
+
+
+class DynamoDBEmbeddingCache(EmbeddingCache):
+    """DynamoDB cache shared by every container, embeddings are packed as float32.
+    The table uses `cache_key` as partition key and `expire_at` as TTL attribute.
     """
+    name = "ddb"
+
+    def __init__(self, table_name: str, ttl: int = 0):
+        self.ttl = ttl
+        self.table = boto3.resource("dynamodb").Table(table_name)
+
+    def get(self, key):
+        try:
+            item = self.table.get_item(Key={"cache_key": key}).get("Item")
+        except Exception as e:
+            logger.warning(f"embedding cache get failed: {e}")
+            return None
+        if item is None or (item.get("expire_at") and item["expire_at"] < time.time()):
+            return None
+        return array("f", item["vector"].value).tolist()
+
+    def set(self, key, embedding):
+        item = {"cache_key": key, "vector": array("f", embedding).tobytes()}
+        if self.ttl:
+            item["expire_at"] = int(time.time()) + self.ttl
+        try:
+            self.table.put_item(Item=item)
+        except Exception as e:
+            logger.warning(f"embedding cache set failed: {e}")
+
+
+class TieredEmbeddingCache:
+    """In-process LRU in front of an optional shared backend, with hit/miss metrics.
+    Hits on the shared backend are promoted to the in-process LRU.
+    """
+
+    def __init__(self, local_cache: EmbeddingCache, shared_cache: Optional[EmbeddingCache] = None):
+        self.local_cache = local_cache
+        self.shared_cache = shared_cache
+        self.metrics = {"memory_hits": 0, "shared_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(endpoint_name: str, target_model: Optional[str], model_type: str, prompt: str) -> str:
+        key_str = json.dumps([endpoint_name, target_model, model_type, prompt], ensure_ascii=False)
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        embedding = self.local_cache.get(key)
+        if embedding is not None:
+            self.metrics["memory_hits"] += 1
+            return embedding
+        if self.shared_cache is not None:
+            embedding = self.shared_cache.get(key)
+            if embedding is not None:
+                self.metrics["shared_hits"] += 1
+                self.local_cache.set(key, embedding)
+                return embedding
+        self.metrics["misses"] += 1
+        return None
+
+    def set(self, key, embedding):
+        self.local_cache.set(key, embedding)
+        if self.shared_cache is not None:
+            self.shared_cache.set(key, embedding)
+
+
+def create_embedding_cache() -> Optional[TieredEmbeddingCache]:
+    """Build the query embedding cache from the environment.
+
+    embedding_cache_size: in-process LRU size, 0 disables the cache
+    embedding_cache_backend: optional shared backend, "disk" or "ddb"
+    embedding_cache_path: SQLite file of the disk backend
+    embedding_cache_table: DynamoDB table of the ddb backend
+    embedding_cache_ttl: seconds entries stay valid in the shared backend, 0 keeps them
+    """
+    cache_size = int(os.environ.get("embedding_cache_size", 1024))
+    if cache_size <= 0:
+        return None
+    backend = os.environ.get("embedding_cache_backend", "")
+    ttl = int(os.environ.get("embedding_cache_ttl", 0))
+    shared_cache = None
+    try:
+        if backend == "disk":
+            shared_cache = LocalDiskEmbeddingCache(
+                os.environ.get("embedding_cache_path", "/tmp/embedding_cache.db"), ttl
+            )
+        elif backend == "ddb":
+            shared_cache = DynamoDBEmbeddingCache(os.environ["embedding_cache_table"], ttl)
+    except Exception as e:
+        logger.warning(f"embedding cache backend {backend} unavailable, using memory only: {e}")
+    return TieredEmbeddingCache(LRUEmbeddingCache(cache_size), shared_cache)
+
+
+embedding_cache = create_embedding_cache()
+
+
+class EmbeddingMicroBatcher:
+    """Coalesce concurrent embedding requests into batched endpoint calls.
+
+    Callers submit texts and get futures back. A background thread collects
+    requests until `max_batch_size` texts are queued or `max_wait_ms` has passed
+    since the first one, groups them by endpoint wrapper and sends each group as
+    a single embed_documents call. Up to `max_concurrent_batches` calls are in
+    flight at once, while they run the next batch keeps filling up.
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 5, max_concurrent_batches: int = 4):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = {"requests": 0, "batches": 0}
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_concurrent_batches)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def submit(self, embeddings: Embeddings, texts: List[str]) -> List[Future]:
+        self._ensure_started()
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((embeddings, text, future))
+            futures.append(future)
+        return futures
+
+    def embed_query(self, embeddings: Embeddings, text: str) -> List[float]:
+        return self.submit(embeddings, [text])[0].result()
+
+    def embed_documents(self, embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+        return [future.result() for future in self.submit(embeddings, texts)]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._flush, batch)
+
+    def _flush(self, batch):
+        groups = OrderedDict()
+        for embeddings, text, future in batch:
+            groups.setdefault(id(embeddings), (embeddings, []))[1].append((text, future))
+        for embeddings, items in groups.values():
+            with self._lock:
+                self.metrics["requests"] += len(items)
+                self.metrics["batches"] += 1
+            try:
+                vectors = embeddings.embed_documents([text for text, _ in items])
+                if len(vectors) != len(items):
+                    raise ValueError(
+                        f"embedding endpoint returned {len(vectors)} vectors for {len(items)} texts"
+                    )
+            except Exception as e:
+                # every caller waits on its future, none may be left unresolved
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(items, vectors):
+                future.set_result(vector)
+
+
+def create_embedding_batcher() -> Optional[EmbeddingMicroBatcher]:
+    """Build the embedding micro-batcher from the environment.
+
+    embedding_batch_max_size: texts per endpoint call, 1 or less disables batching
+    embedding_batch_max_wait_ms: how long the first request waits for others to join
+    embedding_batch_max_concurrency: batched endpoint calls in flight at once
+    """
+    max_batch_size = int(os.environ.get("embedding_batch_max_size", 1))
+    if max_batch_size <= 1:
+        return None
+    return EmbeddingMicroBatcher(
+        max_batch_size=max_batch_size,
+        max_wait_ms=float(os.environ.get("embedding_batch_max_wait_ms", 5)),
+        max_concurrent_batches=int(os.environ.get("embedding_batch_max_concurrency", 4)),
+    )
+
+
+embedding_batcher = create_embedding_batcher()
+
+
+class MicroBatchEmbeddings(Embeddings):
+    """Embeddings whose calls go through the shared micro-batcher, so that
+    concurrent callers share endpoint calls."""
+
+    def __init__(self, embeddings: SagemakerEndpointEmbeddings, batcher: EmbeddingMicroBatcher):
+        self.embeddings = embeddings
+        self.batcher = batcher
+
+    @property
+    def endpoint_name(self) -> str:
+        return self.embeddings.endpoint_name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.batcher.embed_documents(self.embeddings, texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.batcher.embed_query(self.embeddings, text)
+
+
+def _embed_query(embeddings: SagemakerEndpointEmbeddings, prompt: str) -> List[float]:
+    if embedding_batcher is None:
+        return embeddings.embed_query(prompt)
+    return embedding_batcher.embed_query(embeddings, prompt)
+
+
+def _embed_query_with_cache(embeddings: SagemakerEndpointEmbeddings, prompt: str, model_type: str, target_model=None) -> List[float]:
+    if embedding_cache is None:
+        return _embed_query(embeddings, prompt)
+    key = TieredEmbeddingCache.make_key(embeddings.endpoint_name, target_model, model_type, prompt)
+    query_result = embedding_cache.get(key)
+    if query_result is None:
+        query_result = _embed_query(embeddings, prompt)
+        embedding_cache.set(key, query_result)
+    logger.info(f"embedding cache metrics: {embedding_cache.metrics}")
+    return query_result
+
+
+# sized for the executor fan-out of BGEReranker and the context expansion
+SAGEMAKER_MAX_POOL_CONNECTIONS = int(os.environ.get("sagemaker_max_pool_connections", 50))
+_sagemaker_client_lock = threading.Lock()
+_sagemaker_runtime_clients = {}
+_sagemaker_endpoint_wrappers = {}
+
+
+def get_sagemaker_runtime_client(region_name: Optional[str] = None):
+    """Return the shared sagemaker-runtime client of the region.
+    boto3 clients are thread-safe, a single pooled keep-alive client per region
+    avoids paying client construction and TLS handshakes on every call.
+    """
+    with _sagemaker_client_lock:
+        client = _sagemaker_runtime_clients.get(region_name)
+        if client is None:
+            client = boto3.client(
+                "sagemaker-runtime",
+                region_name=region_name,
+                config=Config(
+                    max_pool_connections=SAGEMAKER_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                ),
+            )
+            _sagemaker_runtime_clients[region_name] = client
+        return client
+
+
+def _create_endpoint_wrapper(endpoint_name: str, region_name: str, model_type: str, target_model=None):
     if target_model:
         endpoint_kwargs={"TargetModel":target_model}
     else:
         endpoint_kwargs=None
-    client = boto3.client(
-            "sagemaker-runtime",
-            region_name=region_name
-        )
+    client = get_sagemaker_runtime_client(region_name)
     if model_type == "vector" or model_type == "bce":
         content_handler = vectorContentHandler()
-        embeddings = SagemakerEndpointEmbeddings(
+        return SagemakerEndpointEmbeddings(
             client=client,
             endpoint_name=endpoint_name,
             content_handler=content_handler,
             endpoint_kwargs=endpoint_kwargs
         )
-        query_result = embeddings.embed_query(prompt)
-        return query_result
     elif model_type == "cross":
         content_handler = crossContentHandler()
     elif model_type == "m3":
@@ -401,34 +719,61 @@ def SagemakerEndpointVectorOrCross(prompt: str, endpoint_name: str, region_name:
         model_kwargs['batch_size'] = 12
         model_kwargs['max_length'] = 512
         model_kwargs['return_type'] = 'dense'
-        embeddings = SagemakerEndpointEmbeddings(
+        return SagemakerEndpointEmbeddings(
             client=client,
             endpoint_name=endpoint_name,
             content_handler=content_handler,
             model_kwargs=model_kwargs,
             endpoint_kwargs=endpoint_kwargs
         )
-        query_result = embeddings.embed_query(prompt)
-        return query_result
     elif model_type == "answer":
         content_handler = answerContentHandler()
     elif model_type == "rerank":
         content_handler = rerankContentHandler()
+    else:
+        raise ValueError(f'invalid model type: {model_type}')
     # TODO: replace with SagemakerEndpointStreaming
-    genericModel = SagemakerEndpoint(
+    return SagemakerEndpoint(
         client=client,
         endpoint_name = endpoint_name,
         # region_name = region_name,
         content_handler = content_handler,
         endpoint_kwargs=endpoint_kwargs
     )
-    return genericModel(prompt=prompt, stop=stop, **kwargs)
 
-def getCustomEmbeddings(endpoint_name: str, region_name: str, model_type: str) -> SagemakerEndpointEmbeddings:
-    client = boto3.client(
-            "sagemaker-runtime",
-            region_name=region_name
-            )
+
+def get_endpoint_wrapper(endpoint_name: str, region_name: str, model_type: str, target_model=None):
+    """Return the registered SagemakerEndpointEmbeddings/SagemakerEndpoint wrapper,
+    building it on first use. Wrappers hold no per-request state and are reused.
+    """
+    key = (endpoint_name, region_name, model_type, target_model)
+    wrapper = _sagemaker_endpoint_wrappers.get(key)
+    if wrapper is None:
+        wrapper = _create_endpoint_wrapper(endpoint_name, region_name, model_type, target_model)
+        with _sagemaker_client_lock:
+            wrapper = _sagemaker_endpoint_wrappers.setdefault(key, wrapper)
+    return wrapper
+
+
+def SagemakerEndpointVectorOrCross(prompt: str, endpoint_name: str, region_name: str, model_type: str, stop: List[str], target_model=None, **kwargs) -> SagemakerEndpoint:
+    """
+    original class invocation:
+        response = self.client.invoke_endpoint(
+            EndpointName=self.endpoint_name,
+            Body=body,
+            ContentType=content_type,
+            Accept=accepts,
+            **_endpoint_kwargs,
+        )
+    """
+    wrapper = get_endpoint_wrapper(endpoint_name, region_name, model_type, target_model)
+    if model_type in ["vector", "bce", "m3"]:
+        query_result = _embed_query_with_cache(wrapper, prompt, model_type, target_model)
+        return query_result
+    return wrapper(prompt=prompt, stop=stop, **kwargs)
+
+def getCustomEmbeddings(endpoint_name: str, region_name: str, model_type: str) -> Embeddings:
+    client = get_sagemaker_runtime_client(region_name)
     embeddings = None
     if model_type == "bce":
         content_handler = vectorContentHandler()
@@ -451,4 +796,6 @@ def getCustomEmbeddings(endpoint_name: str, region_name: str, model_type: str) -
             model_kwargs=model_kwargs,
             content_handler=content_handler,
         )
+    if embedding_batcher is not None:
+        return MicroBatchEmbeddings(embeddings, embedding_batcher)
     return embeddings
\ No newline at end of file
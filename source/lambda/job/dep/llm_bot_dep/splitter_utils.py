@@ -1,8 +1,10 @@
+import bisect
+import copy
 import logging
 import re
 import traceback
 import uuid
-from typing import Any, List
+from typing import Any, Iterator, List
 
 import boto3
 from langchain.docstore.document import Document
@@ -83,69 +85,208 @@ class SpacyTextSplitter(TextSplitter):
         return self._merge_splits(splits, self._separator)
 
 
-def find_parent(headers: dict, level: int):
-    """Find the parent node of current node
-    Find the last node whose level is less than current node
+# a sentence ends with Chinese or English end punctuation and closing quotes, or a line break,
+# a dot only ends a sentence when followed by whitespace so that 3.14 or e.g. stay intact
+_sentence_pattern = re.compile(
+    r"(?:[^。！？；!?;.\n]|\.(?!\s|$))*(?:[。！？；!?;]+[”’」』）)\"']*|\.+|\n+|$)"
+)
+_cjk_pattern = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+_word_pattern = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_぀-ヿ㐀-䶿一-鿿가-힯]")
 
-    Args:
-        headers (dict): headers dict
-        level (int): level of the header, eg. # is level1, ## is level2
 
-    Returns:
-        _type_: parent node id or None
-    """
-    for id, header in reversed(list(headers.items())):
-        if header["level"] < level:
-            return id
+def estimate_tokens(text: str) -> int:
+    """Token count of an XLM-R style tokenizer without loading it, one per CJK character and about one per short word"""
+    num_tokens = len(_cjk_pattern.findall(text))
+    for word in _word_pattern.findall(text):
+        num_tokens += 1 + len(word) // 6
+    return num_tokens
 
-    return None
 
+def load_tokenizer(tokenizer_name_or_path: str):
+    """
+    Load a HuggingFace fast tokenizer from a tokenizer.json path or the hub.
 
-def find_previous_with_same_level(headers: dict, level: int):
-    """Find the previous node with same level
+    Returns:
+        tokenizers.Tokenizer or None if the tokenizers package or the tokenizer is not available.
+    """
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        logger.warning("tokenizers is not installed, token counts are estimated")
+        return None
+    try:
+        if tokenizer_name_or_path.endswith(".json"):
+            return Tokenizer.from_file(tokenizer_name_or_path)
+        return Tokenizer.from_pretrained(tokenizer_name_or_path)
+    except Exception as e:
+        logger.warning(f"Failed to load tokenizer {tokenizer_name_or_path}, token counts are estimated: {e}")
+        return None
 
-    Args:
-        headers (dict): headers dict
-        level (int): level of the header, eg. # is level1, ## is level2
 
-    Returns:
-        _type_: previous node id or None
+class TokenCounter:
     """
-    for id, header in reversed(list(headers.items())):
-        if header["level"] == level:
-            return id
+    Count tokens with a fast tokenizer, cached per text.
 
-    return None
+    Uncached texts are encoded together with encode_batch, which runs in
+    parallel in the Rust tokenizer. Without tokenizer the counts are estimated.
 
+    Args:
+        tokenizer: tokenizers.Tokenizer, None to estimate the counts.
+        cache_size (int): Number of cached counts, the cache is emptied once full.
+    """
 
-def find_next_with_same_level(headers: dict, header_id: str):
-    level = headers[header_id]["level"]
-    header_found = False
+    def __init__(self, tokenizer=None, cache_size: int = 200000):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        cache = self._cache
+        missing = {text for text in texts if text not in cache}
+        if missing and len(cache) + len(missing) > self.cache_size:
+            cache.clear()
+            missing = set(texts)
+        if missing:
+            missing = list(missing)
+            if self.tokenizer is None:
+                counts = [estimate_tokens(text) for text in missing]
+            else:
+                encodings = self.tokenizer.encode_batch(missing, add_special_tokens=False)
+                counts = [len(encoding.ids) for encoding in encodings]
+            cache.update(zip(missing, counts))
+        return [cache[text] for text in texts]
+
+    def token_starts_batch(self, texts: List[str]) -> List[List[int]]:
+        """Character offset of every token of each text, encoded together with encode_batch"""
+        if self.tokenizer is None:
+            starts_list = []
+            for text in texts:
+                starts = [match.start() for match in _cjk_pattern.finditer(text)]
+                for match in _word_pattern.finditer(text):
+                    starts.extend([match.start()] * (1 + len(match.group()) // 6))
+                starts.sort()
+                starts_list.append(starts)
+            return starts_list
+        encodings = self.tokenizer.encode_batch(texts, add_special_tokens=False)
+        return [[start for start, _ in encoding.offsets] for encoding in encodings]
+
+    def split(self, text: str, max_tokens: int) -> List[str]:
+        """Cut text into pieces of at most max_tokens tokens"""
+        if self.tokenizer is None:
+            num_tokens = max(self.count(text), 1)
+            step = max(1, len(text) * max_tokens // num_tokens)
+            return [text[i : i + step] for i in range(0, len(text), step)]
+        offsets = self.tokenizer.encode(text, add_special_tokens=False).offsets
+        pieces = []
+        for i in range(0, len(offsets), max_tokens):
+            start = offsets[i][0] if i else 0
+            end = offsets[i + max_tokens][0] if i + max_tokens < len(offsets) else len(text)
+            pieces.append(text[start:end])
+        return pieces
+
+
+class TokenAwareTextSplitter(TextSplitter):
+    """
+    Split text into chunks of at most chunk_size tokens of the embedding model.
 
-    for id, header in headers.items():
-        if header_id == id:
-            header_found = True
+    The text is cut into sentences on Chinese and English end punctuation and
+    line breaks, the sentences are packed greedily into chunks up to the token
+    budget, and the last sentences of a chunk up to chunk_overlap tokens start
+    the next one. Sentences longer than the budget are cut on token boundaries.
+    Chunk sizes thereby match the max_length the embedding endpoint truncates
+    to, whatever the language, which a character budget does not.
 
-        # Find the next node with the same level
-        if header_found and header["level"] == level and header_id != id:
-            return id
+    Args:
+        chunk_size (int): Token budget of a chunk, keep it below the max_length of the embedding model.
+        chunk_overlap (int): Tokens of trailing sentences repeated at the start of the next chunk.
+        tokenizer: tokenizers.Tokenizer, loaded from tokenizer_name_or_path if None.
+        tokenizer_name_or_path (str): Hub name or tokenizer.json path of the embedding model tokenizer.
+    """
 
-    return None
+    def __init__(
+        self,
+        chunk_size: int = 500,
+        chunk_overlap: int = 50,
+        tokenizer=None,
+        tokenizer_name_or_path: str = "BAAI/bge-m3",
+        **kwargs: Any,
+    ) -> None:
+        if tokenizer is None:
+            tokenizer = load_tokenizer(tokenizer_name_or_path)
+        self.token_counter = TokenCounter(tokenizer)
+        super().__init__(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=self.token_counter.count,
+            **kwargs,
+        )
 
+    def split_text(self, text: str, reserved_tokens: int = 0) -> List[str]:
+        """
+        Split text into chunks, reserved_tokens of the budget are kept free, e.g. for a heading prepended later.
+        """
+        return self.split_texts([text], [reserved_tokens])[0]
 
-def find_child(headers: dict, header_id: str):
-    children = []
-    level = headers[header_id]["level"]
+    def split_texts(self, texts: List[str], reserved_tokens: List[int] = None) -> List[List[str]]:
+        """
+        Split several texts at once, every text is encoded once and all of them in a single batch.
 
-    for id, header in headers.items():
-        if (
-            header["level"] == level + 1
-            and id not in children
-            and header["parent"] == header_id
-        ):
-            children.append(id)
+        Sentence token counts are taken from the token offsets of the whole
+        text instead of encoding each sentence again.
+        """
+        if reserved_tokens is None:
+            reserved_tokens = [0] * len(texts)
+        starts_list = self.token_counter.token_starts_batch(texts)
+        return [
+            self._pack(text, starts, reserved)
+            for text, starts, reserved in zip(texts, starts_list, reserved_tokens)
+        ]
+
+    def _pack(self, text: str, token_starts: List[int], reserved_tokens: int) -> List[str]:
+        budget = max(self._chunk_size - reserved_tokens, 1)
+        overlap = min(self._chunk_overlap, budget // 2)
+
+        units = []
+        first_token = 0
+        for match in _sentence_pattern.finditer(text):
+            if match.start() == match.end():
+                continue
+            # a token belongs to the sentence its first character is in
+            last_token = bisect.bisect_left(token_starts, match.end(), first_token)
+            count = last_token - first_token
+            first_token = last_token
+            sentence = match.group()
+            if count > budget:
+                for piece in self.token_counter.split(sentence, budget):
+                    units.append((piece, self.token_counter.count(piece)))
+            else:
+                units.append((sentence, count))
 
-    return children
+        chunks = []
+        current, current_tokens = [], 0
+        for unit, count in units:
+            if current and current_tokens + count > budget:
+                chunks.append("".join(text for text, _ in current))
+                # start the next chunk with the trailing sentences fitting in the overlap
+                kept_tokens = 0
+                start = len(current)
+                while start > 0:
+                    unit_tokens = current[start - 1][1]
+                    if kept_tokens + unit_tokens > overlap or kept_tokens + unit_tokens + count > budget:
+                        break
+                    kept_tokens += unit_tokens
+                    start -= 1
+                current, current_tokens = current[start:], kept_tokens
+            current.append((unit, count))
+            current_tokens += count
+        if current:
+            chunks.append("".join(text for text, _ in current))
+        if self._strip_whitespace:
+            chunks = [chunk.strip() for chunk in chunks]
+        return [chunk for chunk in chunks if chunk]
 
 
 def parse_string_to_xml_node(xml_string):
@@ -157,8 +298,18 @@ def parse_string_to_xml_node(xml_string):
         return None
 
 
+_heading_pattern = re.compile(r"\s*(#+)(.*)")
+_markdown_header_pattern = re.compile(r"#+\s+")
+_markdown_table_row_pattern = re.compile(r"\|.*\|.*\|")
+
+
 def extract_headings(md_content: str):
     """Extract heading hierarchy from Markdown content.
+
+    Headings are linked in a single pass: a stack of the open headings with
+    increasing levels gives the parent, and the last heading of every level
+    gives the previous heading, whose next heading is set at the same time.
+
     Args:
         md_content (str): Markdown content.
     Returns:
@@ -166,34 +317,41 @@ def extract_headings(md_content: str):
     """
     header_index = 0
     headers = {}
-    lines = md_content.split("\n")
     id_index_dict = {}
-    for line in lines:
-        match = re.match(r"\s*(#+)(.*)", line)
-        if match:
-            header_index += 1
-            # print(match.group)
-            level = len(match.group(1))
-            title = match.group(2).strip()
-            id_prefix = str(uuid.uuid4())[:8]
-            _id = f"${header_index}-{id_prefix}"
-            parent = find_parent(headers, level)
-            previous = find_previous_with_same_level(headers, level)
-            headers[_id] = {
-                "title": title,
-                "level": level,
-                "parent": parent,
-                "previous": previous,
-            }
-            # Use list in case multiple heading have the same title
-            if title not in id_index_dict:
-                id_index_dict[title] = [_id]
-            else:
-                id_index_dict[title].append(_id)
-
-    for header_obj in headers:
-        headers[header_obj]["child"] = find_child(headers, header_obj)
-        headers[header_obj]["next"] = find_next_with_same_level(headers, header_obj)
+    # (id, level) of the headings a following heading can be nested in
+    stack = []
+    last_id_by_level = {}
+    for line in md_content.split("\n"):
+        match = _heading_pattern.match(line)
+        if not match:
+            continue
+        header_index += 1
+        level = len(match.group(1))
+        title = match.group(2).strip()
+        id_prefix = str(uuid.uuid4())[:8]
+        _id = f"${header_index}-{id_prefix}"
+        # the parent is the last heading with a lower level
+        while stack and stack[-1][1] >= level:
+            stack.pop()
+        parent = stack[-1][0] if stack else None
+        previous = last_id_by_level.get(level)
+        headers[_id] = {
+            "title": title,
+            "level": level,
+            "parent": parent,
+            "previous": previous,
+            "child": [],
+            "next": None,
+        }
+        # only direct children are listed, a heading skipping a level is not
+        if parent is not None and headers[parent]["level"] == level - 1:
+            headers[parent]["child"].append(_id)
+        if previous is not None:
+            headers[previous]["next"] = _id
+        stack.append((_id, level))
+        last_id_by_level[level] = _id
+        # Use list in case multiple heading have the same title
+        id_index_dict.setdefault(title, []).append(_id)
 
     return headers, id_index_dict
 
@@ -204,14 +362,10 @@ class MarkdownHeaderTextSplitter:
         self.res_bucket = res_bucket
 
     def _is_markdown_header(self, line):
-        header_pattern = r"^#+\s+"
-        if re.match(header_pattern, line):
-            return True
-        else:
-            return False
+        return line.startswith("#") and _markdown_header_pattern.match(line) is not None
 
     def _is_markdown_table_row(self, line):
-        return re.fullmatch(r"\|.*\|.*\|", line) is not None
+        return line.startswith("|") and _markdown_table_row_pattern.fullmatch(line) is not None
 
     def _set_chunk_id(
         self,
@@ -284,21 +438,50 @@ class MarkdownHeaderTextSplitter:
                 "No resource bucket is defined, skip saving content into S3 bucket"
             )
 
-        lines = text.page_content.strip().split("\n")
+        content = text.page_content.strip()
+        lines = content.split("\n")
         chunks = []
         current_chunk_content = []
         same_heading_dict = {}
         table_content = []
         inside_table = False
-        current_figure = ""
+        current_figure = []
         inside_figure = False
-        heading_hierarchy, id_index_dict = extract_headings(text.page_content.strip())
-        if len(lines) > 0:
-            current_heading = lines[0]
+        heading_hierarchy, id_index_dict = extract_headings(content)
+        current_heading = lines[0]
 
         # save current heading map
         current_heading_level_map = {}
 
+        def make_chunk(page_content: str, content_type: str) -> Document:
+            nonlocal current_heading
+            metadata = dict(text.metadata)
+            metadata["content_type"] = content_type
+            metadata["current_heading"] = current_heading
+            current_heading_list = self._get_current_heading_list(
+                current_heading, current_heading_level_map
+            )
+            current_heading = current_heading.replace("#", "").strip()
+            try:
+                self._set_chunk_id(
+                    id_index_dict, current_heading, metadata, same_heading_dict
+                )
+            except KeyError:
+                logger.info(f"No standard heading found for {current_heading}")
+                id_prefix = str(uuid.uuid4())[:8]
+                metadata["chunk_id"] = f"$0-{id_prefix}"
+            if metadata["chunk_id"] in heading_hierarchy:
+                metadata["heading_hierarchy"] = heading_hierarchy[metadata["chunk_id"]]
+            if "service" in metadata:
+                metadata["complete_heading"] = (
+                    metadata["service"] + " " + current_heading_list
+                )
+            else:
+                metadata["complete_heading"] = current_heading_list
+            return Document(page_content=page_content, metadata=metadata)
+
+        figure_start = FigureNode.START.value
+        figure_end = FigureNode.END.value
         for line in lines:
             # Replace escaped characters for table markers
             line = line.strip()
@@ -306,173 +489,96 @@ class MarkdownHeaderTextSplitter:
             if self._is_markdown_header(line):  # Assuming these denote headings
                 # Save the current chunk if it exists
                 if current_chunk_content:
-                    metadata = text.metadata.copy()
-                    metadata["content_type"] = "paragragh"
-                    metadata["current_heading"] = current_heading
-                    current_heading_list = self._get_current_heading_list(
-                        current_heading, current_heading_level_map
-                    )
-                    current_heading = current_heading.replace("#", "").strip()
-                    # split_words = '*' * 100
-                    # logger.info(f"{split_words}")
-                    # logger.info(f"current line is {line}")
-                    # logger.info(f"current metadata is {text.metadata}")
-                    # logger.info(f"current heading list is {current_heading_list}")
-                    # logger.info(f"current heading level map is {current_heading_level_map}")
-                    # logger.info(f"{split_words}")
-                    try:
-                        self._set_chunk_id(
-                            id_index_dict, current_heading, metadata, same_heading_dict
-                        )
-                    except KeyError:
-                        logger.info(
-                            f"No standard heading found, check your document with {current_chunk_content}"
-                        )
-                        id_prefix = str(uuid.uuid4())[:8]
-                        metadata["chunk_id"] = f"$0-{id_prefix}"
-                    if metadata["chunk_id"] in heading_hierarchy:
-                        metadata["heading_hierarchy"] = heading_hierarchy[
-                            metadata["chunk_id"]
-                        ]
-                    page_content = "\n".join(current_chunk_content)
-                    if "service" in metadata:
-                        metadata["complete_heading"] = (
-                            metadata["service"] + " " + current_heading_list
-                        )
-                    else:
-                        metadata["complete_heading"] = current_heading_list
                     chunks.append(
-                        Document(
-                            page_content=page_content,
-                            metadata=metadata,
-                        )
+                        make_chunk("\n".join(current_chunk_content), "paragragh")
                     )
                     current_chunk_content = []  # Reset for the next chunk
                 current_heading = line
 
-            if FigureNode.START.value == line:
+            if line == figure_start:
                 inside_figure = True
-                current_figure += line + "\n"
-            elif FigureNode.END.value == line:
-                current_figure += line
+                current_figure.append(line + "\n")
+            elif line == figure_end:
+                current_figure.append(line)
                 inside_figure = False
                 # Parse xml node to get content and metadata
-                xml_node = parse_string_to_xml_node(current_figure)
+                xml_node = parse_string_to_xml_node("".join(current_figure))
                 figure_type = xml_node.findtext(FigureNode.TYPE.value)
                 figure_description = xml_node.find(FigureNode.DESCRIPTION.value)
                 figure_value = xml_node.find(FigureNode.VALUE.value)
                 chunk_figure_content = etree.tostring(figure_description).decode("utf-8")
                 if figure_value is not None:
                     chunk_figure_content += "\n" + etree.tostring(figure_value).decode("utf-8")
-                metadata = text.metadata.copy()
-                metadata["content_type"] = figure_type
-                metadata["current_heading"] = current_heading
-                current_heading_list = self._get_current_heading_list(
-                    current_heading, current_heading_level_map
-                )
-                current_heading = current_heading.replace("#", "").strip()
-                try:
-                    self._set_chunk_id(
-                        id_index_dict, current_heading, metadata, same_heading_dict
-                    )
-                except KeyError:
-                    logger.info(f"No standard heading found")
-                    id_prefix = str(uuid.uuid4())[:8]
-                    metadata["chunk_id"] = f"$0-{id_prefix}"
-                if metadata["chunk_id"] in heading_hierarchy:
-                    metadata["heading_hierarchy"] = heading_hierarchy[
-                        metadata["chunk_id"]
-                    ]
-                if "service" in metadata:
-                    metadata["complete_heading"] = (
-                        metadata["service"] + " " + current_heading_list
-                    )
-                else:
-                    metadata["complete_heading"] = current_heading_list
-                chunks.append(
-                    Document(
-                        page_content=chunk_figure_content, metadata=metadata
-                    )
-                )
-                current_figure = ""       
+                chunks.append(make_chunk(chunk_figure_content, figure_type))
+                current_figure = []
             elif inside_figure:
-                current_figure += line
+                current_figure.append(line)
 
-            if self._is_markdown_table_row(line) and not inside_figure:
+            if not inside_figure and self._is_markdown_table_row(line):
                 inside_table = True
             elif inside_table:
                 # The first line under a table
                 inside_table = False
                 # Save table content as a separate document
                 if table_content:
-                    metadata = text.metadata.copy()
-                    metadata["content_type"] = "table"
-                    metadata["current_heading"] = current_heading
-                    current_heading_list = self._get_current_heading_list(
-                        current_heading, current_heading_level_map
-                    )
-                    current_heading = current_heading.replace("#", "").strip()
-                    try:
-                        self._set_chunk_id(
-                            id_index_dict, current_heading, metadata, same_heading_dict
-                        )
-                    except KeyError:
-                        logger.info(f"No standard heading found")
-                        id_prefix = str(uuid.uuid4())[:8]
-                        metadata["chunk_id"] = f"$0-{id_prefix}"
-                    if metadata["chunk_id"] in heading_hierarchy:
-                        metadata["heading_hierarchy"] = heading_hierarchy[
-                            metadata["chunk_id"]
-                        ]
-                    if "service" in metadata:
-                        metadata["complete_heading"] = (
-                            metadata["service"] + " " + current_heading_list
-                        )
-                    else:
-                        metadata["complete_heading"] = current_heading_list
-                    chunks.append(
-                        Document(
-                            page_content="\n".join(table_content), metadata=metadata
-                        )
-                    )
+                    chunks.append(make_chunk("\n".join(table_content), "table"))
                     table_content = []  # Reset for the next table
 
             if inside_table:
                 table_content.append(line)
-            elif not inside_figure and FigureNode.END.value != line:
+            elif not inside_figure and line != figure_end:
                 current_chunk_content.append(line)
 
         # Save the last chunk if it exists
         if current_chunk_content:
-            metadata = text.metadata.copy()
-            metadata["content_type"] = "paragragh"
-            metadata["current_heading"] = current_heading
-            current_heading_list = self._get_current_heading_list(
-                current_heading, current_heading_level_map
-            )
-            current_heading = current_heading.replace("#", "").strip()
-            try:
-                self._set_chunk_id(
-                    id_index_dict, current_heading, metadata, same_heading_dict
-                )
-            except KeyError:
-                logger.info(f"No standard heading found")
-                id_prefix = str(uuid.uuid4())[:8]
-                metadata["chunk_id"] = f"$0-{id_prefix}"
-            if metadata["chunk_id"] in heading_hierarchy:
-                metadata["heading_hierarchy"] = heading_hierarchy[metadata["chunk_id"]]
-            page_content = "\n".join(current_chunk_content)
-            if "service" in metadata:
-                metadata["complete_heading"] = (
-                    metadata["service"] + " " + current_heading_list
-                )
-            else:
-                metadata["complete_heading"] = current_heading_list
-            chunks.append(
-                Document(
-                    page_content=page_content,
-                    metadata=metadata,
-                )
-            )
+            chunks.append(make_chunk("\n".join(current_chunk_content), "paragragh"))
 
         return chunks
+
+
+def chunk_documents(
+    content: List[Document], text_splitter: TextSplitter
+) -> Iterator[Document]:
+    """
+    Split sections produced by MarkdownHeaderTextSplitter into chunks in a single pass.
+
+    The splits of a section are materialised once, their number is stored as
+    the size of the heading_hierarchy of the section, and the chunks are
+    yielded lazily. Chunk ids get the position of the chunk in its section
+    as suffix, starting from 1.
+
+    Args:
+        content (List[Document]): Sections with chunk_id and optional heading_hierarchy metadata.
+        text_splitter (TextSplitter): Splitter bounding the chunk size.
+
+    Yields:
+        Document: A chunk of a section.
+    """
+    if isinstance(text_splitter, TokenAwareTextSplitter):
+        content = list(content)
+        # the complete heading is prepended to the chunks before they are embedded
+        headings = [document.metadata.get("complete_heading") or "" for document in content]
+        heading_tokens = text_splitter.token_counter.count_batch([heading + " " for heading in headings])
+        texts_list = text_splitter.split_texts(
+            [document.page_content for document in content],
+            [count if heading else 0 for heading, count in zip(headings, heading_tokens)],
+        )
+    else:
+        texts_list = (text_splitter.split_text(document.page_content) for document in content)
+    for document, texts in zip(content, texts_list):
+        chunk_id = document.metadata["chunk_id"]
+        heading_hierarchy = document.metadata.get("heading_hierarchy")
+        if heading_hierarchy is not None:
+            heading_hierarchy["size"] = len(texts)
+        # every chunk gets its own copy of the metadata, except the heading hierarchy shared by the section
+        section_metadata = {
+            key: value
+            for key, value in document.metadata.items()
+            if key != "heading_hierarchy"
+        }
+        for index, text in enumerate(texts, start=1):
+            metadata = copy.deepcopy(section_metadata)
+            metadata["chunk_id"] = f"{chunk_id}-{index}"
+            if heading_hierarchy is not None:
+                metadata["heading_hierarchy"] = heading_hierarchy
+            yield Document(page_content=text, metadata=metadata)
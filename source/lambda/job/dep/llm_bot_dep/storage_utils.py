@@ -2,9 +2,15 @@
 Helper functions for storage intermediate content or log
 """
 
+import atexit
 import datetime
+import gzip
 import json
 import logging
+import os
+import queue
+import threading
+from typing import Dict, List, Tuple
 from urllib.parse import urlparse
 from botocore.exceptions import ClientError
 
@@ -14,67 +20,204 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def convert_to_logger(document: Document) -> str:
-    # TODO: Convert the document to a logger file format, customize if possible
-    logger_content = "Page Content: \n" + document.page_content + "\n"
-    logger_content += "Metadata: " + json.dumps(document.metadata, ensure_ascii=False)
+# raw size of the records of one file and splitting type that triggers an upload
+ARTIFACT_FLUSH_BYTES = 8 * 1024 * 1024
 
-    return logger_content
+_STOP = object()
 
 
-def upload_chunk_to_s3(
-    s3, logger_content: str, bucket: str, prefix: str, splitting_type: str
-):
-    """Upload the logger file to S3 with hierarchy below:
+def artifact_prefix(file_path: str) -> str:
+    """Top level folder of the artifacts of a source file"""
+    return file_path.replace("s3://", "").replace("/", "-").replace(".", "-")
+
+
+class ArtifactWriter:
+    """Buffered writer of intermediate content, stored with the hierarchy below:
     filename A
         ├── semantic-splitting (split by headers)
-        │   ├── timestamp 1
-        │   │   ├── logger file 1
-        │   ├── timestamp 2
-        │   │   ├── logger file 2
+        │   ├── hour 1
+        │   │   ├── <timestamp>-0.jsonl.gz
+        │   │   ├── <timestamp>-1.jsonl.gz
         ├── chunk-size-splitting (split by chunk size)
-        │   ├── timestamp 3
-        │   │   ├── logger file 3
-        │   ├── timestamp 4
-        │   │   ├── logger file 4
+        │   ├── hour 1
+        │   │   ├── <timestamp>-0.jsonl.gz
         ├── before-splitting (whole markdown content before splitting)
-        │   ├── timestamp 5
-        │   │   ├── logger file 5
-        │   ├── timestamp 6
-        │   │   ├── logger file 6
         ├── qa-enhancement (QA enhanced content generated by LLM)
-        │   ├── timestamp 7
-        │   │   ├── logger file 7
-        │   ├── timestamp 8
-        │   │   ├── logger file 8
         ...
+
+    Documents are appended as JSON lines to an in-memory buffer per source file
+    and splitting type. A buffer is gzipped and uploaded by a background thread
+    once it reaches flush_bytes, or when the file is flushed, so a file costs
+    a handful of PUT requests instead of one per section and chunk.
+
+    Args:
+        s3: S3 client
+        bucket (str): Target S3 bucket
+        enabled (bool): False drops every artifact, e.g. for production loads
+        flush_bytes (int): Buffer size triggering an upload
     """
-    # round the timestamp to hours to avoid too many folders
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H")
-    # make the logger file name unique
-    object_key = f"{prefix}/{splitting_type}/{timestamp}/{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')}.log"
-    try:
-        res = s3.put_object(Bucket=bucket, Key=object_key, Body=logger_content)
-        logger.debug(f"Upload logger file to S3: {res}")
-    except Exception as e:
-        logger.error(f"Error uploading logger file to S3: {e}")
+
+    def __init__(
+        self,
+        s3,
+        bucket: str,
+        enabled: bool = True,
+        flush_bytes: int = ARTIFACT_FLUSH_BYTES,
+        queue_size: int = 32,
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.enabled = enabled
+        self.flush_bytes = flush_bytes
+        self.metrics = {"records": 0, "objects": 0, "errors": 0}
+        self._buffers: Dict[Tuple[str, str], List[bytes]] = {}
+        self._buffer_sizes: Dict[Tuple[str, str], int] = {}
+        self._parts: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def write(self, document: Document, splitting_type: str) -> None:
+        if not self.enabled:
+            return
+        prefix = artifact_prefix(document.metadata.get("file_path", ""))
+        record = json.dumps(
+            {"page_content": document.page_content, "metadata": document.metadata},
+            ensure_ascii=False,
+            default=str,
+        )
+        line = (record + "\n").encode("utf-8")
+        key = (prefix, splitting_type)
+        with self._lock:
+            self._buffers.setdefault(key, []).append(line)
+            self._buffer_sizes[key] = self._buffer_sizes.get(key, 0) + len(line)
+            self.metrics["records"] += 1
+            full = self._buffer_sizes[key] >= self.flush_bytes
+            records = self._pop_buffer(key) if full else None
+        if records:
+            self._upload(key, records)
+
+    def flush_file(self, file_path: str) -> None:
+        """Upload the buffered artifacts of a source file"""
+        prefix = artifact_prefix(file_path)
+        with self._lock:
+            pending = [
+                (key, self._pop_buffer(key)) for key in list(self._buffers) if key[0] == prefix
+            ]
+        for key, records in pending:
+            self._upload(key, records)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending = [(key, self._pop_buffer(key)) for key in list(self._buffers)]
+        for key, records in pending:
+            self._upload(key, records)
+
+    def close(self) -> None:
+        """Upload everything buffered and wait for the background thread"""
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+            logger.info(f"Artifact writer closed, metrics: {self.metrics}")
+
+    def _pop_buffer(self, key: Tuple[str, str]) -> List[bytes]:
+        self._buffer_sizes.pop(key, None)
+        return self._buffers.pop(key, [])
+
+    def _upload(self, key: Tuple[str, str], records: List[bytes]) -> None:
+        prefix, splitting_type = key
+        with self._lock:
+            part = self._parts.get(key, 0)
+            self._parts[key] = part + 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="artifact-writer", daemon=True
+                )
+                self._thread.start()
+        now = datetime.datetime.now()
+        # round the folder to hours to avoid too many folders
+        object_key = f"{prefix}/{splitting_type}/{now.strftime('%Y-%m-%d-%H')}/{now.strftime('%Y-%m-%d-%H-%M-%S-%f')}-{part}.jsonl.gz"
+        self._queue.put((object_key, records))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            object_key, records = item
+            try:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=object_key,
+                    Body=gzip.compress(b"".join(records)),
+                    ContentType="application/x-ndjson",
+                )
+                self.metrics["objects"] += 1
+            except Exception as e:
+                self.metrics["errors"] += 1
+                logger.error(f"Error uploading artifact {object_key} to S3: {e}")
+
+
+_artifact_writers: Dict[str, ArtifactWriter] = {}
+_artifact_writers_lock = threading.Lock()
+_artifact_config = {
+    "enabled": os.environ.get("artifact_persistence", "true").lower() == "true",
+    "flush_bytes": ARTIFACT_FLUSH_BYTES,
+}
+
+
+def configure_artifact_writers(enabled: bool = None, flush_bytes: int = None) -> None:
+    """Set the options of the writers created by save_content_to_s3"""
+    if enabled is not None:
+        _artifact_config["enabled"] = enabled
+    if flush_bytes is not None:
+        _artifact_config["flush_bytes"] = flush_bytes
+    with _artifact_writers_lock:
+        for writer in _artifact_writers.values():
+            writer.enabled = _artifact_config["enabled"]
+            writer.flush_bytes = _artifact_config["flush_bytes"]
+
+
+def get_artifact_writer(s3, bucket: str) -> ArtifactWriter:
+    with _artifact_writers_lock:
+        if bucket not in _artifact_writers:
+            _artifact_writers[bucket] = ArtifactWriter(s3, bucket, **_artifact_config)
+        return _artifact_writers[bucket]
+
+
+def flush_artifacts(file_path: str = None) -> None:
+    """Upload the buffered artifacts of a source file, or of all files"""
+    with _artifact_writers_lock:
+        writers = list(_artifact_writers.values())
+    for writer in writers:
+        if file_path is None:
+            writer.flush()
+        else:
+            writer.flush_file(file_path)
+
+
+def close_artifact_writers() -> None:
+    with _artifact_writers_lock:
+        writers = list(_artifact_writers.values())
+    for writer in writers:
+        writer.close()
+
+
+# artifacts still buffered when the job ends are not lost
+atexit.register(close_artifact_writers)
 
 
 def save_content_to_s3(s3, document: Document, res_bucket: str, splitting_type: str):
-    """Save content to S3 bucket
+    """Save content to S3 bucket, buffered by the artifact writer of the bucket
 
     Args:
         document (Document): The page document to be saved
         res_bucket (str): Target S3 bucket
         s3 (_type_): S3 client
     """
-    logger_file = convert_to_logger(document)
-    # Extract the filename from the file_path in the metadata
-    file_path = document.metadata.get("file_path", "")
-    # filename = file_path.split('/')[-1].split('.')[0]
-    filename = file_path.replace("s3://", "").replace("/", "-").replace(".", "-")
-    # RecursiveCharacterTextSplitter have been rewrite to split based on chunk size & overlap, use separate folder to store the logger file
-    upload_chunk_to_s3(s3, logger_file, res_bucket, filename, splitting_type)
+    get_artifact_writer(s3, res_bucket).write(document, splitting_type)
 
 
 def _s3_uri_exist(s3_client, s3_uri: str) -> bool:
@@ -2,7 +2,10 @@ import itertools
 import logging
 import os
 import sys
+import threading
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Generator, Iterable, List
 
@@ -14,8 +17,10 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import OpenSearchVectorSearch
 from langchain_community.vectorstores.opensearch_vector_search import (
     OpenSearchVectorSearch,
+    _default_text_mapping,
 )
 from opensearchpy import RequestsHttpConnection
+from opensearchpy.exceptions import RequestError
 from requests_aws4auth import AWS4Auth
 from tenacity import retry, stop_after_attempt, wait_exponential
 
@@ -79,11 +84,27 @@ except Exception as e:
     args["REGION"] = os.environ["region"]
 
 from llm_bot_dep import sm_utils
+from llm_bot_dep.bulk_utils import BulkIndexer, BulkLoadMode
 from llm_bot_dep.constant import SplittingType
 from llm_bot_dep.ddb_utils import WorkspaceManager
+from llm_bot_dep.embedding_store import EmbeddingStore, embed_with_store
 from llm_bot_dep.embeddings import get_embedding_info
 from llm_bot_dep.loaders.auto import cb_process_object
-from llm_bot_dep.storage_utils import save_content_to_s3
+from llm_bot_dep.manifest_utils import (
+    MAX_MANIFEST_CHUNKS,
+    chunk_content_hash,
+    chunk_doc_id,
+    file_fingerprint,
+    manifest_doc_ids,
+)
+from llm_bot_dep.pipeline_utils import PipelineStage, PipelineTask, StagedPipeline
+from llm_bot_dep.splitter_utils import TokenAwareTextSplitter, chunk_documents
+from llm_bot_dep.storage_utils import (
+    close_artifact_writers,
+    configure_artifact_writers,
+    flush_artifacts,
+    save_content_to_s3,
+)
 
 # Adaption to allow nougat to run in AWS Glue with writable /tmp
 os.environ["TRANSFORMERS_CACHE"] = "/tmp/transformers_cache"
@@ -119,6 +140,8 @@ s3_client = boto3.client("s3")
 smr_client = boto3.client("sagemaker-runtime")
 dynamodb = boto3.resource("dynamodb")
 etl_object_table = dynamodb.Table(etl_object_table_name)
+# boto3 resources are not thread safe, pipeline stages share the tables through this lock
+dynamodb_lock = threading.Lock()
 workspace_table = dynamodb.Table(workspace_table)
 workspace_manager = WorkspaceManager(workspace_table)
 
@@ -128,10 +151,42 @@ OBJECT_EXPIRY_TIME = 3600
 credentials = boto3.Session().get_credentials()
 awsauth = AWS4Auth(refreshable_credentials=credentials, region=region, service="es")
 MAX_OS_DOCS_PER_PUT = 8
+# worker threads of each ingestion pipeline stage and capacity of the queues between them
+PIPELINE_STAGE_WORKERS = {"fetch": 4, "parse": 2, "chunk": 1, "embed": 4, "index": 2}
+PIPELINE_QUEUE_SIZE = 16
+# threads deleting stale chunks and writing the status of finished files
+PIPELINE_FINISH_WORKERS = 2
+PIPELINE_LOG_INTERVAL = 60
+# chunk embeddings reused across jobs, e.g. when the same corpus is ingested into another workspace
+EMBEDDING_STORE_S3_URI = f"s3://{res_bucket}/embedding-store"
+EMBEDDING_STORE_LOCAL_PATH = "/tmp/embedding_store"
+# disable refresh and replicas of an index created by the job until the job ends, off since the batch jobs of
+# an execution run in parallel on the same index and the first one to end would restore its settings
+BULK_LOAD_MODE = False
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_THREAD_COUNT = 4
+# segments per shard after the job, None skips the force merge
+BULK_FORCE_MERGE_SEGMENTS = None
+# size chunks in tokens of the embedding model instead of characters, changing it re-embeds every file on update
+TOKEN_AWARE_CHUNKING = False
+CHUNK_TOKEN_SIZE = 500
+CHUNK_TOKEN_OVERLAP = 50
+CHUNK_TOKENIZER = "BAAI/bge-m3"
+# intermediate sections and chunks written to the result bucket as gzipped JSONL, one object per file and MB limit
+SAVE_INTERMEDIATE_ARTIFACTS = True
+ARTIFACT_FLUSH_BYTES = 8 * 1024 * 1024
+configure_artifact_writers(
+    enabled=SAVE_INTERMEDIATE_ARTIFACTS, flush_bytes=ARTIFACT_FLUSH_BYTES
+)
 
 nltk.data.path.append("/tmp/nltk_data")
 
 
+def put_etl_object_item(item: dict):
+    with dynamodb_lock:
+        etl_object_table.put_item(Item=item)
+
+
 class S3FileProcessor:
     def __init__(self, bucket: str, prefix: str, supported_file_types: List[str] = []):
         self.bucket = bucket
@@ -181,7 +236,7 @@ class S3FileProcessor:
             "createTime": create_time,
             "status": "RUNNING",
         }
-        etl_object_table.put_item(Item=input_body)
+        put_etl_object_item(input_body)
 
         if file_type == "txt":
             return "txt", self.decode_file_content(file_content), kwargs
@@ -214,7 +269,7 @@ class S3FileProcessor:
                 "status": "FAILED",
                 "detail": message,
             }
-            etl_object_table.put_item(Item=input_body)
+            put_etl_object_item(input_body)
             logger.info(message)
 
     def decode_file_content(self, file_content: str, default_encoding: str = "utf-8"):
@@ -258,7 +313,11 @@ class S3FileProcessor:
                         file_content = self.get_file_content(key)
                         yield self.process_file(key, file_type, file_content)
                     else:
-                        yield file_type, "", {"bucket": self.bucket, "key": key}
+                        yield file_type, "", {
+                            "bucket": self.bucket,
+                            "key": key,
+                            "etag": obj.get("ETag", ""),
+                        }
 
             if current_indice >= (int(batchIndice) + 1) * int(batchFileNumber):
                 # Exit the outer loop
@@ -273,6 +332,8 @@ class BatchChunkDocumentProcessor:
         chunk_size (int): The size of each chunk.
         chunk_overlap (int): The overlap between consecutive chunks.
         batch_size (int): The size of each batch.
+        token_aware (bool): Count chunk_size and chunk_overlap in tokens of the tokenizer instead of characters.
+        tokenizer (str): Hub name or tokenizer.json path of the embedding model tokenizer.
 
     Methods:
         chunk_generator(content: List[Document]) -> Generator[Document, None, None]:
@@ -288,16 +349,29 @@ class BatchChunkDocumentProcessor:
         chunk_size: int,
         chunk_overlap: int,
         batch_size: int,
+        token_aware: bool = False,
+        tokenizer: str = CHUNK_TOKENIZER,
     ):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.batch_size = batch_size
+        self.token_aware = token_aware
+        if token_aware:
+            self.text_splitter = TokenAwareTextSplitter(
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                tokenizer_name_or_path=tokenizer,
+            )
+        else:
+            self.text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
 
     def chunk_generator(
         self, content: List[Document]
     ) -> Generator[Document, None, None]:
         """
-        Generates chunks of documents from the given content.
+        Generates chunks of documents from the given content, each section is split once.
 
         Args:
             content (List[Document]): The list of documents to be chunked.
@@ -306,38 +380,7 @@ class BatchChunkDocumentProcessor:
             Document: A chunk of a document.
 
         """
-        temp_text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
-        )
-        temp_content = content
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
-        )
-        updated_heading_hierarchy = {}
-        for temp_document in temp_content:
-            temp_chunk_id = temp_document.metadata["chunk_id"]
-            temp_split_size = len(temp_text_splitter.split_documents([temp_document]))
-            # Add size in heading_hierarchy
-            if "heading_hierarchy" in temp_document.metadata:
-                temp_hierarchy = temp_document.metadata["heading_hierarchy"]
-                temp_hierarchy["size"] = temp_split_size
-                updated_heading_hierarchy[temp_chunk_id] = temp_hierarchy
-
-        for document in content:
-            splits = text_splitter.split_documents([document])
-            # List of Document objects
-            index = 1
-            for split in splits:
-                chunk_id = split.metadata["chunk_id"]
-                logger.info(chunk_id)
-                split.metadata["chunk_id"] = f"{chunk_id}-{index}"
-                if chunk_id in updated_heading_hierarchy:
-                    split.metadata["heading_hierarchy"] = updated_heading_hierarchy[
-                        chunk_id
-                    ]
-                    logger.info(split.metadata["heading_hierarchy"])
-                index += 1
-                yield split
+        return chunk_documents(content, self.text_splitter)
 
     def batch_generator(self, content: List[Document], gen_chunk_flag: bool = True):
         """
@@ -444,60 +487,187 @@ class OpenSearchIngestionWorker:
         self,
         docsearch: OpenSearchVectorSearch,
         embedding_model_endpoint: str,
+        embedding_store: EmbeddingStore = None,
+        bulk_indexer: BulkIndexer = None,
+        bulk_load_mode: BulkLoadMode = None,
     ):
         self.docsearch = docsearch
         self.embedding_model_endpoint = embedding_model_endpoint
+        self.embedding_store = embedding_store
+        self.bulk_indexer = bulk_indexer
+        self.bulk_load_mode = bulk_load_mode
+        self._index_ready = False
+        self._index_lock = threading.Lock()
+
+    def aos_ingestion(self, documents: List[Document]) -> None:
+        texts, embeddings_vectors, metadatas = self.embed_documents(documents)
+        self.add_embeddings(texts, embeddings_vectors, metadatas)
 
     @retry(
         stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
     )
-    def aos_ingestion(self, documents: List[Document]) -> None:
+    def embed_documents(self, documents: List[Document]):
+        """
+        Embed a batch of documents.
+
+        Args:
+            documents (List[Document]): The documents to embed.
+
+        Returns:
+            tuple: texts, embedding vectors and metadatas of the documents.
+        """
         texts = [doc.page_content for doc in documents]
         metadatas = [doc.metadata for doc in documents]
+        # only texts missing from the embedding store are sent to the endpoint
+        embeddings_vectors = embed_with_store(
+            self.embedding_store, self._embed_texts, texts
+        )
+        for metadata in metadatas:
+            metadata["embedding_endpoint_name"] = self.embedding_model_endpoint
+        return texts, embeddings_vectors, metadatas
+
+    def _embed_texts(self, texts: List[str]):
         embeddings_vectors = self.docsearch.embedding_function.embed_documents(
             list(texts)
         )
-
         if isinstance(embeddings_vectors[0], dict):
-            embeddings_vectors_list = []
-            metadata_list = []
-            for doc_id, metadata in enumerate(metadatas):
-                embeddings_vectors_list.append(
-                    embeddings_vectors[0]["dense_vecs"][doc_id]
-                )
-                metadata["embedding_endpoint_name"] = self.embedding_model_endpoint
-                metadata_list.append(metadata)
-            embeddings_vectors = embeddings_vectors_list
-            metadatas = metadata_list
-        self.docsearch._OpenSearchVectorSearch__add(
-            texts, embeddings_vectors, metadatas=metadatas
+            embeddings_vectors = embeddings_vectors[0]["dense_vecs"]
+        return embeddings_vectors
+
+    def ensure_index(self, dimension: int) -> None:
+        """
+        Create the index with the default k-NN mapping of OpenSearchVectorSearch
+        before the first bulk request, and switch it to bulk load mode if this
+        job created it. Existing indices keep serving searches with their settings.
+        """
+        if self._index_ready:
+            return
+        with self._index_lock:
+            if self._index_ready:
+                return
+            index_name = self.docsearch.index_name
+            created = False
+            if not self.docsearch.client.indices.exists(index=index_name):
+                try:
+                    self.docsearch.client.indices.create(
+                        index=index_name, body=_default_text_mapping(dimension)
+                    )
+                    created = True
+                except RequestError as e:
+                    # created by a concurrent job in the meantime
+                    if e.error != "resource_already_exists_exception":
+                        raise
+            if created:
+                self.bulk_load_mode.begin()
+            self._index_ready = True
+
+    def add_embeddings(
+        self, texts, embeddings_vectors, metadatas, ids=None, callback=None
+    ) -> None:
+        """
+        Queue the chunks for bulk indexing, callback(error) is called once they are indexed.
+        """
+        self.ensure_index(len(embeddings_vectors[0]))
+        actions = []
+        for i, text in enumerate(texts):
+            actions.append(
+                {
+                    "_op_type": "index",
+                    "_index": self.docsearch.index_name,
+                    "_id": ids[i] if ids else str(uuid.uuid4()),
+                    "vector_field": embeddings_vectors[i],
+                    "text": text,
+                    "metadata": metadatas[i],
+                }
+            )
+        self.bulk_indexer.submit(actions, callback)
+
+    def update_metadatas(self, ids, metadatas, callback=None) -> None:
+        """
+        Refresh the metadata of already indexed chunks without embedding them again.
+        The chunk ids in heading_hierarchy are regenerated on every parse, so kept
+        chunks need the metadata of the new parse to stay linked with new chunks.
+        """
+        actions = [
+            {
+                "_op_type": "update",
+                "_index": self.docsearch.index_name,
+                "_id": document_id,
+                "doc": {"metadata": metadata},
+            }
+            for document_id, metadata in zip(ids, metadatas)
+        ]
+        self.bulk_indexer.submit(actions, callback)
+
+    def close(self) -> None:
+        """Wait for the queued bulk requests, then restore and refresh the index"""
+        try:
+            self.bulk_indexer.close()
+        finally:
+            self.bulk_load_mode.end()
+
+    def delete_stale_chunks(self, file_path: str, keep_ids: List[str]) -> None:
+        """
+        Delete the chunks of file_path not in keep_ids, including chunks indexed
+        with random ids before content addressed ids were used.
+        """
+        if not self.docsearch.client.indices.exists(index=self.docsearch.index_name):
+            return
+        response = self.docsearch.client.delete_by_query(
+            index=self.docsearch.index_name,
+            body={
+                "query": {
+                    "bool": {
+                        "filter": [{"term": {"metadata.file_path.keyword": file_path}}],
+                        "must_not": [{"ids": {"values": keep_ids}}],
+                    }
+                }
+            },
+            conflicts="proceed",
         )
+        logger.info("Deleted %d stale chunks of %s", response["deleted"], file_path)
 
 
 class OpenSearchDeleteWorker:
-    def __init__(self, docsearch: OpenSearchVectorSearch):
+    def __init__(
+        self,
+        docsearch: OpenSearchVectorSearch,
+        bulk_indexer: BulkIndexer,
+        bulk_load_mode: BulkLoadMode,
+    ):
         self.docsearch = docsearch
         self.index_name = self.docsearch.index_name
+        self.bulk_indexer = bulk_indexer
+        self.bulk_load_mode = bulk_load_mode
 
     def aos_deletion(self, document_ids) -> None:
-        bulk_delete_requests = []
-
         # Check if self.index_name exists
         if not self.docsearch.client.indices.exists(index=self.index_name):
             logger.info("Index %s does not exist", self.index_name)
             return
         else:
-            for document_id in document_ids:
-                bulk_delete_requests.append(
-                    {"delete": {"_id": document_id, "_index": self.index_name}}
-                )
+            bulk_delete_requests = [
+                {"_op_type": "delete", "_index": self.index_name, "_id": document_id}
+                for document_id in document_ids
+            ]
+
+            def log_result(error):
+                if error is not None:
+                    logger.error("Failed to delete documents: %s", error)
+                else:
+                    logger.info("Deleted %d documents", len(document_ids))
 
-            self.docsearch.client.bulk(
-                index=self.index_name, body=bulk_delete_requests, refresh=True
-            )
-            logger.info("Deleted %d documents", len(document_ids))
+            # deletions are visible after the refresh at the end of the job
+            self.bulk_indexer.submit(bulk_delete_requests, log_result)
             return
 
+    def close(self) -> None:
+        """Wait for the queued bulk requests, then restore and refresh the index"""
+        try:
+            self.bulk_indexer.close()
+        finally:
+            self.bulk_load_mode.end()
+
 
 def update_workspace(workspace_id, embedding_model_endpoint, index_type):
     (
@@ -523,90 +693,279 @@ def update_workspace(workspace_id, embedding_model_endpoint, index_type):
 
 
 def ingestion_pipeline(
-    s3_files_iterator, batch_chunk_processor, ingestion_worker, extract_only=False
+    s3_files_iterator,
+    file_processor,
+    batch_chunk_processor,
+    ingestion_worker,
+    extract_only=False,
+    incremental=False,
 ):
-    for file_type, file_content, kwargs in s3_files_iterator:
-        input_body = {
-            "s3Path": f"s3://{kwargs['bucket']}/{kwargs['key']}",
-            "s3Bucket": kwargs["bucket"],
-            "s3Prefix": kwargs["key"],
-            "executionId": table_item_id,
-            "createTime": kwargs["create_time"],
-            "status": "SUCCEED",
-        }
-        try:
-            # The res is list[Document] type
-            res = cb_process_object(s3_client, file_type, file_content, **kwargs)
-            for document in res:
-                save_content_to_s3(
-                    s3_client, document, res_bucket, SplittingType.SEMANTIC.value
-                )
-
-            gen_chunk_flag = False if file_type == "csv" else True
-            batches = batch_chunk_processor.batch_generator(res, gen_chunk_flag)
+    """
+    Ingest S3 files through concurrent fetch, parse, chunk, embed and index stages.
 
-            for batch in batches:
-                if len(batch) == 0:
-                    continue
+    The stages are connected by bounded queues, so the embedding endpoint and
+    OpenSearch keep working while the next files are downloaded and parsed.
+    The status of each file is written to the ETL object table once all of its
+    chunks are indexed, or as soon as one of its stages fails. Chunks are sent
+    by the bulk indexer of the worker in large bulk requests without refresh,
+    the index is refreshed once when the pipeline is done.
 
-                for document in batch:
-                    if "complete_heading" in document.metadata:
-                        document.page_content = (
-                            document.metadata["complete_heading"]
-                            + " "
-                            + document.page_content
-                        )
-                    else:
-                        document.page_content = document.page_content
+    Chunks are indexed with content addressed ids and a manifest of the chunks
+    of each file is kept in the workspace table. In incremental mode, files
+    whose manifest fingerprint is unchanged are skipped, only chunks missing
+    from the manifest are embedded, and chunks that disappeared are deleted.
 
-                    save_content_to_s3(
-                        s3_client, document, res_bucket, SplittingType.CHUNK.value
+    Args:
+        s3_files_iterator: Iterator of (file_type, "", kwargs) for the S3 files to ingest.
+        file_processor (S3FileProcessor): Processor used to download and prepare the files.
+        batch_chunk_processor (BatchChunkDocumentProcessor): Processor splitting documents into chunk batches.
+        ingestion_worker (OpenSearchIngestionWorker): Worker embedding and indexing the batches.
+        extract_only (bool): Stop after chunking, nothing is embedded or indexed.
+        incremental (bool): Reuse the chunks recorded in the file manifests.
+    """
+    fingerprint_kwargs = {
+        "embedding_model": embedding_model_endpoint,
+        "chunk_size": batch_chunk_processor.chunk_size,
+        "chunk_overlap": batch_chunk_processor.chunk_overlap,
+        "splitter": "token" if batch_chunk_processor.token_aware else None,
+    }
+
+    def fetch(payload, task):
+        file_type, key = payload
+        if incremental:
+            with dynamodb_lock:
+                manifest = workspace_manager.get_file_manifest(
+                    workspace_id, task.context["file_path"]
+                )
+            fingerprint = file_fingerprint(task.context["etag"], **fingerprint_kwargs)
+            if manifest and manifest["fingerprint"] == fingerprint:
+                logger.info("Skipping unchanged object: %s", key)
+                task.context["skipped"] = True
+                return
+            task.context["old_chunks"] = (manifest or {}).get("chunks") or {}
+        file_content = file_processor.get_file_content(key)
+        processed = file_processor.process_file(key, file_type, file_content)
+        if processed is None:
+            raise ValueError(f"Unknown file type: {file_type}")
+        task.context["create_time"] = processed[2]["create_time"]
+        yield processed
+
+    def parse(payload, task):
+        file_type, file_content, kwargs = payload
+        # The res is list[Document] type
+        res = cb_process_object(s3_client, file_type, file_content, **kwargs)
+        for document in res:
+            save_content_to_s3(
+                s3_client, document, res_bucket, SplittingType.SEMANTIC.value
+            )
+        yield file_type, res
+
+    def chunk(payload, task):
+        file_type, res = payload
+        file_path = task.context["file_path"]
+        old_doc_ids = manifest_doc_ids(file_path, task.context.get("old_chunks", {}))
+        doc_ids = []
+        chunk_counts = {}
+        gen_chunk_flag = False if file_type == "csv" else True
+        for batch in batch_chunk_processor.batch_generator(res, gen_chunk_flag):
+            if len(batch) == 0:
+                continue
+
+            for document in batch:
+                if "complete_heading" in document.metadata:
+                    document.page_content = (
+                        document.metadata["complete_heading"]
+                        + " "
+                        + document.page_content
                     )
 
-                if not extract_only:
-                    ingestion_worker.aos_ingestion(batch)
-        except Exception as e:
-            logger.error(
-                "Error processing object %s: %s",
-                kwargs["bucket"] + "/" + kwargs["key"],
-                e,
+                save_content_to_s3(
+                    s3_client, document, res_bucket, SplittingType.CHUNK.value
+                )
+            if extract_only:
+                yield batch
+                continue
+
+            new_docs, new_ids, kept_docs, kept_ids = [], [], [], []
+            for document in batch:
+                content_hash = chunk_content_hash(
+                    document.page_content, embedding_model_endpoint
+                )
+                occurrence = chunk_counts.get(content_hash, 0)
+                chunk_counts[content_hash] = occurrence + 1
+                document_id = chunk_doc_id(file_path, content_hash, occurrence)
+                doc_ids.append(document_id)
+                if document_id in old_doc_ids:
+                    kept_docs.append(document)
+                    kept_ids.append(document_id)
+                else:
+                    new_docs.append(document)
+                    new_ids.append(document_id)
+            if new_docs:
+                yield "add", new_docs, new_ids
+            if kept_docs:
+                yield "update", kept_docs, kept_ids
+        task.context["doc_ids"] = doc_ids
+        task.context["chunk_counts"] = chunk_counts
+
+    def embed(payload, task):
+        operation, documents, ids = payload
+        if operation == "add":
+            texts, embeddings_vectors, metadatas = ingestion_worker.embed_documents(
+                documents
+            )
+            yield operation, (texts, embeddings_vectors, metadatas), ids
+        else:
+            yield operation, [doc.metadata for doc in documents], ids
+
+    def index(payload, task):
+        operation, data, ids = payload
+        # the file is done once the bulk indexer acknowledged its chunks
+        release = task.hold()
+        if operation == "add":
+            texts, embeddings_vectors, metadatas = data
+            ingestion_worker.add_embeddings(
+                texts, embeddings_vectors, metadatas, ids=ids, callback=release
+            )
+        else:
+            ingestion_worker.update_metadatas(ids, data, callback=release)
+
+    def finish_file(task):
+        """Delete vanished chunks and record the manifest of an ingested file"""
+        file_path = task.context["file_path"]
+        if incremental:
+            ingestion_worker.delete_stale_chunks(file_path, task.context["doc_ids"])
+        chunk_counts = task.context["chunk_counts"]
+        with dynamodb_lock:
+            workspace_manager.put_file_manifest(
+                workspace_id,
+                file_path,
+                file_fingerprint(task.context["etag"], **fingerprint_kwargs),
+                chunk_counts if len(chunk_counts) <= MAX_MANIFEST_CHUNKS else None,
             )
-            input_body = {
-                "s3Path": f"s3://{kwargs['bucket']}/{kwargs['key']}",
-                "s3Bucket": kwargs["bucket"],
-                "s3Prefix": kwargs["key"],
-                "executionId": table_item_id,
-                "createTime": kwargs["create_time"],
-                "status": "FAILED",
-                "detail": str(e),
-            }
-            traceback.print_exc()
-        finally:
-            etl_object_table.put_item(Item=input_body)
-
 
-def delete_pipeline(s3_files_iterator, document_generator, delete_worker):
-    for _, _, kwargs in s3_files_iterator:
-        try:
-            s3_path = f"s3://{kwargs['bucket']}/{kwargs['key']}"
+    # files are finished on their own threads, not on the thread releasing the task,
+    # e.g. the result thread of the bulk indexer acknowledging the chunks of every file
+    finisher = ThreadPoolExecutor(
+        max_workers=PIPELINE_FINISH_WORKERS, thread_name_prefix="finish"
+    )
 
-            batches = document_generator.batch_generator(s3_path)
-            for batch in batches:
-                if len(batch) == 0:
-                    continue
-                delete_worker.aos_deletion(batch)
+    def on_task_done(task):
+        finisher.submit(update_file_status, task)
 
+    def update_file_status(task):
+        try:
+            write_file_status(task)
         except Exception as e:
-            logger.error(
-                "Error processing object %s: %s",
-                kwargs["bucket"] + "/" + kwargs["key"],
-                e,
-            )
+            logger.error("Failed to finish object %s: %s", task.name, e)
             traceback.print_exc()
 
+    def write_file_status(task):
+        bucket, key = task.context["bucket"], task.context["key"]
+        input_body = {
+            "s3Path": f"s3://{bucket}/{key}",
+            "s3Bucket": bucket,
+            "s3Prefix": key,
+            "executionId": table_item_id,
+            "createTime": task.context.get(
+                "create_time", str(datetime.now(timezone.utc))
+            ),
+            "status": "SUCCEED",
+        }
+        if task.context.get("skipped"):
+            input_body["detail"] = "unchanged, skipped"
+        elif task.error is None and not extract_only:
+            try:
+                finish_file(task)
+            except Exception as e:
+                task.error = e
+        if task.error is not None:
+            logger.error("Error processing object %s: %s", bucket + "/" + key, task.error)
+            input_body["status"] = "FAILED"
+            input_body["detail"] = str(task.error)
+        put_etl_object_item(input_body)
+        flush_artifacts(task.context["file_path"])
+
+    stage_fns = [("fetch", fetch), ("parse", parse), ("chunk", chunk)]
+    if not extract_only:
+        stage_fns += [("embed", embed), ("index", index)]
+    stages = [
+        PipelineStage(
+            name,
+            fn,
+            workers=PIPELINE_STAGE_WORKERS[name],
+            queue_size=PIPELINE_QUEUE_SIZE,
+        )
+        for name, fn in stage_fns
+    ]
+    pipeline = StagedPipeline(
+        stages, on_task_done=on_task_done, log_interval=PIPELINE_LOG_INTERVAL
+    )
+    try:
+        pipeline.run(
+            (
+                PipelineTask(
+                    kwargs["key"],
+                    {
+                        "bucket": kwargs["bucket"],
+                        "key": kwargs["key"],
+                        "etag": kwargs["etag"],
+                        "file_path": f"s3://{kwargs['bucket']}/{kwargs['key']}",
+                    },
+                ),
+                (file_type, kwargs["key"]),
+            )
+            for file_type, _, kwargs in s3_files_iterator
+        )
+    finally:
+        try:
+            if not extract_only:
+                # the last chunks are indexed and their files released while closing
+                ingestion_worker.close()
+        finally:
+            finisher.shutdown(wait=True)
+            close_artifact_writers()
+    if not extract_only and ingestion_worker.embedding_store is not None:
+        ingestion_worker.embedding_store.flush()
+        ingestion_worker.embedding_store.compact()
+
+
+def delete_pipeline(s3_files_iterator, document_generator, delete_worker):
+    try:
+        for _, _, kwargs in s3_files_iterator:
+            try:
+                s3_path = f"s3://{kwargs['bucket']}/{kwargs['key']}"
+
+                # before the chunks, so that the next update ingests the file
+                # again from scratch even if deleting the chunks fails
+                with dynamodb_lock:
+                    workspace_manager.delete_file_manifest(workspace_id, s3_path)
+                batches = document_generator.batch_generator(s3_path)
+                for batch in batches:
+                    if len(batch) == 0:
+                        continue
+                    delete_worker.aos_deletion(batch)
+
+            except Exception as e:
+                logger.error(
+                    "Error processing object %s: %s",
+                    kwargs["bucket"] + "/" + kwargs["key"],
+                    e,
+                )
+                traceback.print_exc()
+    finally:
+        # the deletions are visible after the refresh at the end
+        delete_worker.close()
+
 
 def create_processors_and_workers(
-    operation_type, docsearch, embedding_model_endpoint, file_processor
+    operation_type,
+    docsearch,
+    embedding_model_endpoint,
+    file_processor,
+    embedding_store=None,
+    bulk_indexer=None,
+    bulk_load_mode=None,
 ):
     """
     Create processors and workers based on the operation type.
@@ -616,6 +975,9 @@ def create_processors_and_workers(
         docsearch: The instance of the DocSearch class.
         embedding_model_endpoint: The endpoint of the embedding model.
         file_processor: The instance of the file processor.
+        embedding_store: The optional store of reusable chunk embeddings.
+        bulk_indexer: The bulk indexer writing to the index.
+        bulk_load_mode: The bulk load settings of the index.
 
     Returns:
         tuple: A tuple containing the following elements:
@@ -624,16 +986,31 @@ def create_processors_and_workers(
             - worker: The worker responsible for performing the operation.
     """
 
-    if operation_type in ["create", "extract_only"]:
-        s3_files_iterator = file_processor.iterate_s3_files(extract_content=True)
-        batch_processor = BatchChunkDocumentProcessor(
-            chunk_size=500, chunk_overlap=30, batch_size=10
+    if operation_type in ["create", "update", "extract_only"]:
+        # the files are downloaded by the fetch stage of the ingestion pipeline
+        s3_files_iterator = file_processor.iterate_s3_files(extract_content=False)
+        if TOKEN_AWARE_CHUNKING:
+            batch_processor = BatchChunkDocumentProcessor(
+                chunk_size=CHUNK_TOKEN_SIZE,
+                chunk_overlap=CHUNK_TOKEN_OVERLAP,
+                batch_size=10,
+                token_aware=True,
+            )
+        else:
+            batch_processor = BatchChunkDocumentProcessor(
+                chunk_size=500, chunk_overlap=30, batch_size=10
+            )
+        worker = OpenSearchIngestionWorker(
+            docsearch,
+            embedding_model_endpoint,
+            embedding_store,
+            bulk_indexer,
+            bulk_load_mode,
         )
-        worker = OpenSearchIngestionWorker(docsearch, embedding_model_endpoint)
-    elif operation_type in ["delete", "update"]:
+    elif operation_type == "delete":
         s3_files_iterator = file_processor.iterate_s3_files(extract_content=False)
         batch_processor = BatchQueryDocumentProcessor(docsearch, batch_size=10)
-        worker = OpenSearchDeleteWorker(docsearch)
+        worker = OpenSearchDeleteWorker(docsearch, bulk_indexer, bulk_load_mode)
     else:
         raise ValueError(
             "Invalid operation type. Valid types: create, delete, update, extract_only"
@@ -672,7 +1049,8 @@ def main():
     file_processor = S3FileProcessor(s3_bucket, s3_prefix, supported_file_types)
 
     if operation_type == "extract_only":
-        embedding_function, docsearch = None, None
+        embedding_function, docsearch, embedding_store = None, None, None
+        bulk_indexer, bulk_load_mode = None, None
     else:
         embedding_function = sm_utils.getCustomEmbeddings(
             embedding_model_endpoint, region, embedding_model_type
@@ -686,33 +1064,57 @@ def main():
             verify_certs=True,
             connection_class=RequestsHttpConnection,
         )
+        embedding_store = EmbeddingStore(
+            embedding_model_endpoint,
+            embedding_model_type,
+            local_path=EMBEDDING_STORE_LOCAL_PATH,
+            s3_uri=EMBEDDING_STORE_S3_URI,
+            s3_client=s3_client,
+        )
+        bulk_indexer = BulkIndexer(
+            docsearch.client,
+            max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+            thread_count=BULK_THREAD_COUNT,
+        )
+        bulk_load_mode = BulkLoadMode(
+            docsearch.client,
+            aos_index_name,
+            enabled=BULK_LOAD_MODE,
+            force_merge_segments=BULK_FORCE_MERGE_SEGMENTS,
+        )
 
     s3_files_iterator, batch_processor, worker = create_processors_and_workers(
-        operation_type, docsearch, embedding_model_endpoint, file_processor
+        operation_type,
+        docsearch,
+        embedding_model_endpoint,
+        file_processor,
+        embedding_store,
+        bulk_indexer,
+        bulk_load_mode,
     )
 
     if operation_type == "create":
-        ingestion_pipeline(s3_files_iterator, batch_processor, worker)
+        ingestion_pipeline(s3_files_iterator, file_processor, batch_processor, worker)
     elif operation_type == "extract_only":
         ingestion_pipeline(
-            s3_files_iterator, batch_processor, worker, extract_only=True
+            s3_files_iterator, file_processor, batch_processor, worker, extract_only=True
         )
     elif operation_type == "delete":
         delete_pipeline(s3_files_iterator, batch_processor, worker)
     elif operation_type == "update":
-        # Delete the documents first
-        delete_pipeline(s3_files_iterator, batch_processor, worker)
-
-        # Then ingest the documents
-        s3_files_iterator, batch_processor, worker = create_processors_and_workers(
-            "create", docsearch, embedding_model_endpoint, file_processor
+        # Skip unchanged files, embed new chunks and delete vanished ones
+        ingestion_pipeline(
+            s3_files_iterator, file_processor, batch_processor, worker, incremental=True
         )
-        ingestion_pipeline(s3_files_iterator, batch_processor, worker)
     else:
         raise ValueError(
             "Invalid operation type. Valid types: create, delete, update, extract_only"
         )
 
+    if operation_type != "extract_only":
+        # Invalidate the documents cached by the online retrievers
+        workspace_manager.touch_workspace(workspace_id)
+
 
 if __name__ == "__main__":
     logger.info("boto3 version: %s", boto3.__version__)
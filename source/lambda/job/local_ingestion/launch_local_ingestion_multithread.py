@@ -18,7 +18,9 @@ from llm_bot_dep import storage_utils
 
 storage_utils.save_content_to_s3 = lambda *args: None
 aos_injection_mp_worker_num = 16
-aos_injection_batch_size = 50
+# documents streamed per bulk_add call, parallel_bulk splits them into size bounded requests
+aos_injection_batch_size = 2000
+aos_injection_bulk_thread_count = 2
 embedding_chunk_num = 50
 os.environ["embedding_chunk_num"] = str(embedding_chunk_num)
 
@@ -100,7 +102,8 @@ def process_run(process_id, task_queue):
         local_ingestion_multithread.bulk_add(
             opensearch_obj,
             batch_data,
-            max_chunk_bytes=1 * 1024 * 1024,
+            max_chunk_bytes=10 * 1024 * 1024,
+            thread_count=aos_injection_bulk_thread_count,
             embedding_size=embedding_size,
         )
 
@@ -143,13 +146,17 @@ def main():
         f"local_ingestion_multithread.aos_injection_mp max worker: {aos_injection_mp_worker_num}"
     )
 
-    local_ingestion_multithread.main(worker_num, 0)
+    try:
+        local_ingestion_multithread.main(worker_num, 0)
 
-    for _ in processes:
-        task_queue.put(None)
+        for _ in processes:
+            task_queue.put(None)
 
-    for p in processes:
-        p.join()
+        for p in processes:
+            p.join()
+    finally:
+        # restore the index settings and refresh once, bulk requests do not refresh
+        local_ingestion_multithread.finish_bulk_load()
 
     print("finished")
 
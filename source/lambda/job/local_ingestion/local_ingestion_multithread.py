@@ -96,7 +96,6 @@ def __bulk_add(
     assert embedding_size is not None, embedding_size
     from langchain_community.vectorstores.opensearch_vector_search import (
         _default_text_mapping,
-        _import_bulk,
         _import_not_found_error,
         _validate_aoss_with_engines,
     )
@@ -110,7 +109,8 @@ def __bulk_add(
     ef_construction = kwargs.get("ef_construction", 512)
     m = kwargs.get("m", 16)
     vector_field = kwargs.get("vector_field", "vector_field")
-    max_chunk_bytes = kwargs.get("max_chunk_bytes", 1 * 1024 * 1024)
+    max_chunk_bytes = kwargs.get("max_chunk_bytes", BULK_MAX_CHUNK_BYTES)
+    thread_count = kwargs.get("thread_count", 2)
 
     _validate_aoss_with_engines(self.is_aoss, engine)
 
@@ -121,7 +121,6 @@ def __bulk_add(
 
     if not mapping:
         mapping = dict()
-    bulk = _import_bulk()
     not_found_error = _import_not_found_error()
     # requests = []
     return_ids = []
@@ -156,14 +155,13 @@ def __bulk_add(
             return_ids.append(_id)
             yield request
 
-    bulk(
+    # no refresh per request, the index is refreshed once by finish_bulk_load
+    bulk_index(
         self.client,
         request_generator(),
         max_chunk_bytes=max_chunk_bytes,
-        # ignore_status=(200,)
+        thread_count=thread_count,
     )
-    if not self.is_aoss:
-        self.client.indices.refresh(index=index_name)
     return return_ids
 
 
@@ -258,11 +256,14 @@ from langchain_community.vectorstores.opensearch_vector_search import (
     OpenSearchVectorSearch,
 )
 from llm_bot_dep.constant import SplittingType
+from llm_bot_dep.bulk_utils import BULK_MAX_CHUNK_BYTES, BulkLoadMode, bulk_index
 from llm_bot_dep.ddb_utils import WorkspaceManager
+from llm_bot_dep.embedding_store import EmbeddingStore, embed_with_store
 from llm_bot_dep.embeddings import get_embedding_info
 from llm_bot_dep.enhance_utils import EnhanceWithBedrock
 from llm_bot_dep.loaders.auto import cb_process_object
-from llm_bot_dep.storage_utils import save_content_to_s3
+from llm_bot_dep.splitter_utils import chunk_documents
+from llm_bot_dep.storage_utils import close_artifact_writers, save_content_to_s3
 from opensearchpy import RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
 from tenacity import retry, stop_after_attempt, wait_exponential
@@ -327,6 +328,14 @@ dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table(etlObjTable)
 workspace_table = dynamodb.Table(workspace_table)
 workspace_manager = WorkspaceManager(workspace_table)
+# chunk embeddings of the local bge-m3 model, reused across runs
+embedding_store = EmbeddingStore(
+    "BAAI/bge-m3",
+    "m3",
+    local_path=os.environ.get("embedding_store_path", "/tmp/embedding_store"),
+    s3_uri=os.environ.get("embedding_store_s3_uri"),
+    s3_client=s3,
+)
 
 ENHANCE_CHUNK_SIZE = 25000
 # Make it 3600s for debugging purpose
@@ -498,6 +507,59 @@ def __aos_injection(texts, dense_vecs_list, metadatas, index_name):
 pendings = set()
 
 
+# bulk load settings of the indices written by this run, restored by finish_bulk_load
+bulk_load_modes = {}
+
+
+def begin_bulk_load(index_name, embedding_size):
+    """Create the index before the first bulk request and disable its refresh and replicas"""
+    if index_name in bulk_load_modes:
+        return
+    from langchain_community.vectorstores.opensearch_vector_search import (
+        _default_text_mapping,
+    )
+
+    client = OpenSearchVectorSearch(
+        index_name=index_name,
+        embedding_function=None,
+        opensearch_url="https://{}".format(aosEndpoint),
+        http_auth=awsauth,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+    ).client
+    with index_create_lock:
+        # checked again under the lock, a second begin() would take the bulk load settings for the original ones
+        if index_name in bulk_load_modes:
+            return
+        if not client.indices.exists(index=index_name):
+            client.indices.create(
+                index=index_name, body=_default_text_mapping(embedding_size)
+            )
+        bulk_load_mode = BulkLoadMode(client, index_name)
+        bulk_load_mode.begin()
+        bulk_load_modes[index_name] = bulk_load_mode
+
+
+def finish_bulk_load():
+    """Restore and refresh the indices once every bulk request is done"""
+    for bulk_load_mode in bulk_load_modes.values():
+        bulk_load_mode.end()
+    bulk_load_modes.clear()
+
+
+def _embed_dense(texts: List[str]) -> List[List[float]]:
+    logger.info(f"embedding documents num: {len(texts)}")
+    embeddings = BGRM3Embedding().embed_documents(texts)
+    colbert_vecs_lens = [len(colbert_vecs) for colbert_vecs in embeddings["colbert_vecs_list"]]
+    avg_lens = sum(colbert_vecs_lens) / len(colbert_vecs_lens)
+
+    logger.info(
+        f"avg_colbert_lens: {avg_lens}, colbert_vecs num: {len(colbert_vecs_lens)}"
+    )
+    return embeddings["dense_vecs_list"]
+
+
 def _aos_injection(
     documents: List[Document],
     index_name,
@@ -539,18 +601,9 @@ def _aos_injection(
         # import multiprocessing
         # logger.info(f'process: {multiprocessing.current_process().ident} enter embedding_execute_context')
         # time.sleep(4)
-        logger.info(f"embedding documents num: {len(texts)}")
-        embeddings = BGRM3Embedding().embed_documents(texts)
-
-    dense_vecs_list = embeddings["dense_vecs_list"]
-    colbert_vecs_list = embeddings["colbert_vecs_list"]
+        dense_vecs_list = embed_with_store(embedding_store, _embed_dense, texts)
 
-    colbert_vecs_lens = [len(colbert_vecs) for colbert_vecs in colbert_vecs_list]
-    avg_lens = sum(colbert_vecs_lens) / len(colbert_vecs_lens)
-
-    logger.info(
-        f"avg_colbert_lens: {avg_lens}, colbert_vecs num: {len(colbert_vecs_lens)}"
-    )
+    begin_bulk_load(index_name, len(dense_vecs_list[0]))
 
     # for doc_id, metadata in enumerate(metadatas):
     #         # lexical_weights = embeddings_vectors[0]["lexical_weights"][
@@ -650,38 +703,10 @@ def _aos_injection(
 def chunk_generator(
     content: List[Document], chunk_size: int = 500, chunk_overlap: int = 30
 ) -> Generator[Document, None, None]:
-    temp_text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap
-    )
-    temp_content = content
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size, chunk_overlap=chunk_overlap
     )
-    updated_heading_hierarchy = {}
-    for temp_document in temp_content:
-        temp_chunk_id = temp_document.metadata["chunk_id"]
-        temp_split_size = len(temp_text_splitter.split_documents([temp_document]))
-        # Add size in heading_hierarchy
-        if "heading_hierarchy" in temp_document.metadata:
-            temp_hierarchy = temp_document.metadata["heading_hierarchy"]
-            temp_hierarchy["size"] = temp_split_size
-            updated_heading_hierarchy[temp_chunk_id] = temp_hierarchy
-
-    for document in content:
-        splits = text_splitter.split_documents([document])
-        # list of Document objects
-        index = 1
-        for split in splits:
-            chunk_id = split.metadata["chunk_id"]
-            logger.debug(chunk_id)
-            split.metadata["chunk_id"] = f"{chunk_id}-{index}"
-            if chunk_id in updated_heading_hierarchy:
-                split.metadata["heading_hierarchy"] = updated_heading_hierarchy[
-                    chunk_id
-                ]
-                logger.debug(split.metadata["heading_hierarchy"])
-            index += 1
-            yield split
+    return chunk_documents(content, text_splitter)
 
 
 def aos_injection(
@@ -840,6 +865,9 @@ def _main(worker_num, batchIndice, max_file_num=math.inf):
             # embeddings,
             aosEndpoint,
         )
+    embedding_store.flush()
+    embedding_store.compact()
+    close_artifact_writers()
 
 
 # Main function to be called by Glue job script
@@ -0,0 +1,113 @@
+"""Benchmark of the chunk generator of the ingestion jobs on a synthetic markdown corpus.
+
+Compares the previous chunk_generator, which split every section twice and
+logged each chunk id at INFO, with the single-pass chunk_documents. Both
+produce the same chunks, which is checked before timing.
+
+    cd source/lambda/job && python test/chunk_benchmark.py [num_docs]
+"""
+import copy
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.extend(["dep", "dep/llm_bot_dep"])
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from llm_bot_dep.splitter_utils import MarkdownHeaderTextSplitter, chunk_documents
+
+logger = logging.getLogger()
+# the Glue job logs to stdout, keep the formatting cost without flooding the terminal
+logging.basicConfig(stream=open(os.devnull, "w"), level=logging.INFO, force=True)
+
+WORDS = "amazon elastic compute cloud provides secure resizable capacity in the aws cloud with instances storage network".split()
+
+
+def make_markdown(num_sections, rng):
+    lines = []
+    for section in range(num_sections):
+        level = rng.choice([1, 2, 2, 3, 3, 3])
+        lines.append(f"{'#' * level} Section {section} {rng.choice(WORDS)}")
+        for _ in range(rng.randint(1, 12)):
+            lines.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120))) + ".")
+    return "\n".join(lines)
+
+
+def previous_chunk_generator(content, chunk_size=500, chunk_overlap=30):
+    temp_text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    updated_heading_hierarchy = {}
+    for temp_document in content:
+        temp_chunk_id = temp_document.metadata["chunk_id"]
+        temp_split_size = len(temp_text_splitter.split_documents([temp_document]))
+        if "heading_hierarchy" in temp_document.metadata:
+            temp_hierarchy = temp_document.metadata["heading_hierarchy"]
+            temp_hierarchy["size"] = temp_split_size
+            updated_heading_hierarchy[temp_chunk_id] = temp_hierarchy
+
+    for document in content:
+        splits = text_splitter.split_documents([document])
+        index = 1
+        for split in splits:
+            chunk_id = split.metadata["chunk_id"]
+            logger.info(chunk_id)
+            split.metadata["chunk_id"] = f"{chunk_id}-{index}"
+            if chunk_id in updated_heading_hierarchy:
+                split.metadata["heading_hierarchy"] = updated_heading_hierarchy[chunk_id]
+                logger.info(split.metadata["heading_hierarchy"])
+            index += 1
+            yield split
+
+
+def new_chunk_generator(content, chunk_size=500, chunk_overlap=30):
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    return chunk_documents(content, text_splitter)
+
+
+def as_tuples(chunks):
+    return [(chunk.page_content, repr(sorted(chunk.metadata.items()))) for chunk in chunks]
+
+
+def run(generator, corpus, repeat=3):
+    best = None
+    for _ in range(repeat):
+        sections_list = copy.deepcopy(corpus)
+        start = time.perf_counter()
+        num_chunks = sum(1 for sections in sections_list for _ in generator(sections))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return num_chunks, best
+
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rng = random.Random(0)
+    splitter = MarkdownHeaderTextSplitter()
+    corpus = []
+    for i in range(num_docs):
+        document = Document(
+            page_content=make_markdown(200, rng),
+            metadata={"file_path": f"s3://bucket/doc-{i}.md", "file_type": "md"},
+        )
+        corpus.append(splitter.split_text(document))
+    num_sections = sum(len(sections) for sections in corpus)
+    corpus_mb = sum(len(s.page_content) for sections in corpus for s in sections) / 1e6
+
+    previous = as_tuples(c for sections in copy.deepcopy(corpus) for c in previous_chunk_generator(sections))
+    new = as_tuples(c for sections in copy.deepcopy(corpus) for c in new_chunk_generator(sections))
+    assert previous == new, "chunks differ"
+
+    print(f"{num_docs} docs, {num_sections} sections, {corpus_mb:.1f} MB of markdown")
+    for name, generator in [("two-pass", previous_chunk_generator), ("single-pass", new_chunk_generator)]:
+        num_chunks, elapsed = run(generator, corpus)
+        print(f"{name:<12} {num_chunks} chunks in {elapsed:.2f}s, {num_chunks / elapsed:,.0f} chunks/s")
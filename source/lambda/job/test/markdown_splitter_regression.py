@@ -0,0 +1,437 @@
+"""Regression test of extract_headings and MarkdownHeaderTextSplitter.split_text.
+
+The single-pass heading builder and the reworked split_text are compared with
+the previous implementations, kept below, on the markdown files of the
+repository and on synthetic documents with tables, figures, repeated and
+skipped headings. Ids are made deterministic by replacing uuid.uuid4, so that
+the outputs compare equal. The time of both versions on a long manual with
+thousands of headings is printed at the end.
+
+    cd source/lambda/job && python test/markdown_splitter_regression.py
+"""
+import glob
+import logging
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+sys.path.extend(["dep", "dep/llm_bot_dep"])
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from langchain.docstore.document import Document
+from llm_bot_dep.constant import FigureNode
+from llm_bot_dep.splitter_utils import (
+    MarkdownHeaderTextSplitter,
+    extract_headings,
+    parse_string_to_xml_node,
+)
+from lxml import etree
+
+logger = logging.getLogger()
+logging.disable(logging.WARNING)
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", ".."))
+WORDS = "amazon elastic compute cloud provides secure resizable capacity in the aws cloud".split()
+
+
+def find_parent(headers: dict, level: int):
+    """Find the parent node of current node
+    Find the last node whose level is less than current node
+
+    Args:
+        headers (dict): headers dict
+        level (int): level of the header, eg. # is level1, ## is level2
+
+    Returns:
+        _type_: parent node id or None
+    """
+    for id, header in reversed(list(headers.items())):
+        if header["level"] < level:
+            return id
+
+    return None
+
+
+def find_previous_with_same_level(headers: dict, level: int):
+    """Find the previous node with same level
+
+    Args:
+        headers (dict): headers dict
+        level (int): level of the header, eg. # is level1, ## is level2
+
+    Returns:
+        _type_: previous node id or None
+    """
+    for id, header in reversed(list(headers.items())):
+        if header["level"] == level:
+            return id
+
+    return None
+
+
+def find_next_with_same_level(headers: dict, header_id: str):
+    level = headers[header_id]["level"]
+    header_found = False
+
+    for id, header in headers.items():
+        if header_id == id:
+            header_found = True
+
+        # Find the next node with the same level
+        if header_found and header["level"] == level and header_id != id:
+            return id
+
+    return None
+
+
+def find_child(headers: dict, header_id: str):
+    children = []
+    level = headers[header_id]["level"]
+
+    for id, header in headers.items():
+        if (
+            header["level"] == level + 1
+            and id not in children
+            and header["parent"] == header_id
+        ):
+            children.append(id)
+
+    return children
+
+
+
+def previous_extract_headings(md_content: str):
+    """Heading hierarchy extraction before the single-pass builder, scanning all headers per header.
+    Args:
+        md_content (str): Markdown content.
+    Returns:
+        Json object contains the heading hierarchy
+    """
+    header_index = 0
+    headers = {}
+    lines = md_content.split("\n")
+    id_index_dict = {}
+    for line in lines:
+        match = re.match(r"\s*(#+)(.*)", line)
+        if match:
+            header_index += 1
+            # print(match.group)
+            level = len(match.group(1))
+            title = match.group(2).strip()
+            id_prefix = str(uuid.uuid4())[:8]
+            _id = f"${header_index}-{id_prefix}"
+            parent = find_parent(headers, level)
+            previous = find_previous_with_same_level(headers, level)
+            headers[_id] = {
+                "title": title,
+                "level": level,
+                "parent": parent,
+                "previous": previous,
+            }
+            # Use list in case multiple heading have the same title
+            if title not in id_index_dict:
+                id_index_dict[title] = [_id]
+            else:
+                id_index_dict[title].append(_id)
+
+    for header_obj in headers:
+        headers[header_obj]["child"] = find_child(headers, header_obj)
+        headers[header_obj]["next"] = find_next_with_same_level(headers, header_obj)
+
+    return headers, id_index_dict
+
+
+
+def previous_split_text(self, text):
+    """MarkdownHeaderTextSplitter.split_text before the rework"""
+    # saving the content to S3 is left out
+    lines = text.page_content.strip().split("\n")
+    chunks = []
+    current_chunk_content = []
+    same_heading_dict = {}
+    table_content = []
+    inside_table = False
+    current_figure = ""
+    inside_figure = False
+    heading_hierarchy, id_index_dict = previous_extract_headings(text.page_content.strip())
+    if len(lines) > 0:
+        current_heading = lines[0]
+
+    # save current heading map
+    current_heading_level_map = {}
+
+    for line in lines:
+        # Replace escaped characters for table markers
+        line = line.strip()
+
+        if re.match(r"^#+\s+", line):  # Assuming these denote headings
+            # Save the current chunk if it exists
+            if current_chunk_content:
+                metadata = text.metadata.copy()
+                metadata["content_type"] = "paragragh"
+                metadata["current_heading"] = current_heading
+                current_heading_list = self._get_current_heading_list(
+                    current_heading, current_heading_level_map
+                )
+                current_heading = current_heading.replace("#", "").strip()
+                # split_words = '*' * 100
+                # logger.info(f"{split_words}")
+                # logger.info(f"current line is {line}")
+                # logger.info(f"current metadata is {text.metadata}")
+                # logger.info(f"current heading list is {current_heading_list}")
+                # logger.info(f"current heading level map is {current_heading_level_map}")
+                # logger.info(f"{split_words}")
+                try:
+                    self._set_chunk_id(
+                        id_index_dict, current_heading, metadata, same_heading_dict
+                    )
+                except KeyError:
+                    logger.info(
+                        f"No standard heading found, check your document with {current_chunk_content}"
+                    )
+                    id_prefix = str(uuid.uuid4())[:8]
+                    metadata["chunk_id"] = f"$0-{id_prefix}"
+                if metadata["chunk_id"] in heading_hierarchy:
+                    metadata["heading_hierarchy"] = heading_hierarchy[
+                        metadata["chunk_id"]
+                    ]
+                page_content = "\n".join(current_chunk_content)
+                if "service" in metadata:
+                    metadata["complete_heading"] = (
+                        metadata["service"] + " " + current_heading_list
+                    )
+                else:
+                    metadata["complete_heading"] = current_heading_list
+                chunks.append(
+                    Document(
+                        page_content=page_content,
+                        metadata=metadata,
+                    )
+                )
+                current_chunk_content = []  # Reset for the next chunk
+            current_heading = line
+
+        if FigureNode.START.value == line:
+            inside_figure = True
+            current_figure += line + "\n"
+        elif FigureNode.END.value == line:
+            current_figure += line
+            inside_figure = False
+            # Parse xml node to get content and metadata
+            xml_node = parse_string_to_xml_node(current_figure)
+            figure_type = xml_node.findtext(FigureNode.TYPE.value)
+            figure_description = xml_node.find(FigureNode.DESCRIPTION.value)
+            figure_value = xml_node.find(FigureNode.VALUE.value)
+            chunk_figure_content = etree.tostring(figure_description).decode("utf-8")
+            if figure_value is not None:
+                chunk_figure_content += "\n" + etree.tostring(figure_value).decode("utf-8")
+            metadata = text.metadata.copy()
+            metadata["content_type"] = figure_type
+            metadata["current_heading"] = current_heading
+            current_heading_list = self._get_current_heading_list(
+                current_heading, current_heading_level_map
+            )
+            current_heading = current_heading.replace("#", "").strip()
+            try:
+                self._set_chunk_id(
+                    id_index_dict, current_heading, metadata, same_heading_dict
+                )
+            except KeyError:
+                logger.info(f"No standard heading found")
+                id_prefix = str(uuid.uuid4())[:8]
+                metadata["chunk_id"] = f"$0-{id_prefix}"
+            if metadata["chunk_id"] in heading_hierarchy:
+                metadata["heading_hierarchy"] = heading_hierarchy[
+                    metadata["chunk_id"]
+                ]
+            if "service" in metadata:
+                metadata["complete_heading"] = (
+                    metadata["service"] + " " + current_heading_list
+                )
+            else:
+                metadata["complete_heading"] = current_heading_list
+            chunks.append(
+                Document(
+                    page_content=chunk_figure_content, metadata=metadata
+                )
+            )
+            current_figure = ""
+        elif inside_figure:
+            current_figure += line
+
+        if (re.fullmatch(r"\|.*\|.*\|", line) is not None) and not inside_figure:
+            inside_table = True
+        elif inside_table:
+            # The first line under a table
+            inside_table = False
+            # Save table content as a separate document
+            if table_content:
+                metadata = text.metadata.copy()
+                metadata["content_type"] = "table"
+                metadata["current_heading"] = current_heading
+                current_heading_list = self._get_current_heading_list(
+                    current_heading, current_heading_level_map
+                )
+                current_heading = current_heading.replace("#", "").strip()
+                try:
+                    self._set_chunk_id(
+                        id_index_dict, current_heading, metadata, same_heading_dict
+                    )
+                except KeyError:
+                    logger.info(f"No standard heading found")
+                    id_prefix = str(uuid.uuid4())[:8]
+                    metadata["chunk_id"] = f"$0-{id_prefix}"
+                if metadata["chunk_id"] in heading_hierarchy:
+                    metadata["heading_hierarchy"] = heading_hierarchy[
+                        metadata["chunk_id"]
+                    ]
+                if "service" in metadata:
+                    metadata["complete_heading"] = (
+                        metadata["service"] + " " + current_heading_list
+                    )
+                else:
+                    metadata["complete_heading"] = current_heading_list
+                chunks.append(
+                    Document(
+                        page_content="\n".join(table_content), metadata=metadata
+                    )
+                )
+                table_content = []  # Reset for the next table
+
+        if inside_table:
+            table_content.append(line)
+        elif not inside_figure and FigureNode.END.value != line:
+            current_chunk_content.append(line)
+
+    # Save the last chunk if it exists
+    if current_chunk_content:
+        metadata = text.metadata.copy()
+        metadata["content_type"] = "paragragh"
+        metadata["current_heading"] = current_heading
+        current_heading_list = self._get_current_heading_list(
+            current_heading, current_heading_level_map
+        )
+        current_heading = current_heading.replace("#", "").strip()
+        try:
+            self._set_chunk_id(
+                id_index_dict, current_heading, metadata, same_heading_dict
+            )
+        except KeyError:
+            logger.info(f"No standard heading found")
+            id_prefix = str(uuid.uuid4())[:8]
+            metadata["chunk_id"] = f"$0-{id_prefix}"
+        if metadata["chunk_id"] in heading_hierarchy:
+            metadata["heading_hierarchy"] = heading_hierarchy[metadata["chunk_id"]]
+        page_content = "\n".join(current_chunk_content)
+        if "service" in metadata:
+            metadata["complete_heading"] = (
+                metadata["service"] + " " + current_heading_list
+            )
+        else:
+            metadata["complete_heading"] = current_heading_list
+        chunks.append(
+            Document(
+                page_content=page_content,
+                metadata=metadata,
+            )
+        )
+
+    return chunks
+
+
+class DeterministicUUID:
+    """Replacement of uuid.uuid4 returning increasing values"""
+
+    def __init__(self):
+        self.counter = 0
+
+    def __call__(self):
+        self.counter += 1
+        return uuid.UUID(int=self.counter)
+
+
+def run_deterministic(function, *args):
+    uuid.uuid4 = DeterministicUUID()
+    try:
+        return function(*args)
+    finally:
+        uuid.uuid4 = original_uuid4
+
+
+def make_markdown(num_headings, rng):
+    lines = []
+    for i in range(num_headings):
+        # repeated titles, skipped levels and headings without space are all part of the mix
+        title = rng.choice([f"Section {i}", "Overview", "Details"])
+        lines.append(f"{'#' * rng.choice([1, 2, 2, 3, 3, 4, 6])}{rng.choice([' ', ' ', ''])}{title}")
+        for _ in range(rng.randint(0, 4)):
+            kind = rng.random()
+            if kind < 0.15:
+                lines.append("| name | value |")
+                lines.append("| --- | --- |")
+                lines.extend(f"| {rng.choice(WORDS)} | {rng.randint(0, 99)} |" for _ in range(rng.randint(1, 4)))
+            elif kind < 0.25:
+                lines.append(FigureNode.START.value)
+                lines.append(f"<type>{rng.choice(['chart', 'image'])}</type>")
+                lines.append(f"<desp>{' '.join(rng.choice(WORDS) for _ in range(8))}</desp>")
+                if rng.random() < 0.5:
+                    lines.append(f"<value>{rng.randint(0, 99)}</value>")
+                lines.append(FigureNode.END.value)
+            else:
+                lines.append("  " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))) + ".")
+    return "\n".join(lines)
+
+
+def as_tuples(documents):
+    return [(document.page_content, document.metadata) for document in documents]
+
+
+def check(name, markdown, metadata):
+    splitter = MarkdownHeaderTextSplitter()
+    assert run_deterministic(previous_extract_headings, markdown) == run_deterministic(
+        extract_headings, markdown
+    ), f"headings of {name} differ"
+    previous = run_deterministic(previous_split_text, splitter, Document(page_content=markdown, metadata=dict(metadata)))
+    new = run_deterministic(splitter.split_text, Document(page_content=markdown, metadata=dict(metadata)))
+    assert as_tuples(previous) == as_tuples(new), f"sections of {name} differ"
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+original_uuid4 = uuid.uuid4
+
+if __name__ == "__main__":
+    files = sorted(
+        path
+        for path in glob.glob(os.path.join(REPO_ROOT, "**", "*.md"), recursive=True)
+        if "node_modules" not in path
+    )
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            check(os.path.relpath(path, REPO_ROOT), f.read(), {"file_path": path, "file_type": "md"})
+    print(f"{len(files)} markdown files of the repository: identical")
+
+    rng = random.Random(0)
+    for i in range(200):
+        metadata = {"file_path": f"s3://bucket/doc-{i}.md", "file_type": "md"}
+        if i % 2:
+            metadata["service"] = "ec2"
+        check(f"synthetic document {i}", make_markdown(rng.randint(1, 60), rng), metadata)
+    print("200 synthetic documents: identical")
+
+    splitter = MarkdownHeaderTextSplitter()
+    for num_headings in [1000, 5000]:
+        markdown = make_markdown(num_headings, rng)
+        document = Document(page_content=markdown, metadata={"file_path": "s3://bucket/manual.md"})
+        print(
+            f"{num_headings} headings: extract_headings {timed(previous_extract_headings, markdown):.2f}s -> "
+            f"{timed(extract_headings, markdown):.3f}s, split_text "
+            f"{timed(previous_split_text, splitter, document):.2f}s -> {timed(splitter.split_text, document):.3f}s"
+        )
@@ -0,0 +1,97 @@
+"""Micro-benchmark of SagemakerEndpointVectorOrCross against a local stub endpoint.
+
+Compares building a sagemaker-runtime client and endpoint wrapper on every call
+(previous behaviour) with the pooled client/wrapper registry, sequentially and
+through an executor fan-out like the one in BGEReranker.
+
+    cd source/lambda/job && python test/sm_utils_benchmark.py
+"""
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append("dep")
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+# keep the embedding cache out of the measurement
+os.environ["embedding_cache_size"] = "0"
+
+
+class StubEndpointHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in one send, separate sends on a keep-alive connection
+    # wait for the delayed ACK of the client and would penalize the pooled client
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        vectors = [[0.1] * 1024 for _ in body["inputs"]]
+        payload = json.dumps({"sentence_embeddings": {"dense_vecs": vectors}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_endpoint():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEndpointHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def legacy_embed(prompt, endpoint_url):
+    import boto3
+    from langchain.embeddings import SagemakerEndpointEmbeddings
+    from llm_bot_dep.sm_utils import m3ContentHandler
+
+    client = boto3.client("sagemaker-runtime", endpoint_url=endpoint_url)
+    embeddings = SagemakerEndpointEmbeddings(
+        client=client,
+        endpoint_name="stub",
+        content_handler=m3ContentHandler(),
+        model_kwargs={"batch_size": 12, "max_length": 512, "return_type": "dense"},
+    )
+    return embeddings.embed_query(prompt)
+
+
+def pooled_embed(prompt, endpoint_url):
+    from llm_bot_dep.sm_utils import SagemakerEndpointVectorOrCross
+
+    return SagemakerEndpointVectorOrCross(
+        prompt=prompt,
+        endpoint_name="stub",
+        region_name=None,
+        model_type="m3",
+        stop=None,
+    )
+
+
+def run(name, func, endpoint_url, calls=200, workers=1):
+    start = time.perf_counter()
+    if workers == 1:
+        for i in range(calls):
+            func(f"query {i}", endpoint_url)
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda i: func(f"query {i}", endpoint_url), range(calls)))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} workers={workers:<3} {calls / elapsed:8.1f} calls/s  {elapsed / calls * 1000:6.2f} ms/call")
+
+
+if __name__ == "__main__":
+    endpoint_url = start_stub_endpoint()
+    os.environ["AWS_ENDPOINT_URL_SAGEMAKER_RUNTIME"] = endpoint_url
+    for workers in [1, 16]:
+        run("legacy", legacy_embed, endpoint_url, workers=workers)
+        run("pooled", pooled_embed, endpoint_url, workers=workers)
@@ -0,0 +1,108 @@
+"""Benchmark of TokenAwareTextSplitter against RecursiveCharacterTextSplitter on zh and en markdown.
+
+Both splitters chunk the sections of MarkdownHeaderTextSplitter through
+chunk_documents like the Glue job. Besides throughput, the token sizes of the
+chunks are reported, the embedding endpoint truncates chunks above 512 tokens.
+
+Without a tokenizer.json of the embedding model (e.g. BAAI/bge-m3), a BPE
+tokenizer is trained on the corpus so that the fast tokenizer path is measured.
+
+    cd source/lambda/job && python test/splitter_benchmark.py [tokenizer.json]
+"""
+import copy
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.extend(["dep", "dep/llm_bot_dep"])
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from llm_bot_dep.splitter_utils import (
+    MarkdownHeaderTextSplitter,
+    TokenAwareTextSplitter,
+    chunk_documents,
+)
+
+EN_WORDS = "amazon elastic compute cloud provides secure resizable capacity in the aws cloud with instances storage network pricing".split()
+ZH_WORDS = "亚马逊 弹性 计算 云 提供 安全 可调整 容量 实例 存储 网络 定价 服务 用户 数据 模型 检索 知识库".split()
+
+
+def make_markdown(language, num_sections, rng):
+    lines = []
+    for section in range(num_sections):
+        lines.append(f"{'#' * rng.choice([1, 2, 3])} Section {section}")
+        for _ in range(rng.randint(1, 12)):
+            if language == "zh":
+                sentences = ["".join(rng.choice(ZH_WORDS) for _ in range(rng.randint(5, 30))) + rng.choice("。！？") for _ in range(rng.randint(1, 6))]
+                lines.append("".join(sentences))
+            else:
+                sentences = [" ".join(rng.choice(EN_WORDS) for _ in range(rng.randint(5, 30))).capitalize() + rng.choice(".!?") for _ in range(rng.randint(1, 6))]
+                lines.append(" ".join(sentences))
+    return "\n".join(lines)
+
+
+def train_tokenizer(texts):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer.decoder = decoders.Metaspace()
+    trainer = trainers.BpeTrainer(vocab_size=400, special_tokens=["<unk>"])
+    tokenizer.train_from_iterator(texts, trainer)
+    return tokenizer
+
+
+def run(make_splitter, corpus, repeat=3):
+    best, chunks = None, None
+    for _ in range(repeat):
+        # a new splitter per run, so that token counts are not served from the cache of the previous run
+        text_splitter = make_splitter()
+        sections_list = copy.deepcopy(corpus)
+        start = time.perf_counter()
+        chunks = [chunk.page_content for sections in sections_list for chunk in chunk_documents(sections, text_splitter)]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return chunks, best
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    splitter = MarkdownHeaderTextSplitter()
+    corpora = {}
+    for language in ["zh", "en"]:
+        corpora[language] = [
+            splitter.split_text(
+                Document(
+                    page_content=make_markdown(language, 200, rng),
+                    metadata={"file_path": f"s3://bucket/{language}-{i}.md", "file_type": "md"},
+                )
+            )
+            for i in range(20)
+        ]
+
+    if len(sys.argv) > 1:
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_file(sys.argv[1])
+    else:
+        tokenizer = train_tokenizer(s.page_content for corpus in corpora.values() for sections in corpus for s in sections)
+
+    for language, corpus in corpora.items():
+        corpus_mb = sum(len(s.page_content.encode("utf-8")) for sections in corpus for s in sections) / 1e6
+        print(f"{language}: {sum(len(sections) for sections in corpus)} sections, {corpus_mb:.1f} MB")
+        splitters = [
+            ("character 500", lambda: RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=30)),
+            ("token 500", lambda: TokenAwareTextSplitter(chunk_size=500, chunk_overlap=50, tokenizer=tokenizer)),
+        ]
+        for name, make_splitter in splitters:
+            chunks, elapsed = run(make_splitter, corpus)
+            tokens = [len(encoding.ids) for encoding in tokenizer.encode_batch(chunks, add_special_tokens=False)]
+            print(
+                f"  {name:<14} {len(chunks) / elapsed:>9,.0f} chunks/s {corpus_mb / elapsed:6.2f} MB/s  "
+                f"{len(chunks):>6} chunks, tokens mean {statistics.mean(tokens):5.0f} max {max(tokens):5d}, "
+                f"{sum(t > 512 for t in tokens) / len(tokens):6.1%} over 512"
+            )
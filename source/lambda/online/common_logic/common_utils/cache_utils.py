@@ -0,0 +1,161 @@
+import copy
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+_MISSING = object()
+
+
+class LRUTTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    Instances are meant to live at module level so that they are shared
+    across warm Lambda invocations.
+
+    :param maxsize: maximum number of entries kept, the least recently used is evicted first
+    :param ttl: seconds an entry stays valid, None or 0 disables expiry
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, expire_at):
+        return expire_at is not None and expire_at < time.monotonic()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or self._expired(entry[1]):
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expire_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return entry is not _MISSING and not self._expired(entry[1])
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class ConfigCache:
+    """Cache of config-plane records read from DynamoDB, such as workspaces,
+    prompt templates and chatbot configs, shared across warm Lambda invocations.
+
+    Records are cached for `ttl` seconds and missing records (loaded as None)
+    for `negative_ttl` seconds. A record read under the scope of a namespace
+    with a registered version stamp is reloaded once the stamp changes. Stamps
+    are read at most every `stamp_ttl` seconds, so that a writer bumping the
+    stamp is seen within `stamp_ttl` however long `ttl` is.
+
+    :param maxsize: maximum number of records, and of stamps, kept
+    :param ttl: seconds a found record stays valid
+    :param negative_ttl: seconds a missing record stays valid
+    :param stamp_ttl: seconds a version stamp stays valid
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, negative_ttl=60, stamp_ttl=10):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.metrics = Counter()
+        self._records = LRUTTLCache(maxsize=maxsize, ttl=ttl)
+        self._stamps = LRUTTLCache(maxsize=maxsize, ttl=stamp_ttl)
+        self._stamp_loaders = {}
+        self._lock = threading.Lock()
+
+    def register_version_stamp(self, namespace, load_stamp):
+        """Read the version stamp of a scope of namespace with load_stamp(scope)"""
+        self._stamp_loaders[namespace] = load_stamp
+
+    def get(self, namespace, key, load, scope=None, cache_missing=True):
+        """Return the record of key in namespace, calling load() to read it on a miss.
+
+        load returns None for a missing record, which is only cached with
+        cache_missing. Records are copied on the way out, callers may edit them.
+        """
+        stamp = self._stamp(namespace, scope)
+        entry = self._records.get((namespace, key))
+        if entry is not None and entry[1] == stamp:
+            self._count("negative_hits" if entry[0] is None else "hits")
+            return copy.deepcopy(entry[0])
+        self._count("misses")
+        value = load()
+        self._count("ddb_reads")
+        if value is not None:
+            self._records.set((namespace, key), (value, stamp), ttl=self.ttl)
+        elif cache_missing:
+            self._records.set((namespace, key), (value, stamp), ttl=self.negative_ttl)
+        else:
+            self._records.pop((namespace, key))
+        return copy.deepcopy(value)
+
+    def invalidate(self, namespace, key):
+        self._records.pop((namespace, key))
+
+    def clear(self):
+        self._records.clear()
+        self._stamps.clear()
+
+    def stats(self):
+        with self._lock:
+            return {**self.metrics, "size": len(self._records)}
+
+    def stats_since(self, stats):
+        """Metrics counted since stats() returned stats"""
+        current = self.stats()
+        return {name: current.get(name, 0) - stats.get(name, 0) for name in self.metrics}
+
+    def _stamp(self, namespace, scope):
+        if scope is None or namespace not in self._stamp_loaders:
+            return None
+        stamp = self._stamps.get((namespace, scope), _MISSING)
+        if stamp is _MISSING:
+            stamp = self._stamp_loaders[namespace](scope)
+            self._count("ddb_reads")
+            self._count("stamp_reads")
+            self._stamps.set((namespace, scope), stamp)
+        return stamp
+
+    def _count(self, name):
+        with self._lock:
+            self.metrics[name] += 1
+
+
+# config-plane records shared by the online lambdas running in this container
+config_cache = ConfigCache(
+    maxsize=int(os.environ.get("config_cache_size", 1024)),
+    ttl=float(os.environ.get("config_cache_ttl", 300)),
+    negative_ttl=float(os.environ.get("config_cache_negative_ttl", 60)),
+    stamp_ttl=float(os.environ.get("config_cache_stamp_ttl", 10)),
+)
@@ -1,6 +1,13 @@
+import copy
+import hashlib
 import json
 import math
-from datetime import datetime
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import List
 
 import boto3
@@ -8,10 +15,127 @@ from botocore.exceptions import ClientError
 from langchain.schema import BaseChatMessageHistory
 from langchain.schema.messages import BaseMessage
 
+from .cache_utils import LRUTTLCache
 from .constant import MessageType
+from .logger_utils import get_logger
+
+logger = get_logger("ddb_utils")
 
 client = boto3.resource("dynamodb")
 
+# latest messages of a session loaded by messages_as_langchain, 0 loads the whole session
+CHAT_HISTORY_WINDOW = int(os.environ.get("chat_history_window", 40))
+# attributes of a message read for messages_as_langchain
+MESSAGE_ATTRIBUTES = [
+    "messageId",
+    "role",
+    "content",
+    "createTimestamp",
+    "entryType",
+    "customMessageId",
+    "additional_kwargs",
+]
+# history windows keyed by (messages table, session id), shared across warm invocations.
+# Only messages newer than the last cached one are read for a cached session.
+chat_history_cache = LRUTTLCache(
+    maxsize=int(os.environ.get("chat_history_cache_size", 128))
+)
+
+# error codes of a transaction, or of the cancellation reasons of its items, worth another attempt
+RETRYABLE_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+    "TransactionInProgressException",
+    "ThrottlingError",
+    "TransactionConflict",
+    "ProvisionedThroughputExceeded",
+}
+
+
+class ChatHistoryWriter:
+    """Write chat history transactions to DynamoDB from a background thread.
+
+    submit() returns at once, so that the answer can be sent to the client
+    while the history is written. Throttled or conflicting transactions are
+    retried with exponential backoff. A Lambda container is frozen once the
+    handler returns, so the handler has to call flush() before returning.
+
+    Args:
+        ddb_client: low level DynamoDB client of the boto3 resource, items use python types
+        max_retries: attempts after the first one
+        base_delay: backoff before the first retry in seconds
+    """
+
+    def __init__(self, ddb_client, max_retries=5, base_delay=0.05):
+        self.ddb_client = ddb_client
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.stats = {"transactions": 0, "retries": 0, "failures": 0}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-history")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, transact_items: list, client_request_token: str = None):
+        """Queue one transaction, items in the format of TransactWriteItems"""
+        future = self._executor.submit(self._write, transact_items, client_request_token)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def flush(self, timeout=None) -> bool:
+        """Wait for the queued transactions, return False if some are still pending after timeout"""
+        with self._lock:
+            pending = list(self._pending)
+        deadline = None if timeout is None else time.time() + timeout
+        for future in pending:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                future.result(timeout=remaining)
+            except Exception:
+                return False
+        return True
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _write(self, transact_items, client_request_token=None):
+        kwargs = {"TransactItems": transact_items}
+        if client_request_token:
+            # retries of the same turn are applied once
+            kwargs["ClientRequestToken"] = client_request_token
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.ddb_client.transact_write_items(**kwargs)
+                self.stats["transactions"] += 1
+                return
+            except ClientError as err:
+                if attempt == self.max_retries or not self._is_retryable(err):
+                    self.stats["failures"] += 1
+                    logger.error(f"Error writing chat history: {err}")
+                    return
+            self.stats["retries"] += 1
+            time.sleep(self.base_delay * 2 ** attempt * (1 + random.random()))
+
+    @staticmethod
+    def _is_retryable(err: ClientError) -> bool:
+        code = err.response.get("Error", {}).get("Code")
+        if code == "TransactionCanceledException":
+            reasons = err.response.get("CancellationReasons", [])
+            return any(reason.get("Code") in RETRYABLE_ERROR_CODES for reason in reasons)
+        return code in RETRYABLE_ERROR_CODES
+
+
+chat_history_writer = ChatHistoryWriter(client.meta.client)
+
+
+def flush_chat_history(timeout=None) -> bool:
+    """Wait until the chat history of the current invocation is written"""
+    return chat_history_writer.flush(timeout)
+
 
 class DynamoDBChatMessageHistory(BaseChatMessageHistory):
     def __init__(
@@ -21,13 +145,16 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
         session_id: str,
         user_id: str,
         client_type: str,
+        history_window: int = CHAT_HISTORY_WINDOW,
     ):
         self.sessions_table = client.Table(sessions_table_name)
         self.messages_table = client.Table(messages_table_name)
         self.session_id = session_id
         self.user_id = user_id
         self.client_type = client_type
+        self.history_window = history_window
         self.MESSAGE_BY_SESSION_ID_INDEX_NAME = "bySessionId"
+        self.MESSAGE_BY_SESSION_ID_AND_TIMESTAMP_INDEX_NAME = "bySessionIdAndTimestamp"
 
     @property
     def session(self):
@@ -40,12 +167,12 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
     @property
     def messages(self):
         """Retrieve the messages from DynamoDB"""
-        response = {}
+        items = []
         try:
-            response = self.messages_table.query(
+            items = self._query_messages(
+                IndexName=self.MESSAGE_BY_SESSION_ID_INDEX_NAME,
                 KeyConditionExpression="sessionId = :session_id",
                 ExpressionAttributeValues={":session_id": self.session_id},
-                IndexName=self.MESSAGE_BY_SESSION_ID_INDEX_NAME,
             )
         except ClientError as error:
             if error.response["Error"]["Code"] == "ResourceNotFoundException":
@@ -53,49 +180,106 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
             else:
                 print(error)
 
-        items = response.get("Items", [])
         items = sorted(items, key=lambda x: x["createTimestamp"])
 
         return items
 
     @property
     def messages_as_langchain(self):
-        response = {}
+        """Retrieve the latest history_window messages of the session, oldest first.
+
+        The messages are read newest first from the bySessionIdAndTimestamp
+        index, so that only the window is read however long the session is.
+        A session already cached by this container only reads the messages
+        newer than its last cached message.
+        """
+        cache_key = (self.messages_table.name, self.session_id)
+        cached = chat_history_cache.get(cache_key)
         try:
-            response = self.messages_table.query(
-                KeyConditionExpression="sessionId = :session_id",
-                ExpressionAttributeValues={":session_id": self.session_id},
-                IndexName=self.MESSAGE_BY_SESSION_ID_INDEX_NAME,
-            )
+            if cached is None:
+                messages = self._query_latest_messages(self.history_window)
+            else:
+                messages = cached + self._query_messages_after(cached[-1]["additional_kwargs"]["create_time"])
         except ClientError as error:
             if error.response["Error"]["Code"] == "ResourceNotFoundException":
                 print("No record found for session id: %s", self.session_id)
-            else:
+                return []
+            if error.response["Error"]["Code"] != "ValidationException":
                 print(error)
-        items = response.get("Items", [])
-        items = sorted(items, key=lambda x: x["createTimestamp"])
-        ret = []
-
-        for item in items:
-            assert item["role"] in [
-                MessageType.AI_MESSAGE_TYPE,
-                MessageType.HUMAN_MESSAGE_TYPE,
-            ]
-            role = item["role"]
-            additional_kwargs = json.loads(item["additional_kwargs"])
-            langchain_message_template = {
-                "role": role,
-                "content": item["content"],
-                "additional_kwargs": {
-                    "message_id": item["messageId"],
-                    "create_time": item["createTimestamp"],
-                    "entry_type": item["entryType"],
-                    "custom_message_id": item["customMessageId"],
-                    **additional_kwargs,
-                },
-            }
-            ret.append(langchain_message_template)
-        return ret
+                return []
+            # tables deployed before the index was added
+            logger.info(f"{self.MESSAGE_BY_SESSION_ID_AND_TIMESTAMP_INDEX_NAME} is not available, reading the whole session")
+            messages = [self._as_langchain(item) for item in self.messages]
+
+        if self.history_window > 0:
+            messages = messages[-self.history_window:]
+        # the window starts with a question
+        while messages and messages[0]["role"] == MessageType.AI_MESSAGE_TYPE:
+            messages = messages[1:]
+        if messages:
+            chat_history_cache.set(cache_key, messages)
+        else:
+            chat_history_cache.pop(cache_key)
+        # chains may edit the messages they are given
+        return copy.deepcopy(messages)
+
+    def _query_messages(self, limit=None, **query_kwargs):
+        """Query the messages table, following LastEvaluatedKey until limit items are read"""
+        items = []
+        while True:
+            if limit is not None:
+                query_kwargs["Limit"] = limit - len(items)
+            response = self.messages_table.query(**query_kwargs)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response or (limit is not None and len(items) >= limit):
+                return items
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def _query_latest_messages(self, window):
+        items = self._query_messages(
+            limit=window if window > 0 else None,
+            IndexName=self.MESSAGE_BY_SESSION_ID_AND_TIMESTAMP_INDEX_NAME,
+            KeyConditionExpression="sessionId = :session_id",
+            ExpressionAttributeValues={":session_id": self.session_id},
+            ExpressionAttributeNames={f"#{name}": name for name in MESSAGE_ATTRIBUTES},
+            ProjectionExpression=", ".join(f"#{name}" for name in MESSAGE_ATTRIBUTES),
+            ScanIndexForward=False,
+        )
+        return [self._as_langchain(item) for item in reversed(items)]
+
+    def _query_messages_after(self, create_timestamp):
+        items = self._query_messages(
+            IndexName=self.MESSAGE_BY_SESSION_ID_AND_TIMESTAMP_INDEX_NAME,
+            KeyConditionExpression="sessionId = :session_id AND createTimestamp > :create_timestamp",
+            ExpressionAttributeValues={
+                ":session_id": self.session_id,
+                ":create_timestamp": create_timestamp,
+            },
+            ExpressionAttributeNames={f"#{name}": name for name in MESSAGE_ATTRIBUTES},
+            ProjectionExpression=", ".join(f"#{name}" for name in MESSAGE_ATTRIBUTES),
+        )
+        return [self._as_langchain(item) for item in items]
+
+    @staticmethod
+    def _as_langchain(item):
+        assert item["role"] in [
+            MessageType.AI_MESSAGE_TYPE,
+            MessageType.HUMAN_MESSAGE_TYPE,
+        ]
+        role = item["role"]
+        additional_kwargs = json.loads(item["additional_kwargs"])
+        langchain_message_template = {
+            "role": role,
+            "content": item["content"],
+            "additional_kwargs": {
+                "message_id": item["messageId"],
+                "create_time": item["createTimestamp"],
+                "entry_type": item["entryType"],
+                "custom_message_id": item["customMessageId"],
+                **additional_kwargs,
+            },
+        }
+        return langchain_message_template
 
     def update_session(self, latest_question=""):
         """Add the session to the record in DynamoDB"""
@@ -203,6 +387,81 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
         )
         self.update_session()
 
+    def add_turn(
+        self,
+        message_id,
+        custom_message_id,
+        entry_type,
+        query,
+        answer,
+        additional_kwargs=None,
+    ) -> None:
+        """Write the user message, the ai message and the session update of a turn in one transaction.
+
+        The transaction is written by the background chat_history_writer, the
+        session is created or updated without reading it first.
+        """
+        additional_kwargs = json.dumps(additional_kwargs or {})
+        now = datetime.utcnow()
+        user_timestamp = now.isoformat() + "Z"
+        # the ai message sorts after the user message on createTimestamp
+        ai_timestamp = (now + timedelta(microseconds=1)).isoformat() + "Z"
+        user_message_id = f"user_{message_id}"
+        messages = [
+            {
+                "messageId": user_message_id,
+                "sessionId": self.session_id,
+                "role": MessageType.HUMAN_MESSAGE_TYPE,
+                "customMessageId": custom_message_id,
+                "inputMessageId": "",
+                "entryType": entry_type,
+                "content": query,
+                "createTimestamp": user_timestamp,
+                "lastModifiedTimestamp": user_timestamp,
+                "additional_kwargs": additional_kwargs,
+            },
+            {
+                "messageId": f"ai_{message_id}",
+                "sessionId": self.session_id,
+                "role": MessageType.AI_MESSAGE_TYPE,
+                "customMessageId": custom_message_id,
+                "inputMessageId": user_message_id,
+                "entryType": entry_type,
+                "content": answer,
+                "createTimestamp": ai_timestamp,
+                "lastModifiedTimestamp": ai_timestamp,
+                "additional_kwargs": additional_kwargs,
+            },
+        ]
+        # an empty question keeps the latest one, as update_session does
+        latest_question = "latestQuestion = :q" if query else "latestQuestion = if_not_exists(latestQuestion, :q)"
+        session_update = {
+            "Update": {
+                "TableName": self.sessions_table.name,
+                "Key": {"sessionId": self.session_id, "userId": self.user_id},
+                "UpdateExpression": (
+                    "SET lastModifiedTimestamp = :t, "
+                    "startTime = if_not_exists(startTime, :t), "
+                    "createTimestamp = if_not_exists(createTimestamp, :t), "
+                    "clientType = if_not_exists(clientType, :c), "
+                    f"{latest_question}"
+                ),
+                "ExpressionAttributeValues": {
+                    ":t": ai_timestamp,
+                    ":c": self.client_type,
+                    ":q": query,
+                },
+            }
+        }
+        transact_items = [
+            {"Put": {"TableName": self.messages_table.name, "Item": item}}
+            for item in messages
+        ] + [session_update]
+        chat_history_writer.submit(
+            transact_items,
+            client_request_token=hashlib.md5(user_message_id.encode("utf-8")).hexdigest(),
+        )
+
     def clear(self) -> None:
         """Clear session memory from DynamoDB"""
         try:
@@ -3,6 +3,7 @@ import os
 
 from langchain.pydantic_v1 import BaseModel,Field
 from collections import defaultdict
+from common_logic.common_utils.cache_utils import config_cache
 from common_logic.common_utils.constant import LLMModelType,LLMTaskType
 import copy
 
@@ -10,6 +11,21 @@ ddb_prompt_table_name = os.environ.get("prompt_table_name", "")
 dynamodb_resource = boto3.resource("dynamodb")
 ddb_prompt_table = dynamodb_resource.Table(ddb_prompt_table_name)
 
+# sort key of the item holding the version stamp of the prompts of a user,
+# prompt_management changes the stamp whenever a prompt of the user is written
+PROMPT_VERSION_SORT_KEY = "__version__"
+PROMPT_CACHE_NAMESPACE = "prompt"
+
+
+def get_prompt_version(user_id):
+    response = ddb_prompt_table.get_item(
+        Key={"userId": user_id, "sortKey": PROMPT_VERSION_SORT_KEY}
+    )
+    return response.get("Item", {}).get("version")
+
+
+config_cache.register_version_stamp(PROMPT_CACHE_NAMESPACE, get_prompt_version)
+
 
 
 # export models to front
@@ -70,13 +86,21 @@ class PromptTemplateManager:
 
     
     def get_prompt_templates_from_ddb(self,user_id,model_id:str,task_type:str):
-        response = ddb_prompt_table.get_item(
-            Key={"userId": user_id, "sortKey": f"{model_id}__{task_type}"}
+        sort_key = f"{model_id}__{task_type}"
+
+        def load():
+            response = ddb_prompt_table.get_item(
+                Key={"userId": user_id, "sortKey": sort_key}
+            )
+            item = response.get("Item")
+            if item:
+                return item.get("prompt")
+            return None
+
+        prompt = config_cache.get(
+            PROMPT_CACHE_NAMESPACE, (user_id, sort_key), load, scope=user_id
         )
-        item = response.get("Item")
-        if item:
-            return item.get("prompt")
-        return {}
+        return prompt if prompt is not None else {}
 
     def get_all_templates(self,allow_model_ids=EXPORT_MODEL_IDS):
         assert isinstance(allow_model_ids,list),allow_model_ids
@@ -1,4 +1,9 @@
+import bisect
 import json
+import os
+import queue
+import threading
+import time
 
 import boto3
 from common_logic.common_utils.logger_utils import get_logger
@@ -39,3 +44,167 @@ def send_to_ws_client(message: dict, ws_connection_id):
         ConnectionId=ws_connection_id,
         Data=json.dumps(message).encode("utf-8"),
     )
+
+
+class LatencyHistogram:
+    """Latency histogram with fixed millisecond buckets, cheap enough to record per chunk."""
+
+    bucket_bounds_ms = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bucket_bounds_ms) + 1)
+        self.total = 0
+        self.max_ms = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.bucket_bounds_ms, ms)] += 1
+        self.total += 1
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile"""
+        if not self.total:
+            return 0.0
+        rank = q / 100 * self.total
+        seen = 0
+        for bound, count in zip(self.bucket_bounds_ms + [self.max_ms], self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max_ms), 1)
+        return round(self.max_ms, 1)
+
+    def summary(self):
+        buckets = {
+            f"<={bound}ms": count for bound, count in zip(self.bucket_bounds_ms, self.counts) if count
+        }
+        if self.counts[-1]:
+            buckets[f">{self.bucket_bounds_ms[-1]}ms"] = self.counts[-1]
+        return {
+            "count": self.total,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": buckets,
+        }
+
+
+# accumulated over the invocations served by a warm container
+first_token_latency_histogram = LatencyHistogram()
+
+
+class BufferedWebsocketSender:
+    """Send streamed chunks to a websocket client from a background thread.
+
+    Chunks pushed while a post_to_connection round trip is in flight are
+    coalesced into one CHUNK message, up to max_chars characters or until
+    window_ms after the first buffered chunk, so generation never waits on
+    API Gateway.
+
+    Args:
+        ws_connection_id: websocket connection id
+        message_template: fields shared by every CHUNK message, e.g. message_id
+        request_timestamp: start of the request, used for first-token latency
+        max_chars: flush once this many characters are buffered
+        window_ms: flush at most this long after the first buffered chunk
+    """
+
+    _stop = object()
+
+    def __init__(self, ws_connection_id, message_template: dict, request_timestamp=None,
+                 max_chars=None, window_ms=None):
+        self.ws_connection_id = ws_connection_id
+        self.message_template = message_template
+        self.request_timestamp = request_timestamp
+        self.max_chars = max_chars if max_chars is not None else int(os.environ.get("ws_coalesce_max_chars", 512))
+        self.window_ms = window_ms if window_ms is not None else int(os.environ.get("ws_coalesce_window_ms", 50))
+        self.inter_chunk_latency_histogram = LatencyHistogram()
+        self.send_latency_histogram = LatencyHistogram()
+        self.chunk_num = 0
+        self.message_num = 0
+        self.error = None
+        self._last_push_time = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def push(self, chunk: str):
+        """Queue a chunk, re-raise a failure of the background sender to stop generation"""
+        if self.error is not None:
+            raise self.error
+        now = time.time()
+        if self._last_push_time is None:
+            if self.request_timestamp is not None:
+                first_token_latency_histogram.record(now - self.request_timestamp)
+        else:
+            self.inter_chunk_latency_histogram.record(now - self._last_push_time)
+        self._last_push_time = now
+        self.chunk_num += 1
+        self._queue.put(chunk)
+
+    def close(self, raise_error=True):
+        """Flush the remaining chunks and wait for the sender thread.
+        A failure of the background sender is re-raised unless raise_error is False,
+        e.g. while generation is already failing with its own exception.
+        """
+        self._queue.put(self._stop)
+        self._thread.join()
+        logger.info(f"websocket stream stats: {json.dumps(self.stats())}")
+        if self.error is not None:
+            if not raise_error:
+                logger.warning(f"websocket sender failed: {self.error}")
+                return
+            raise self.error
+
+    def stats(self):
+        return {
+            "chunk_num": self.chunk_num,
+            "message_num": self.message_num,
+            "first_token_latency": first_token_latency_histogram.summary(),
+            "inter_chunk_latency": self.inter_chunk_latency_histogram.summary(),
+            "send_latency": self.send_latency_histogram.summary(),
+        }
+
+    def _collect(self, first_chunk):
+        """Coalesce queued chunks after first_chunk, return (content, stop)"""
+        parts = [first_chunk]
+        size = len(first_chunk)
+        # the first message goes out without waiting, only what is already queued is merged
+        window_ms = self.window_ms if self.message_num else 0
+        deadline = time.time() + window_ms / 1000
+        while size < self.max_chars:
+            try:
+                chunk = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if chunk is self._stop:
+                return "".join(parts), True
+            parts.append(chunk)
+            size += len(chunk)
+        return "".join(parts), False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            chunk = self._queue.get()
+            if chunk is self._stop:
+                break
+            content, stop = self._collect(chunk)
+            if self.error is not None:
+                # drain so that close() is not blocked, generation stops on the next push
+                continue
+            send_start = time.time()
+            try:
+                send_to_ws_client(
+                    message={
+                        **self.message_template,
+                        "message": {"role": "assistant", "content": content},
+                        "chunk_id": self.message_num,
+                    },
+                    ws_connection_id=self.ws_connection_id,
+                )
+            except Exception as e:
+                self.error = e
+                continue
+            self.send_latency_histogram.record(time.time() - send_start)
+            self.message_num += 1
@@ -2,21 +2,40 @@ import logging
 from datetime import datetime
 from typing import List
 
+from common_logic.common_utils.cache_utils import config_cache
+
 
 WORKSPACE_OBJECT_TYPE = "workspace"
+WORKSPACE_CACHE_NAMESPACE = "workspace"
 
 
 class WorkspaceManager:
     def __init__(self, workspace_table):
         self.workspace_table = workspace_table
+        # updated_at is the version stamp of a workspace, ingestion jobs bump it
+        # and retrievers key their caches of the index content with it
+        self.cache_namespace = f"{WORKSPACE_CACHE_NAMESPACE}#{workspace_table.name}"
+        config_cache.register_version_stamp(self.cache_namespace, self.get_workspace_version)
 
     def get_workspace(self, workspace_id: str):
-        response = self.workspace_table.get_item(
-            Key={"workspace_id": workspace_id, "object_type": WORKSPACE_OBJECT_TYPE}
+        def load():
+            response = self.workspace_table.get_item(
+                Key={"workspace_id": workspace_id, "object_type": WORKSPACE_OBJECT_TYPE}
+            )
+            return response.get("Item")
+
+        # a missing workspace is not cached, it may be created any time
+        return config_cache.get(
+            self.cache_namespace, workspace_id, load, scope=workspace_id, cache_missing=False
         )
-        item = response.get("Item")
 
-        return item
+    def get_workspace_version(self, workspace_id: str):
+        response = self.workspace_table.get_item(
+            Key={"workspace_id": workspace_id, "object_type": WORKSPACE_OBJECT_TYPE},
+            ProjectionExpression="#updated_at",
+            ExpressionAttributeNames={"#updated_at": "updated_at"},
+        )
+        return response.get("Item", {}).get("updated_at")
 
     def get_workspace_id(self, workspace_name: str, embeddings_model_name: str):
         response = self.workspace_table.scan(
@@ -93,7 +112,10 @@ class WorkspaceManager:
     ):
         timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
+        # read the current record, and let later reads see this write
+        config_cache.invalidate(self.cache_namespace, workspace_id)
         item = self.get_workspace(workspace_id)
+        config_cache.invalidate(self.cache_namespace, workspace_id)
         # If the item not exist, create the item
         if not item:
             open_search_index_name = self.create_workspace_open_search(
@@ -7,7 +7,7 @@ import logging
 import boto3
 import sys
 
-from functions.lambda_retriever.utils.aos_retrievers import QueryDocumentKNNRetriever, QueryDocumentBM25Retriever, QueryQuestionRetriever
+from functions.lambda_retriever.utils.aos_retrievers import QueryDocumentKNNRetriever, QueryDocumentBM25Retriever, QueryDocumentHybridRetriever, QueryQuestionRetriever
 from functions.lambda_retriever.utils.reranker import BGEReranker, MergeReranker
 from functions.lambda_retriever.utils.context_utils import retriever_results_format
 from functions.lambda_retriever.utils.websearch_retrievers import GoogleRetriever
@@ -81,6 +81,24 @@ def get_custom_qd_retrievers(workspace_ids, qd_config):
     ]
     return retriever_list
 
+def get_custom_qd_hybrid_retrievers(workspace_ids, qd_config):
+    default_qd_config = {
+        "using_whole_doc": False,
+        "context_num": 1,
+        "top_k": 10,
+        "fusion": "rrf",
+        "query_key": "query"
+    }
+    qd_config = {**default_qd_config, **qd_config}
+    workspace_list = get_workspace_list(workspace_ids)
+    retriever_list = [
+        QueryDocumentHybridRetriever(
+            workspace_list=workspace_list,
+            **qd_config
+        )
+    ]
+    return retriever_list
+
 def get_custom_qq_retrievers(workspace_ids, qq_config):
     default_qq_config = {
         "top_k": 10,
@@ -131,6 +149,7 @@ def get_workspace_list(workspace_ids):
 retriever_dict = {
     "qq": get_custom_qq_retrievers,
     "qd": get_custom_qd_retrievers,
+    "qd_hybrid": get_custom_qd_hybrid_retrievers,
     "websearch": get_websearch_retrievers,
     "bedrock_kb": get_bedrock_kb_retrievers,
 }
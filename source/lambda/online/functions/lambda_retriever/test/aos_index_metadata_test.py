@@ -0,0 +1,240 @@
+"""Tests of the index metadata cache of LLMBotOpenSearchClient against a local fake OpenSearch.
+
+The fake serves indices.get, search and _msearch over HTTP and counts requests, so that
+the round trips of the real client are checked: one indices.get per index and
+warm container, then one request per search. Missing indices are looked up
+again after MISSING_INDEX_TTL, deleted or recreated indices are seen on the
+next search.
+
+    cd source/lambda/online && python functions/lambda_retriever/test/aos_index_metadata_test.py
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.extend(["."])
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from opensearchpy import OpenSearch
+from opensearchpy.exceptions import TransportError
+
+from functions.lambda_retriever.utils import aos_utils
+from functions.lambda_retriever.utils.aos_utils import LLMBotOpenSearchClient
+
+
+class FakeOpenSearch:
+    """Indices with a mapping and documents, answering every search with all the documents"""
+
+    def __init__(self):
+        self.indices = {}
+        self.aliases = {}
+        # indices whose searches are rejected as under a full search queue
+        self.throttled = set()
+        self.requests = collections.Counter()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                data = self.rfile.read(length)
+                path = self.path.split("?")[0]
+                if path.endswith("/_msearch"):
+                    status, payload = server.handle_msearch([json.loads(line) for line in data.splitlines() if line])
+                else:
+                    status, payload = server.handle(self.command, path, json.loads(data or b"{}"))
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def create_index(self, name, dimension, documents=()):
+        self.indices[name] = {
+            "mappings": {
+                "properties": {
+                    "text": {"type": "text"},
+                    "vector_field": {"type": "knn_vector", "dimension": dimension},
+                    "metadata": {"properties": {"additional_vecs": {"type": "knn_vector", "dimension": 8}}},
+                }
+            },
+            "documents": list(documents),
+        }
+
+    def handle(self, method, path, body):
+        parts = path.strip("/").split("/")
+        name = self.aliases.get(parts[0], parts[0])
+        if name not in self.indices:
+            self.requests["not_found"] += 1
+            return 404, {"error": {"type": "index_not_found_exception", "index": parts[0]}, "status": 404}
+        if parts[1:] == ["_search"]:
+            self.requests["search"] += 1
+            vector = body["query"].get("knn", {}).get("vector_field", {}).get("vector")
+            dimension = self.indices[name]["mappings"]["properties"]["vector_field"]["dimension"]
+            if vector is not None and len(vector) != dimension:
+                return 400, {"error": {"type": "illegal_argument_exception"}, "status": 400}
+            hits = [{"_source": document, "_score": 1.0} for document in self.indices[name]["documents"]]
+            return 200, {"hits": {"hits": hits}}
+        self.requests["indices.get"] += 1
+        return 200, {name: {"aliases": {}, "mappings": self.indices[name]["mappings"], "settings": {}}}
+
+    def handle_msearch(self, lines):
+        self.requests["msearch"] += 1
+        responses = []
+        for header, query in zip(lines[::2], lines[1::2]):
+            name = self.aliases.get(header["index"], header["index"])
+            if name not in self.indices:
+                responses.append({"error": {"type": "index_not_found_exception"}, "status": 404})
+            elif name in self.throttled:
+                responses.append({"error": {"type": "es_rejected_execution_exception"}, "status": 429})
+            else:
+                hits = [{"_source": document, "_score": 1.0} for document in self.indices[name]["documents"]]
+                responses.append({"hits": {"hits": hits}, "status": 200})
+        return 200, {"responses": responses}
+
+    def total(self):
+        return sum(self.requests.values())
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+fake = FakeOpenSearch()
+aos_client = LLMBotOpenSearchClient("fake-domain")
+aos_client.client = OpenSearch(hosts=[{"host": "127.0.0.1", "port": fake.port}])
+
+
+def test_steady_state_is_one_request_per_search():
+    fake.create_index("docs", 4, [{"text": "hello", "metadata": {"source": "a"}}])
+    fake.requests.clear()
+    for _ in range(10):
+        response = aos_client.search("docs", "basic", "hello", field="text")
+        assert response["hits"]["hits"][0]["_source"]["text"] == "hello"
+        aos_client.search("docs", "knn", [0.1] * 4, field="vector_field")
+    assert fake.requests == {"indices.get": 1, "search": 20}, fake.requests
+    metadata = aos_client.get_index_metadata("docs")
+    assert metadata["vector_dimensions"] == {"vector_field": 4, "metadata.additional_vecs": 8}
+
+
+def test_missing_index_is_looked_up_again_after_ttl():
+    fake.requests.clear()
+    assert aos_client.search("later", "basic", "hello") == []
+    assert aos_client.search("later", "basic", "hello") == []
+    assert fake.total() == 1, fake.requests
+
+    fake.create_index("later", 4, [{"text": "created"}])
+    aos_client.index_metadata.pop("later")  # as if MISSING_INDEX_TTL had passed
+    assert aos_client.search("later", "basic", "hello")["hits"]["hits"][0]["_source"]["text"] == "created"
+    assert aos_client.index_metadata.get("later")["exists"]
+
+    original_ttl = aos_utils.MISSING_INDEX_TTL
+    aos_utils.MISSING_INDEX_TTL = 0.001
+    try:
+        aos_client.search("expiring", "basic", "hello")
+        fake.requests.clear()
+        time.sleep(0.01)
+        aos_client.search("expiring", "basic", "hello")
+        assert fake.requests == {"not_found": 1}, fake.requests
+    finally:
+        aos_utils.MISSING_INDEX_TTL = original_ttl
+
+
+def test_deleted_and_recreated_indices():
+    fake.create_index("short_lived", 4)
+    aos_client.search("short_lived", "basic", "hello")
+    del fake.indices["short_lived"]
+    fake.requests.clear()
+    # the search fails, the cached metadata is dropped
+    assert aos_client.search("short_lived", "basic", "hello") == []
+    assert not aos_client.get_index_metadata("short_lived")["exists"]
+    assert fake.requests == {"not_found": 2}, fake.requests
+
+    # recreated with another embedding model, the query vector does not fit the cached dimension
+    fake.create_index("recreated", 4, [{"text": "v1"}])
+    aos_client.search("recreated", "knn", [0.1] * 4, field="vector_field")
+    fake.create_index("recreated", 8, [{"text": "v2"}])
+    fake.requests.clear()
+    response = aos_client.search("recreated", "knn", [0.1] * 8, field="vector_field")
+    assert response["hits"]["hits"][0]["_source"]["text"] == "v2"
+    assert fake.requests == {"indices.get": 1, "search": 1}, fake.requests
+
+    fake.requests.clear()
+    try:
+        aos_client.search("recreated", "knn", [0.1] * 3, field="vector_field")
+    except ValueError as e:
+        assert "dimension 8" in str(e), e
+    else:
+        raise AssertionError("a query vector of the wrong dimension must fail")
+    assert fake.requests == {"indices.get": 1}, fake.requests
+
+
+def test_alias():
+    fake.create_index("docs_v2", 4, [{"text": "aliased"}])
+    fake.aliases["docs_alias"] = "docs_v2"
+    assert aos_client.get_index_metadata("docs_alias")["index"] == "docs_v2"
+    assert aos_client.search("docs_alias", "basic", "x")["hits"]["hits"][0]["_source"]["text"] == "aliased"
+
+
+def test_msearch_errors():
+    fake.create_index("msearch_docs", 4, [{"text": "found"}])
+    fake.create_index("msearch_throttled", 4, [{"text": "throttled"}])
+    searches = [
+        {"index_name": "msearch_docs", "query_type": "basic", "query_term": "x"},
+        {"index_name": "msearch_missing", "query_type": "basic", "query_term": "x"},
+    ]
+    found, missing = aos_client.msearch(searches)
+    assert found["hits"]["hits"][0]["_source"]["text"] == "found"
+    assert missing == []
+
+    fake.throttled.add("msearch_throttled")
+    try:
+        aos_client.msearch(searches + [{"index_name": "msearch_throttled", "query_type": "basic", "query_term": "x"}])
+    except TransportError as e:
+        assert e.status_code == 429 and e.error == "es_rejected_execution_exception", e
+    else:
+        raise AssertionError("a rejected search must not look like a search without hits")
+
+
+if __name__ == "__main__":
+    test_steady_state_is_one_request_per_search()
+    test_missing_index_is_looked_up_again_after_ttl()
+    test_deleted_and_recreated_indices()
+    test_alias()
+    test_msearch_errors()
+    print("tests passed")
+
+    num_searches = 100
+    fake.requests.clear()
+    for i in range(num_searches):
+        aos_client.search("docs", "basic", f"query {i}")
+    print(
+        f"{num_searches} searches on a cached index: {fake.total() / num_searches:.2f} requests per search "
+        f"(2 with indices.get before every search)"
+    )
+    fake.stop()
@@ -0,0 +1,84 @@
+"""Micro-benchmark of BGEM3Reranker colbert scoring.
+
+Compares the previous per-document scoring (one list -> array conversion and
+one einsum per candidate, dispatched through executor tasks) with the packed
+float16 array scored by a single batched einsum.
+
+    cd source/lambda/online && python functions/lambda_retriever/test/colbert_benchmark.py
+"""
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+sys.path.extend([".", "../job/dep/llm_bot_dep"])
+
+from functions.lambda_retriever.utils.reranker import colbert_scores_np, pack_colbert_vecs
+
+DIM = 1024
+QUERY_TOKENS = 32
+DOC_TOKENS = 256
+
+
+def legacy_colbert_score_np(q_reps, p_reps):
+    token_scores = np.einsum('nik,njk->nij', q_reps, p_reps)
+    scores = token_scores.max(-1)
+    return np.sum(scores) / q_reps.shape[0]
+
+
+async def legacy_scores(query_colbert, doc_colbert_list):
+    loop = asyncio.get_event_loop()
+    task_list = [
+        loop.run_in_executor(None, legacy_colbert_score_np, np.asarray([query_colbert]), np.asarray([doc]))
+        for doc in doc_colbert_list
+    ]
+    return await asyncio.gather(*task_list)
+
+
+def vectorised_scores(query_colbert, doc_colbert_list):
+    packed, mask = pack_colbert_vecs(doc_colbert_list)
+    return colbert_scores_np(query_colbert, packed, mask)
+
+
+def make_vecs(rng, num_tokens):
+    vecs = rng.standard_normal((num_tokens, DIM)).astype(np.float32)
+    return (vecs / np.linalg.norm(vecs, axis=-1, keepdims=True)).tolist()
+
+
+def run(num_docs, repeat=5):
+    rng = np.random.default_rng(0)
+    # colbert vectors arrive from opensearch as nested lists of varying length
+    query_colbert = make_vecs(rng, QUERY_TOKENS)
+    doc_colbert_list = [make_vecs(rng, int(rng.integers(DOC_TOKENS // 2, DOC_TOKENS + 1))) for _ in range(num_docs)]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        legacy = asyncio.run(legacy_scores(query_colbert, doc_colbert_list))
+    legacy_ms = (time.perf_counter() - start) / repeat * 1000
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        vectorised = vectorised_scores(query_colbert, doc_colbert_list)
+    vectorised_ms = (time.perf_counter() - start) / repeat * 1000
+
+    # legacy divided by the batch size of 1, vectorised averages over query tokens
+    assert np.allclose(np.asarray(legacy) / QUERY_TOKENS, vectorised, atol=1e-2)
+    print(f"docs={num_docs:<4} legacy {legacy_ms:8.1f} ms  vectorised {vectorised_ms:8.1f} ms  speedup {legacy_ms / vectorised_ms:5.1f}x")
+
+
+def test_candidates_without_tokens():
+    rng = np.random.default_rng(1)
+    query_colbert = make_vecs(rng, QUERY_TOKENS)
+    doc = make_vecs(rng, 8)
+    scores = vectorised_scores(query_colbert, [[], doc, []])
+    assert scores[0] == scores[2] == 0.0
+    assert np.isclose(scores[1], vectorised_scores(query_colbert, [doc])[0])
+    assert vectorised_scores(query_colbert, [[], []]).tolist() == [0.0, 0.0]
+
+
+if __name__ == "__main__":
+    test_candidates_without_tokens()
+    print("tests passed")
+    for num_docs in [10, 50, 200]:
+        run(num_docs)
@@ -1,13 +1,13 @@
 import os
 import logging
 import traceback 
-import asyncio
 from typing import Any, Dict, List 
 
 from langchain.schema.retriever import BaseRetriever
 from langchain.callbacks.manager import CallbackManagerForRetrieverRun
 from langchain.docstore.document import Document
 
+from common_logic.common_utils.cache_utils import LRUTTLCache
 from common_logic.common_utils.time_utils import timeit
 from .aos_utils import LLMBotOpenSearchClient
 from sm_utils import SagemakerEndpointVectorOrCross
@@ -21,6 +21,12 @@ en_embedding_model_endpoint = os.environ.get("en_embedding_endpoint", "")
 aos_endpoint = os.environ.get("aos_endpoint", "")
 
 aos_client = LLMBotOpenSearchClient(aos_endpoint)
+# reconstructed whole documents keyed by (index, file_path, index generation),
+# shared across warm invocations
+whole_doc_cache = LRUTTLCache(
+    maxsize=int(os.environ.get("whole_doc_cache_size", 256)),
+    ttl=int(os.environ.get("whole_doc_cache_ttl", 300))
+)
 
 def remove_redundancy_debug_info(results):
     # filtered_results = copy.deepcopy(results)
@@ -156,178 +162,184 @@ def get_doc(file_path, index_name):
     chunk_text_list = [x[4] for x in sorted_chunk_list]
     return "\n".join(chunk_text_list)
 
-def get_child_context(chunk_id, index_name, window_size):
-    next_content_list = []
-    previous_content_list = []
-    previous_pos = 0
-    next_pos = 0
-    chunk_id_prefix = "-".join(chunk_id.split("-")[:-1])
-    section_id = int(chunk_id.split("-")[-1])
-    previous_section_id = section_id
-    next_section_id = section_id
-    while previous_pos < window_size:
-        previous_section_id -= 1
-        if previous_section_id < 1:
-            break
-        previous_chunk_id = f"{chunk_id_prefix}-{previous_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=previous_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            previous_content_list.insert(0, r["_source"]["text"])
-            previous_pos += 1
-        else:
-            break
-    while next_pos < window_size:
-        next_section_id += 1
-        next_chunk_id = f"{chunk_id_prefix}-{next_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=next_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            next_content_list.insert(0, r["_source"]["text"])
-            next_pos += 1
-        else:
-            break
-    return [previous_content_list, next_content_list]
-
-def get_sibling_context(chunk_id, index_name, window_size):
-    next_content_list = []
-    previous_content_list = []
-    previous_pos = 0
-    next_pos = 0
-    chunk_id_prefix = "-".join(chunk_id.split("-")[:-1])
-    section_id = int(chunk_id.split("-")[-1])
-    previous_section_id = section_id
-    next_section_id = section_id
-    while previous_pos < window_size:
-        previous_section_id -= 1
-        if previous_section_id < 1:
-            break
-        previous_chunk_id = f"{chunk_id_prefix}-{previous_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=previous_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            previous_content_list.insert(0, r["_source"]["text"])
-            previous_pos += 1
-        else:
-            break
-    while next_pos < window_size:
-        next_section_id += 1
-        next_chunk_id = f"{chunk_id_prefix}-{next_section_id}"
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=next_chunk_id,
-            field="metadata.chunk_id",
-            size=1,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            next_content_list.insert(0, r["_source"]["text"])
-            next_pos += 1
-        else:
-            break
-    return [previous_content_list, next_content_list]
-
-def get_context(aos_hit, index_name, window_size):
-    previous_content_list = []
-    next_content_list = []
-    if "chunk_id" not in aos_hit['_source']["metadata"]:
-        return previous_content_list, next_content_list
-    chunk_id = aos_hit["_source"]["metadata"]["chunk_id"]
-    inner_previous_content_list, inner_next_content_list = get_sibling_context(chunk_id, index_name, window_size)
-    if len(inner_previous_content_list) == window_size and len(inner_next_content_list) == window_size:
-        return inner_previous_content_list, inner_next_content_list
-
-    if "heading_hierarchy" not in aos_hit['_source']["metadata"]:
-        return [previous_content_list, next_content_list]
-    if "previous" in aos_hit['_source']["metadata"]["heading_hierarchy"]:
-        previous_chunk_id = aos_hit['_source']["metadata"]["heading_hierarchy"]["previous"]
-        previous_pos = 0
-        while previous_chunk_id and previous_chunk_id.startswith("$") and previous_pos < window_size:
-            opensearch_query_response = aos_client.search(
-                index_name=index_name,
-                query_type="basic",
-                query_term=previous_chunk_id,
-                field="metadata.chunk_id",
-                size=1,
-            )
-            if len(opensearch_query_response["hits"]["hits"]) > 0:
-                r = opensearch_query_response["hits"]["hits"][0]
-                previous_chunk_id = r["_source"]["metadata"]["heading_hierarchy"]["previous"]
-                previous_content_list.insert(0, r["_source"]["text"])
-                previous_pos += 1
-            else:
+def get_whole_docs(file_path_list, index_name, index_generation=None):
+    """Reconstruct whole documents, once per distinct file path.
+    Documents are served from whole_doc_cache when possible. The index generation
+    is part of the key so that documents rewritten by an ingestion job are not reused.
+
+    :param file_path_list: file paths of the hits, may contain duplicates
+    :param index_name: Target Index Name
+    :param index_generation: stamp that changes whenever the index content is rewritten
+
+    :return: dict of file path to whole document content
+    """
+    doc_dict = {}
+    for file_path in file_path_list:
+        if file_path in doc_dict:
+            continue
+        cache_key = (index_name, file_path, index_generation)
+        doc = whole_doc_cache.get(cache_key)
+        if doc is None:
+            doc = get_doc(file_path, index_name)
+            whole_doc_cache.set(cache_key, doc)
+        doc_dict[file_path] = doc
+    logger.info(f"whole doc cache stats: {whole_doc_cache.stats()}")
+    return doc_dict
+
+def _split_chunk_id(chunk_id):
+    """Split a chunk id such as `$3-1a2b3c4d-2` into its prefix and section id"""
+    chunk_id_prefix, _, section_id = chunk_id.rpartition("-")
+    return chunk_id_prefix, int(section_id)
+
+def get_chunks_by_id(chunk_id_list, index_name):
+    """Fetch chunks by exact chunk id with a single terms query
+
+    :param chunk_id_list: chunk ids to look up
+    :param index_name: Target Index Name
+
+    :return: dict of chunk id to aos `_source`
+    """
+    chunk_dict = {}
+    if not chunk_id_list:
+        return chunk_dict
+    opensearch_query_response = aos_client.search(
+        index_name=index_name,
+        query_type="terms",
+        query_term=list(chunk_id_list),
+        field="metadata.chunk_id.keyword",
+        size=len(chunk_id_list),
+    )
+    if not opensearch_query_response:
+        return chunk_dict
+    for r in opensearch_query_response["hits"]["hits"]:
+        chunk_dict.setdefault(r["_source"]["metadata"]["chunk_id"], r["_source"])
+    return chunk_dict
+
+def get_sibling_contexts(chunk_id_list, index_name, window_size):
+    """Get the neighbouring chunks split from the same section for every chunk id.
+    All neighbouring chunk ids are computed up front and fetched in one request,
+    then the windows are walked locally, stopping at the first missing chunk.
+
+    :return: list of [previous_content_list, next_content_list], in the order of chunk_id_list
+    """
+    positions = []
+    wanted_chunk_ids = set()
+    for chunk_id in chunk_id_list:
+        try:
+            chunk_id_prefix, section_id = _split_chunk_id(chunk_id)
+        except ValueError:
+            positions.append(None)
+            continue
+        positions.append((chunk_id_prefix, section_id))
+        for offset in range(1, window_size + 1):
+            if section_id - offset >= 1:
+                wanted_chunk_ids.add(f"{chunk_id_prefix}-{section_id - offset}")
+            wanted_chunk_ids.add(f"{chunk_id_prefix}-{section_id + offset}")
+    chunk_dict = get_chunks_by_id(wanted_chunk_ids, index_name)
+
+    context_list = []
+    for position in positions:
+        previous_content_list = []
+        next_content_list = []
+        if position is None:
+            context_list.append([previous_content_list, next_content_list])
+            continue
+        chunk_id_prefix, section_id = position
+        for offset in range(1, window_size + 1):
+            chunk = chunk_dict.get(f"{chunk_id_prefix}-{section_id - offset}")
+            if chunk is None:
                 break
-    if "next" in aos_hit['_source']["metadata"]["heading_hierarchy"]:
-        next_chunk_id = aos_hit['_source']["metadata"]["heading_hierarchy"]["next"]
-        next_pos = 0
-        while next_chunk_id and next_chunk_id.startswith("$") and next_pos < window_size:
-            opensearch_query_response = aos_client.search(
-                index_name=index_name,
-                query_type="basic",
-                query_term=next_chunk_id,
-                field="metadata.chunk_id",
-                size=1,
-            )
-            if len(opensearch_query_response["hits"]["hits"]) > 0:
-                r = opensearch_query_response["hits"]["hits"][0]
-                next_chunk_id = r["_source"]["metadata"]["heading_hierarchy"]["next"]
-                next_content_list.append(r["_source"]["text"])
-                next_pos += 1
-            else:
+            previous_content_list.insert(0, chunk["text"])
+        for offset in range(1, window_size + 1):
+            chunk = chunk_dict.get(f"{chunk_id_prefix}-{section_id + offset}")
+            if chunk is None:
                 break
-    return [previous_content_list, next_content_list]
-
-def get_parent_content(previous_chunk_id, next_chunk_id, index_name):
-    previous_content_list = []
-    while previous_chunk_id.startswith("$"):
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=previous_chunk_id,
-            field="metadata.chunk_id",
-            size=10,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            previous_chunk_id = r["_source"]["metadata"]["chunk_id"]
-            previous_content_list.append(r["_source"]["text"])
-        else:
-            break
-    next_content_list = []
-    while next_chunk_id.startswith("$"):
-        opensearch_query_response = aos_client.search(
-            index_name=index_name,
-            query_type="basic",
-            query_term=next_chunk_id,
-            field="metadata.chunk_id",
-            size=10,
-        )
-        if len(opensearch_query_response["hits"]["hits"]) > 0:
-            r = opensearch_query_response["hits"]["hits"][0]
-            next_chunk_id = r["_source"]["metadata"]["chunk_id"]
-            next_content_list.append(r["_source"]["text"])
-        else:
+            next_content_list.append(chunk["text"])
+        context_list.append([previous_content_list, next_content_list])
+    return context_list
+
+def get_heading_contexts(aos_hit_list, index_name, window_size):
+    """Follow the heading_hierarchy previous/next linked list for every hit.
+    Each hop depends on the previous one, so the walk issues one _msearch per hop
+    covering every hit and direction still in progress, instead of one search per chunk.
+
+    :return: list of [previous_content_list, next_content_list], in the order of aos_hit_list
+    """
+    context_list = [[[], []] for _ in aos_hit_list]
+    # (hit position, 0 for previous / 1 for next, heading chunk id)
+    frontier = []
+    for pos, aos_hit in enumerate(aos_hit_list):
+        heading_hierarchy = aos_hit["_source"]["metadata"]["heading_hierarchy"]
+        for direction, key in enumerate(["previous", "next"]):
+            chunk_id = heading_hierarchy.get(key)
+            if chunk_id and chunk_id.startswith("$"):
+                frontier.append((pos, direction, chunk_id))
+
+    for _ in range(window_size):
+        if not frontier:
             break
-    return [previous_content_list, next_content_list]
+        response_list = aos_client.msearch([
+            {
+                "index_name": index_name,
+                "query_type": "basic",
+                "query_term": chunk_id,
+                "field": "metadata.chunk_id",
+                "size": 1,
+            }
+            for _, _, chunk_id in frontier
+        ])
+        next_frontier = []
+        for (pos, direction, _), response in zip(frontier, response_list):
+            if not response or not response.get("hits", {}).get("hits"):
+                continue
+            r = response["hits"]["hits"][0]
+            if direction == 0:
+                context_list[pos][0].insert(0, r["_source"]["text"])
+                chunk_id = r["_source"]["metadata"]["heading_hierarchy"]["previous"]
+            else:
+                context_list[pos][1].append(r["_source"]["text"])
+                chunk_id = r["_source"]["metadata"]["heading_hierarchy"]["next"]
+            if chunk_id and chunk_id.startswith("$"):
+                next_frontier.append((pos, direction, chunk_id))
+        frontier = next_frontier
+    return context_list
+
+@timeit
+def get_contexts(aos_hit_list, index_name, window_size):
+    """Expand every hit with its neighbouring content.
+    Sibling chunks of the same section are used when the whole window is available,
+    otherwise the heading_hierarchy previous/next sections are used instead.
+
+    :param aos_hit_list: aos hits to expand
+    :param index_name: Target Index Name
+    :param window_size: number of chunks to add on each side
+
+    :return: list of [previous_content_list, next_content_list], in the order of aos_hit_list
+    """
+    context_list = [[[], []] for _ in aos_hit_list]
+    sibling_pos_list = [
+        pos for pos, aos_hit in enumerate(aos_hit_list)
+        if "chunk_id" in aos_hit["_source"]["metadata"]
+    ]
+    sibling_context_list = get_sibling_contexts(
+        [aos_hit_list[pos]["_source"]["metadata"]["chunk_id"] for pos in sibling_pos_list],
+        index_name,
+        window_size
+    )
+    heading_pos_list = []
+    for pos, sibling_context in zip(sibling_pos_list, sibling_context_list):
+        if len(sibling_context[0]) == window_size and len(sibling_context[1]) == window_size:
+            context_list[pos] = sibling_context
+        elif "heading_hierarchy" in aos_hit_list[pos]["_source"]["metadata"]:
+            heading_pos_list.append(pos)
+    heading_context_list = get_heading_contexts(
+        [aos_hit_list[pos] for pos in heading_pos_list],
+        index_name,
+        window_size
+    )
+    for pos, heading_context in zip(heading_pos_list, heading_context_list):
+        context_list[pos] = heading_context
+    return context_list
 
 def organize_faq_results(response, index_name, source_field="file_path", text_field="text"):
     """
@@ -420,7 +432,7 @@ class QueryQuestionRetriever(BaseRetriever):
         for result in opensearch_knn_results:
             docs.append(Document(page_content=result["content"], metadata={
                 "source": result[self.source_field], "score":result["score"],"retrieval_score": result["score"],
-                "retrieval_content": result["content"],"answer": result["answer"], 
+                "retrieval_type": "knn", "retrieval_content": result["content"],"answer": result["answer"], 
                 "question": result["question"]}))
         if self.enable_debug:
             debug_info[f"qq-knn-recall-{self.index}-{self.lang}"] = remove_redundancy_debug_info(opensearch_knn_results)
@@ -432,6 +444,7 @@ class QueryDocumentKNNRetriever(BaseRetriever):
     text_field: Any
     source_field: Any
     using_whole_doc: Any
+    index_generation: Any
     context_num: Any
     top_k: Any
     lang: Any
@@ -455,31 +468,13 @@ class QueryDocumentKNNRetriever(BaseRetriever):
             self.target_model = None
         self.model_type = workspace["model_type"]
         self.using_whole_doc = using_whole_doc
+        # bumped by the ingestion job whenever it rewrites the index
+        self.index_generation = workspace.get("updated_at")
         self.context_num = context_num
         self.top_k = top_k
         self.query_key = query_key
         self.enable_debug = enable_debug
 
-    async def __ainvoke_get_context(self, aos_hit, window_size, loop):
-        return await loop.run_in_executor(None,
-                                          get_context,
-                                          aos_hit,
-                                          self.index,
-                                          window_size)
-
-    async def __spawn_task(self, aos_hits, context_size):
-        loop = asyncio.get_event_loop()
-        task_list = []
-        for aos_hit in aos_hits:
-            if context_size:
-                task = asyncio.create_task(
-                    self.__ainvoke_get_context(
-                        aos_hit,
-                        context_size,
-                        loop))
-                task_list.append(task)
-        return await asyncio.gather(*task_list)
-
     @timeit
     def organize_results(self, response, aos_index=None, source_field="file_path", text_field="text", using_whole_doc=True, context_size=0):
         """
@@ -508,20 +503,15 @@ class QueryDocumentKNNRetriever(BaseRetriever):
             #     result["data"]["colbert"] = aos_hit['_source']['metadata']['additional_vecs']['colbert_vecs']
             results.append(result)
         if using_whole_doc:
+            doc_dict = get_whole_docs([result["source"] for result in results], aos_index, self.index_generation)
             for result in results:
-                doc = get_doc(result["source"], aos_index)
+                doc = doc_dict[result["source"]]
                 if doc:
                     result["doc"] = doc
-        else:
-            response_list = asyncio.run(self.__spawn_task(aos_hits, context_size))
-            for context, result in zip(response_list, results):
+        elif context_size:
+            context_list = get_contexts(aos_hits, aos_index, context_size)
+            for context, result in zip(context_list, results):
                 result["doc"] = "\n".join(context[0] + [result["doc"]] + context[1])
-            # context = get_context(aos_hit['_source']["metadata"]["heading_hierarchy"]["previous"],
-            #                     aos_hit['_source']["metadata"]["heading_hierarchy"]["next"],
-            #                     aos_index,
-            #                     context_size)
-            # if context:
-            #     result["doc"] = "\n".join(context[0] + [result["doc"]] + context[1])
         return results
 
     @timeit
@@ -562,6 +552,7 @@ class QueryDocumentKNNRetriever(BaseRetriever):
                                                "retrieval_content": result["content"],
                                                "retrieval_data": result["data"],
                                                "retrieval_score": result["score"],
+                                               "retrieval_type": "knn",
                                                # "jsonlAnswer": result["detail"]["metadata"]["jsonlAnswer"],
                                                #
                                                 # set common score for llm.
@@ -576,6 +567,7 @@ class QueryDocumentBM25Retriever(BaseRetriever):
     text_field: Any
     source_field: Any
     using_whole_doc: Any
+    index_generation: Any
     context_num: Any
     top_k: Any
     lang: Any
@@ -593,31 +585,13 @@ class QueryDocumentBM25Retriever(BaseRetriever):
         self.lang = workspace["languages"][0]
         self.model_type = workspace["model_type"]
         self.using_whole_doc = using_whole_doc
+        # bumped by the ingestion job whenever it rewrites the index
+        self.index_generation = workspace.get("updated_at")
         self.context_num = context_num
         self.top_k = top_k
         self.query_key = query_key
         self.enable_debug = enable_debug
 
-    async def __ainvoke_get_context(self, aos_hit, window_size, loop):
-        return await loop.run_in_executor(None,
-                                          get_context,
-                                          aos_hit,
-                                          self.index,
-                                          window_size)
-
-    async def __spawn_task(self, aos_hits, context_size):
-        loop = asyncio.get_event_loop()
-        task_list = []
-        for aos_hit in aos_hits:
-            if context_size:
-                task = asyncio.create_task(
-                    self.__ainvoke_get_context(
-                        aos_hit,
-                        context_size,
-                        loop))
-                task_list.append(task)
-        return await asyncio.gather(*task_list)
-
     @timeit
     def organize_results(self, response, aos_index=None, source_field="file_path", text_field="text", using_whole_doc=True, context_size=0):
         """
@@ -651,20 +625,15 @@ class QueryDocumentBM25Retriever(BaseRetriever):
                 result["jsonlAnswer"] = aos_hit["_source"]["metadata"]["jsonlAnswer"]
             results.append(result)
         if using_whole_doc:
+            doc_dict = get_whole_docs([result["source"] for result in results], aos_index, self.index_generation)
             for result in results:
-                doc = get_doc(result["source"], aos_index)
+                doc = doc_dict[result["source"]]
                 if doc:
                     result["doc"] = doc
-        else:
-            response_list = asyncio.run(self.__spawn_task(aos_hits, context_size))
-            for context, result in zip(response_list, results):
+        elif context_size:
+            context_list = get_contexts(aos_hits, aos_index, context_size)
+            for context, result in zip(context_list, results):
                 result["doc"] = "\n".join(context[0] + [result["doc"]] + context[1])
-            # context = get_context(aos_hit['_source']["metadata"]["heading_hierarchy"]["previous"],
-            #                     aos_hit['_source']["metadata"]["heading_hierarchy"]["next"],
-            #                     aos_index,
-            #                     context_size)
-            # if context:
-            #     result["doc"] = "\n".join(context[0] + [result["doc"]] + context[1])
         return results
 
     @timeit
@@ -703,12 +672,200 @@ class QueryDocumentBM25Retriever(BaseRetriever):
                                                "retrieval_content": result["content"],
                                                "retrieval_data": result["data"],
                                                "retrieval_score": result["score"],
+                                               "retrieval_type": "bm25",
                                                 # set common score for llm.
                                                "score": result["score"]}))
         if self.enable_debug:
             debug_info[f"qd-bm25-recall-{self.index}-{self.lang}"] = remove_redundancy_debug_info(opensearch_bm25_results)
         return doc_list
 
+def rrf_fusion(result_lists, weights, k=60):
+    """Reciprocal rank fusion, scores depend on ranks only"""
+    fused_scores = {}
+    for result_list, weight in zip(result_lists, weights):
+        for rank, (key, _) in enumerate(result_list):
+            fused_scores[key] = fused_scores.get(key, 0) + weight / (k + rank + 1)
+    return fused_scores
+
+def weighted_fusion(result_lists, weights):
+    """Weighted sum of min-max normalised scores"""
+    fused_scores = {}
+    for result_list, weight in zip(result_lists, weights):
+        if not result_list:
+            continue
+        scores = [score for _, score in result_list]
+        min_score, max_score = min(scores), max(scores)
+        score_range = max_score - min_score
+        for key, score in result_list:
+            norm_score = (score - min_score) / score_range if score_range else 1.0
+            fused_scores[key] = fused_scores.get(key, 0) + weight * norm_score
+    return fused_scores
+
+fusion_methods = {
+    "rrf": rrf_fusion,
+    "weighted": weighted_fusion,
+}
+
+class QueryDocumentHybridRetriever(BaseRetriever):
+    """KNN and BM25 retrieval over several workspaces in a single _msearch.
+    Scores are fused locally, hits are deduplicated and only the final top_k
+    hits are expanded with their context.
+    """
+    workspace_list: Any
+    using_whole_doc: Any
+    context_num: Any
+    top_k: Any
+    fusion: Any
+    knn_weight: Any
+    bm25_weight: Any
+    query_key: str="query"
+    enable_debug: Any
+    config: Dict={"run_name": "Hybrid"}
+
+    def __init__(self, workspace_list, using_whole_doc, context_num, top_k, fusion="rrf",
+                 knn_weight=1.0, bm25_weight=1.0, query_key='query', enable_debug=False):
+        super().__init__()
+        if fusion not in fusion_methods:
+            raise ValueError(f'invalid fusion method: {fusion}')
+        self.workspace_list = workspace_list
+        self.using_whole_doc = using_whole_doc
+        self.context_num = context_num
+        self.top_k = top_k
+        self.fusion = fusion
+        self.knn_weight = knn_weight
+        self.bm25_weight = bm25_weight
+        self.query_key = query_key
+        self.enable_debug = enable_debug
+
+    def __get_query(self, question, lang):
+        query = question[self.query_key]
+        if "query_lang" in question and question["query_lang"] != lang and "translated_text" in question:
+            query = question["translated_text"]
+        return query
+
+    @staticmethod
+    def __get_target_model(workspace):
+        if workspace["embeddings_model_name"].endswith("tar.gz"):
+            return workspace["embeddings_model_name"]
+        return None
+
+    def __build_search_list(self, question, filter):
+        # workspaces sharing an embedding model reuse the same query embedding
+        query_repr_dict = {}
+        search_list = []
+        for workspace in self.workspace_list:
+            index = workspace["open_search_index_name"]
+            lang = workspace["languages"][0]
+            query = self.__get_query(question, lang)
+            embedding_key = (query, lang, workspace["embeddings_model_endpoint"],
+                             self.__get_target_model(workspace), workspace["model_type"])
+            if embedding_key not in query_repr_dict:
+                query_repr_dict[embedding_key] = get_relevance_embedding(*embedding_key)
+            search_list.append({
+                "index_name": index,
+                "query_type": "knn",
+                "query_term": query_repr_dict[embedding_key],
+                "field": "vector_field",
+                "size": self.top_k,
+                "filter": filter,
+            })
+            search_list.append({
+                "index_name": index,
+                "query_type": "fuzzy",
+                "query_term": query,
+                "field": "text",
+                "size": self.top_k,
+                "filter": filter,
+            })
+        return search_list
+
+    @timeit
+    def __fuse(self, response_list):
+        """Fuse the KNN and BM25 hit lists of every workspace into a single ranked list of
+        (index, aos_hit, fused score), deduplicated by index and document id"""
+        knn_results = []
+        bm25_results = []
+        hit_dict = {}
+        for workspace, knn_response, bm25_response in zip(
+                self.workspace_list, response_list[0::2], response_list[1::2]):
+            index = workspace["open_search_index_name"]
+            for response, result_list in [(knn_response, knn_results), (bm25_response, bm25_results)]:
+                if not response:
+                    continue
+                for aos_hit in response["hits"]["hits"]:
+                    key = (index, aos_hit["_id"])
+                    hit_dict.setdefault(key, aos_hit)
+                    result_list.append((key, aos_hit["_score"]))
+        # each list is ranked on its own scores before fusion
+        knn_results.sort(key=lambda x: x[1], reverse=True)
+        bm25_results.sort(key=lambda x: x[1], reverse=True)
+        fused_scores = fusion_methods[self.fusion](
+            [knn_results, bm25_results], [self.knn_weight, self.bm25_weight]
+        )
+        ranked_keys = sorted(fused_scores, key=fused_scores.get, reverse=True)[:self.top_k]
+        return [(key[0], hit_dict[key], fused_scores[key]) for key in ranked_keys]
+
+    @timeit
+    def __expand(self, fused_hits):
+        """Expand the final hits with whole docs or context, one batch per index"""
+        results = []
+        for index, aos_hit, score in fused_hits:
+            content = aos_hit["_source"]["text"]
+            results.append({
+                "index": index,
+                "source": aos_hit["_source"]["metadata"]["file_path"],
+                "score": score,
+                "detail": aos_hit["_source"],
+                "content": content,
+                "doc": content,
+                "data": {},
+            })
+        index_generation_dict = {
+            workspace["open_search_index_name"]: workspace.get("updated_at")
+            for workspace in self.workspace_list
+        }
+        for index in {result["index"] for result in results}:
+            index_pos_list = [pos for pos, result in enumerate(results) if result["index"] == index]
+            if self.using_whole_doc:
+                doc_dict = get_whole_docs([results[pos]["source"] for pos in index_pos_list],
+                                          index, index_generation_dict[index])
+                for pos in index_pos_list:
+                    if doc_dict[results[pos]["source"]]:
+                        results[pos]["doc"] = doc_dict[results[pos]["source"]]
+            elif self.context_num:
+                context_list = get_contexts([fused_hits[pos][1] for pos in index_pos_list],
+                                            index, self.context_num)
+                for pos, context in zip(index_pos_list, context_list):
+                    results[pos]["doc"] = "\n".join(context[0] + [results[pos]["doc"]] + context[1])
+        return results
+
+    @timeit
+    def _get_relevant_documents(self, question: Dict, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        debug_info = question["debug_info"]
+        if not self.workspace_list:
+            return []
+        filter = get_filter_list(question)
+        response_list = aos_client.msearch(self.__build_search_list(question, filter))
+        results = self.__expand(self.__fuse(response_list))
+        doc_list = []
+        content_set = set()
+        for result in results:
+            if result["doc"] in content_set:
+                continue
+            content_set.add(result["doc"])
+            doc_list.append(Document(page_content=result["doc"],
+                                     metadata={"source": result["source"],
+                                               "retrieval_content": result["content"],
+                                               "retrieval_data": result["data"],
+                                               "retrieval_score": result["score"],
+                                               "retrieval_type": "hybrid",
+                                                # set common score for llm.
+                                               "score": result["score"]}))
+        if self.enable_debug:
+            index_str = "-".join(workspace["open_search_index_name"] for workspace in self.workspace_list)
+            debug_info[f"qd-hybrid-recall-{index_str}"] = remove_redundancy_debug_info(results)
+        return doc_list
+
 def index_results_format(docs:list, threshold=-1):
     results = []
     for doc in docs:
@@ -3,10 +3,16 @@ import threading
 
 import boto3
 from opensearchpy import OpenSearch, RequestsHttpConnection
+from opensearchpy.exceptions import TransportError
 from requests_aws4auth import AWS4Auth
 
+from common_logic.common_utils.cache_utils import LRUTTLCache
+
 open_search_client_lock = threading.Lock()
 
+# seconds a missing index is remembered before it is looked up again
+MISSING_INDEX_TTL = float(os.environ.get("aos_missing_index_ttl", 60))
+
 credentials = boto3.Session().get_credentials()
 
 region = boto3.Session().region_name
@@ -32,6 +38,17 @@ def _import_not_found_error():
     return NotFoundError
 
 
+def _vector_dimensions(properties, prefix=""):
+    """Dimension of each knn_vector field of the properties of a mapping, by field path"""
+    dimensions = {}
+    for name, field in properties.items():
+        if field.get("type") == "knn_vector":
+            dimensions[f"{prefix}{name}"] = field.get("dimension")
+        if "properties" in field:
+            dimensions.update(_vector_dimensions(field["properties"], f"{prefix}{name}."))
+    return dimensions
+
+
 class LLMBotOpenSearchClient:
     instance = None
 
@@ -60,11 +77,16 @@ class LLMBotOpenSearchClient:
             verify_certs=True,
             connection_class=RequestsHttpConnection,
         )
+        # index metadata read once per warm container, refreshed on a miss or an error
+        self.index_metadata = LRUTTLCache(
+            maxsize=int(os.environ.get("aos_index_metadata_cache_size", 256))
+        )
         self.query_match = {
             "knn": self._build_knn_search_query,
             "exact": self._build_exactly_match_query,
             "fuzzy": self._build_fuzzy_search_query,
             "basic": self._build_basic_search_query,
+            "terms": self._build_terms_search_query,
         }
 
     def _build_basic_search_query(
@@ -94,6 +116,30 @@ class LLMBotOpenSearchClient:
 
         return query
 
+    def _build_terms_search_query(
+        self, index_name, query_term, field, size, filter=None
+    ):
+        """
+        Build terms search query, returning at most one hit per term
+
+        :param index_name: Target Index Name
+        :param query_term: list of exact values to look up
+        :param field: keyword search field
+        :param size: number of results to return from aos
+
+        :return: aos response json
+        """
+        query = {
+            "size": size,
+            "query": {"bool": {"filter": [{"terms": {field: query_term}}]}},
+            "collapse": {"field": field},
+            "_source": {"excludes": ["*.additional_vecs", "vector_field"]},
+        }
+        if filter:
+            query["query"]["bool"]["filter"].extend(filter)
+
+        return query
+
     def _build_fuzzy_search_query(
         self, index_name, query_term, field, size, filter=None
     ):
@@ -113,7 +159,7 @@ class LLMBotOpenSearchClient:
             "_source": {"excludes": ["*.additional_vecs", "vector_field"]},
         }
         if filter:
-            query["query"]["bool"]["filter"] = filter
+            query["query"] = {"bool": {"must": [query["query"]], "filter": filter}}
 
         return query
 
@@ -184,6 +230,38 @@ class LLMBotOpenSearchClient:
                 results.append({"doc": doc, "score": score, "source": source})
         return results
 
+    def get_index_metadata(self, index_name, refresh=False):
+        """
+        Get the metadata of an index, read from aos once and then cached
+
+        :param index_name: Target Index Name, or alias
+        :param refresh: read the metadata from aos even if it is cached
+
+        :return: dict with exists, and for an existing index its name, the
+            properties of its mapping and the dimension of each knn_vector field
+        """
+        metadata = None if refresh else self.index_metadata.get(index_name)
+        if metadata is not None:
+            return metadata
+        not_found_error = _import_not_found_error()
+        try:
+            response = self.client.indices.get(index=index_name)
+        except not_found_error:
+            metadata = {"exists": False}
+            self.index_metadata.set(index_name, metadata, ttl=MISSING_INDEX_TTL)
+            return metadata
+        # an alias is answered with the index it points to
+        name, index = next(iter(response.items()))
+        properties = index.get("mappings", {}).get("properties", {})
+        metadata = {
+            "exists": True,
+            "index": name,
+            "properties": properties,
+            "vector_dimensions": _vector_dimensions(properties),
+        }
+        self.index_metadata.set(index_name, metadata)
+        return metadata
+
     def search(
         self,
         index_name,
@@ -205,13 +283,76 @@ class LLMBotOpenSearchClient:
 
         :return: aos response json
         """
-        not_found_error = _import_not_found_error()
-        try:
-            self.client.indices.get(index=index_name)
-        except not_found_error:
+        metadata = self.get_index_metadata(index_name)
+        if not metadata["exists"]:
             return []
+        if query_type == "knn":
+            dimension = metadata["vector_dimensions"].get(field)
+            if dimension is not None and dimension != len(query_term):
+                # the index may have been recreated with another embedding model
+                metadata = self.get_index_metadata(index_name, refresh=True)
+                if not metadata["exists"]:
+                    return []
+                dimension = metadata["vector_dimensions"].get(field)
+                if dimension is not None and dimension != len(query_term):
+                    raise ValueError(
+                        f"{field} of {index_name} has dimension {dimension}, "
+                        f"the query vector has dimension {len(query_term)}"
+                    )
         query = self.query_match[query_type](
             index_name, query_term, field, size, filter
         )
-        response = self.client.search(body=query, index=index_name)
+        not_found_error = _import_not_found_error()
+        try:
+            response = self.client.search(body=query, index=index_name)
+        except not_found_error:
+            # deleted since its metadata was read
+            self.index_metadata.pop(index_name)
+            return []
+        except Exception:
+            self.index_metadata.pop(index_name)
+            raise
         return response
+
+    def msearch(self, search_list):
+        """
+        Perform several searches on aos in one round trip.
+        Searches may target different indices and query types, a search on a
+        missing index yields an empty response instead of failing the batch,
+        any other failed search raises a TransportError.
+
+        :param search_list: list of dict with the keyword arguments of `search`,
+            i.e. index_name, query_type, query_term and optional field, size, filter
+
+        :return: list of aos response json, in the order of search_list
+        """
+        if not search_list:
+            return []
+        body = []
+        for search in search_list:
+            body.append({"index": search["index_name"]})
+            body.append(
+                self.query_match[search["query_type"]](
+                    search["index_name"],
+                    search["query_term"],
+                    search.get("field", "text"),
+                    search.get("size", 10),
+                    search.get("filter"),
+                )
+            )
+        response = self.client.msearch(body=body)
+        response_list = []
+        for search, sub_response in zip(search_list, response["responses"]):
+            if "error" not in sub_response:
+                response_list.append(sub_response)
+                continue
+            # the metadata of the index may be stale, as after a failed search
+            self.index_metadata.pop(search["index_name"])
+            error = sub_response["error"]
+            error_type = error.get("type") if isinstance(error, dict) else error
+            if error_type == "index_not_found_exception":
+                response_list.append([])
+                continue
+            # e.g. es_rejected_execution_exception when throttled, or a query parse error
+            raise TransportError(sub_response.get("status", "N/A"), error_type, error)
+        return response_list
@@ -1,6 +1,8 @@
 import json
 import os
+import re
 import time
+import hashlib
 import logging
 import asyncio
 import numpy as np
@@ -14,36 +16,87 @@ from langchain.schema import Document
 from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
 
 from sm_utils import SagemakerEndpointVectorOrCross
+from common_logic.common_utils.cache_utils import LRUTTLCache
 
 rerank_model_endpoint = os.environ.get("rerank_endpoint", "")
+# rerank scores keyed by hash of (endpoint, target_model, query, truncated content)
+rerank_score_cache = LRUTTLCache(
+    maxsize=int(os.environ.get("rerank_cache_size", 4096)),
+    ttl=int(os.environ.get("rerank_cache_ttl", 3600))
+)
+# approximate token units: a single CJK character or a run of other non-space characters
+token_unit_pattern = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\s\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
 
-"""Document compressor that uses BGE reranker model."""
-class BGEM3Reranker(BaseDocumentCompressor):
 
-    """Number of documents to return."""
-    def _colbert_score_np(self, q_reps, p_reps):
-        token_scores = np.einsum('nik,njk->nij', q_reps, p_reps)
-        scores = token_scores.max(-1)
-        scores = np.sum(scores) / q_reps.shape[0]
+def truncate_by_tokens(text: str, max_tokens: int, margin: float = 1.5) -> str:
+    """Cut text after roughly max_tokens tokens without loading a tokenizer.
+    Tokens are approximated by CJK characters and whitespace separated words,
+    `margin` keeps extra units so that text the endpoint would still see is not cut.
+    """
+    max_units = int(max_tokens * margin)
+    for i, match in enumerate(token_unit_pattern.finditer(text)):
+        if i == max_units:
+            return text[:match.start()]
+    return text
+
+
+def rerank_cache_key(endpoint_name, target_model, query, content):
+    key_str = json.dumps([endpoint_name, target_model, query, content], ensure_ascii=False)
+    return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+def pack_colbert_vecs(vecs_list, max_len=None, dtype=np.float16):
+    """Pack variable-length colbert vectors into one padded array.
+
+    :param vecs_list: list of (num_tokens, dim) colbert vectors, as lists or arrays
+    :param max_len: keep at most this many token vectors per item
+    :param dtype: storage dtype, float16 halves the memory of the packed array
+
+    :return: packed (n, max_tokens, dim) array and (n, max_tokens) boolean mask of real tokens
+    """
+    # slice before converting, the nested list -> array conversion dominates the cost
+    vecs_list = [vecs[:max_len] for vecs in vecs_list]
+    lengths = [len(vecs) for vecs in vecs_list]
+    # candidates may have no token vectors at all, the dimension comes from the first one that has
+    dim = next((len(vecs[0]) for vecs, length in zip(vecs_list, lengths) if length), 0)
+    packed = np.zeros((len(vecs_list), max(lengths, default=0), dim), dtype=dtype)
+    mask = np.zeros(packed.shape[:2], dtype=bool)
+    for i, vecs in enumerate(vecs_list):
+        if lengths[i]:
+            packed[i, :lengths[i]] = vecs
+        mask[i, :lengths[i]] = True
+    return packed, mask
+
+
+def colbert_scores_np(q_reps, p_reps, p_mask, chunk_tokens=16384):
+    """Late-interaction scores of one query against all candidate docs at once.
+
+    :param q_reps: (num_query_tokens, dim) query colbert vectors
+    :param p_reps: (n, num_doc_tokens, dim) packed doc colbert vectors
+    :param p_mask: (n, num_doc_tokens) mask of real doc tokens
+    :param chunk_tokens: doc token vectors upcast to float32 per einsum call, bounds peak memory
+
+    :return: (n,) scores, mean over query tokens of the best matching doc token, 0 for docs without tokens
+    """
+    q_reps = np.asarray(q_reps, dtype=np.float32)
+    scores = np.zeros(p_reps.shape[0], dtype=np.float32)
+    if p_reps.shape[1] == 0:
         return scores
+    chunk_size = max(1, chunk_tokens // p_reps.shape[1])
+    for start in range(0, p_reps.shape[0], chunk_size):
+        p_chunk = p_reps[start:start + chunk_size].astype(np.float32, copy=False)
+        chunk_mask = p_mask[start:start + chunk_size]
+        token_scores = np.einsum('ik,njk->nij', q_reps, p_chunk, optimize=True)
+        token_scores = np.where(chunk_mask[:, None, :], token_scores, -np.inf)
+        chunk_scores = token_scores.max(-1).sum(-1)
+        # a doc without token vectors matches nothing, -inf would not survive json
+        scores[start:start + chunk_size] = np.where(chunk_mask.any(-1), chunk_scores, 0.0)
+    return scores / q_reps.shape[0]
 
-    async def __ainvoke_rerank_model(self, query_batch, doc_batch, loop):
-        return await loop.run_in_executor(None,
-                                          self._colbert_score_np,
-                                          np.asarray(query_batch),
-                                          np.asarray(doc_batch))
 
-    async def __spawn_task(self, query_colbert_list, doc_colbert_list):
-        batch_size = 1
-        task_list = []
-        loop = asyncio.get_event_loop()
-        for batch_start in range(0, len(query_colbert_list), batch_size):
-            task = asyncio.create_task(self.__ainvoke_rerank_model(
-                query_colbert_list[batch_start:batch_start + batch_size],
-                doc_colbert_list[batch_start:batch_start + batch_size], loop))
-            task_list.append(task)
-        return await asyncio.gather(*task_list)
+"""Document compressor that uses BGE reranker model."""
+class BGEM3Reranker(BaseDocumentCompressor):
 
+    """Number of documents to return."""
     def compress_documents(
         self,
         documents: Sequence[Document],
@@ -68,14 +121,11 @@ class BGEM3Reranker(BaseDocumentCompressor):
         _docs = [d.metadata["retrieval_data"]['colbert'] for d in doc_list]
 
         rerank_text_length = 1024 * 10
-        query_colbert_list = []
-        doc_colbert_list = []
-        for doc in _docs:
-            query_colbert_list.append(query["colbert"][:rerank_text_length])
-            doc_colbert_list.append(doc[:rerank_text_length])
-        score_list = []
-        logger.info(f'rerank pair num {len(query_colbert_list)}, m3 method: colbert score')
-        score_list = asyncio.run(self.__spawn_task(query_colbert_list, doc_colbert_list))
+        logger.info(f'rerank pair num {len(_docs)}, m3 method: colbert score')
+        doc_colbert_packed, doc_colbert_mask = pack_colbert_vecs(_docs, max_len=rerank_text_length)
+        score_list = colbert_scores_np(
+            query["colbert"][:rerank_text_length], doc_colbert_packed, doc_colbert_mask
+        ).tolist()
         final_results = []
         debug_info = query["debug_info"]
         debug_info["knowledge_qa_rerank"] = []
@@ -102,14 +152,22 @@ class BGEReranker(BaseDocumentCompressor):
     target_model: Any
     rerank_model_endpoint: str=rerank_model_endpoint
     top_k: int=10
+    max_tokens: int=512
+    score_gap_threshold: Any=None
 
-    def __init__(self, query_key='query', enable_debug=False, rerank_model_endpoint=rerank_model_endpoint, target_model=None, top_k=10):
+    def __init__(self, query_key='query', enable_debug=False, rerank_model_endpoint=rerank_model_endpoint, target_model=None, top_k=10,
+                 max_tokens=512, score_gap_threshold=None):
         super().__init__()
         self.query_key = query_key
         self.enable_debug = enable_debug
         self.rerank_model_endpoint = rerank_model_endpoint
         self.target_model = target_model
         self.top_k = top_k
+        # the endpoint truncates each (query, doc) pair to this many tokens
+        self.max_tokens = max_tokens
+        # skip reranking when the best retrieval score leads the next one by at least this gap,
+        # if all documents come from the same retriever type
+        self.score_gap_threshold = score_gap_threshold
 
     async def __ainvoke_rerank_model(self, batch, loop):
         logging.info("invoke endpoint")
@@ -131,6 +189,35 @@ class BGEReranker(BaseDocumentCompressor):
             task_list.append(task)
         return await asyncio.gather(*task_list)
 
+    def __retrieval_scores_separated(self, doc_list):
+        if self.score_gap_threshold is None or len(doc_list) < 2:
+            return False
+        # knn and bm25 scores are on different scales, only compare scores of one retriever type
+        retrieval_types = {doc.metadata.get("retrieval_type") for doc in doc_list}
+        if len(retrieval_types) != 1 or None in retrieval_types:
+            return False
+        scores = sorted((doc.metadata["retrieval_score"] for doc in doc_list), reverse=True)
+        return scores[0] - scores[1] >= self.score_gap_threshold
+
+    def __get_rerank_scores(self, query, doc_list):
+        """Rerank scores of every doc, only pairs missing from rerank_score_cache go to the endpoint"""
+        query_budget = self.max_tokens - len(token_unit_pattern.findall(query))
+        contents = [truncate_by_tokens(d.metadata["retrieval_content"], max(query_budget, 0)) for d in doc_list]
+        cache_keys = [rerank_cache_key(self.rerank_model_endpoint, self.target_model, query, content) for content in contents]
+        score_list = [rerank_score_cache.get(cache_key) for cache_key in cache_keys]
+        miss_pos_list = [pos for pos, score in enumerate(score_list) if score is None]
+        rerank_pair = [[query, contents[pos]] for pos in miss_pos_list]
+        logger.info(f'rerank pair num {len(rerank_pair)}, cached {len(doc_list) - len(rerank_pair)}, endpoint_name: {self.rerank_model_endpoint}')
+        if rerank_pair:
+            response_list = asyncio.run(self.__spawn_task(rerank_pair))
+            new_score_list = []
+            for response in response_list:
+                new_score_list.extend(json.loads(response))
+            for pos, score in zip(miss_pos_list, new_score_list):
+                score_list[pos] = score
+                rerank_score_cache.set(cache_keys[pos], score)
+        return score_list
+
     def compress_documents(
         self,
         documents: Sequence[Document],
@@ -152,17 +239,15 @@ class BGEReranker(BaseDocumentCompressor):
         if len(documents) == 0:  # to avoid empty api call
             return []
         doc_list = list(documents)
-        _docs = [d.metadata["retrieval_content"] for d in doc_list]
-
-        rerank_pair = []
-        rerank_text_length = 1024 * 10
-        for doc in _docs:
-            rerank_pair.append([query[self.query_key], doc[:rerank_text_length]])
-        score_list = []
-        logger.info(f'rerank pair num {len(rerank_pair)}, endpoint_name: {self.rerank_model_endpoint}')
-        response_list = asyncio.run(self.__spawn_task(rerank_pair))
-        for response in response_list:
-            score_list.extend(json.loads(response))
+        if self.__retrieval_scores_separated(doc_list):
+            logger.info("retrieval scores already separated, skip rerank")
+            query["debug_info"]["knowledge_qa_rerank"] = []
+            doc_list.sort(key=lambda x: x.metadata["retrieval_score"], reverse=True)
+            for doc in doc_list:
+                doc.metadata["rerank_score"] = doc.metadata["retrieval_score"]
+                doc.metadata["score"] = doc.metadata["rerank_score"]
+            return doc_list[:self.top_k]
+        score_list = self.__get_rerank_scores(query[self.query_key], doc_list)
         final_results = []
         debug_info = query["debug_info"]
         debug_info["knowledge_qa_rerank"] = []
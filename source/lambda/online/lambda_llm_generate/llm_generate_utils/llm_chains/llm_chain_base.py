@@ -1,3 +1,10 @@
+import hashlib
+import json
+import os
+
+from common_logic.common_utils.cache_utils import LRUTTLCache
+
+
 class LLMChainMeta(type):
     def __new__(cls, name, bases, attrs):
         new_cls = type.__new__(cls, name, bases, attrs)
@@ -9,6 +16,11 @@ class LLMChainMeta(type):
 
 class LLMChain(metaclass=LLMChainMeta):
     model_map = {}
+    # chains built by get_chain, keyed by a hash of all their arguments and
+    # shared across warm invocations
+    chain_cache = LRUTTLCache(maxsize=int(os.environ.get("llm_chain_cache_size", 128)))
+    # False for chains whose construction depends on more than their arguments, e.g. the clock
+    cacheable = True
 
     @classmethod
     def get_chain_id(cls):
@@ -19,8 +31,29 @@ class LLMChain(metaclass=LLMChainMeta):
         return f"{model_id}__{intent_type}"
 
     @classmethod
-    def get_chain(cls, model_id, intent_type, model_kwargs=None, **kwargs):
-        return cls.model_map[cls._get_chain_id(model_id, intent_type)].create_chain(
-            model_kwargs=model_kwargs, **kwargs
-        )
+    def get_cache_key(cls, model_kwargs=None, **kwargs):
+        """Canonical hash of the chain and its arguments, None if an argument is not json serializable"""
+        try:
+            arguments = json.dumps(
+                [cls.get_chain_id(), model_kwargs, kwargs],
+                sort_keys=True,
+                ensure_ascii=False,
+            )
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(arguments.encode("utf-8")).hexdigest()
 
+    @classmethod
+    def get_chain(cls, model_id, intent_type, model_kwargs=None, **kwargs):
+        chain_cls = cls.model_map[cls._get_chain_id(model_id, intent_type)]
+        cache_key = None
+        if chain_cls.cacheable:
+            # before create_chain, which may edit its arguments
+            cache_key = chain_cls.get_cache_key(model_kwargs=model_kwargs, **kwargs)
+        if cache_key is None:
+            return chain_cls.create_chain(model_kwargs=model_kwargs, **kwargs)
+        chain = cls.chain_cache.get(cache_key)
+        if chain is None:
+            chain = chain_cls.create_chain(model_kwargs=model_kwargs, **kwargs)
+            cls.chain_cache.set(cache_key, chain)
+        return chain
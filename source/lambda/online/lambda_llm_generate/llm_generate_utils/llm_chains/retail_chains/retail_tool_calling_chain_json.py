@@ -55,6 +55,8 @@ class GLM4Chat9BRetailToolCallingChain(GLM4Chat9BChatChain):
         "temperature": 0.1,
     }
     DATE_PROMPT = "当前日期: %Y-%m-%d"
+    # the system prompt holds the current date
+    cacheable = False
     
     @staticmethod
     def convert_openai_function_to_glm(tools:list[dict]):
@@ -160,6 +162,8 @@ class Qwen2Instruct7BRetailToolCallingChain(Qwen2Instruct7BChatChain):
     }
 
     DATE_PROMPT = "当前日期: %Y-%m-%d 。"
+    # the system prompt holds the current date
+    cacheable = False
     FN_NAME = '✿FUNCTION✿'
     FN_ARGS = '✿ARGS✿'
     FN_RESULT = '✿RESULT✿'
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import threading
 from datetime import datetime
 
 
@@ -21,6 +22,19 @@ SYSTEM_MESSAGE_TYPE = MessageType.SYSTEM_MESSAGE_TYPE
 
 logger = get_logger("llm_model")
 
+# boto3 clients shared by the models of a container, a new client loads its service model and connects again
+_boto3_clients = {}
+_boto3_clients_lock = threading.Lock()
+
+
+def get_boto3_client(service_name, region_name=None, credentials_profile_name=None):
+    key = (service_name, region_name, credentials_profile_name)
+    with _boto3_clients_lock:
+        if key not in _boto3_clients:
+            session = boto3.Session(profile_name=credentials_profile_name)
+            _boto3_clients[key] = session.client(service_name, region_name=region_name)
+        return _boto3_clients[key]
+
 
 
 class ModeMixins:
@@ -83,6 +97,11 @@ class Claude2(Model):
             or None
         )
         llm = BedrockChat(
+            client=get_boto3_client(
+                "bedrock-runtime",
+                region_name=region_name,
+                credentials_profile_name=credentials_profile_name,
+            ),
             credentials_profile_name=credentials_profile_name,
             region_name=region_name,
             model_id=cls.model_id,
@@ -124,7 +143,7 @@ class SagemakerModelBase(Model):
 
     @classmethod
     def create_client(cls, region_name):
-        client = boto3.client("sagemaker-runtime", region_name=region_name)
+        client = get_boto3_client("sagemaker-runtime", region_name=region_name)
         return client
 
     def __init__(self, model_kwargs=None, **kwargs) -> None:
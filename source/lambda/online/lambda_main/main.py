@@ -3,7 +3,8 @@ import uuid
 import boto3
 import traceback
 
-from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory
+from common_logic.common_utils.cache_utils import config_cache
+from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory, flush_chat_history
 from lambda_main.main_utils.online_entries import get_entry
 from lambda_main.main_utils.response_utils import process_response
 from common_logic.common_utils.constant import EntryType
@@ -23,6 +24,8 @@ prompt_table_name = os.environ.get("prompt_table_name", "")
 websocket_url = os.environ.get("websocket_url", "")
 openai_key_arn = os.environ.get("openai_key_arn", "")
 region_name = os.environ["AWS_REGION"]
+# seconds the handler waits for the chat history writes before returning
+CHAT_HISTORY_FLUSH_TIMEOUT = float(os.environ.get("chat_history_flush_timeout", 10))
 session = boto3.session.Session()
 secret_manager_client = session.client(
     service_name="secretsmanager",
@@ -67,6 +70,21 @@ def get_secret_value(secret_arn: str):
 
 @chatbot_lambda_call_wrapper
 def lambda_handler(event_body:dict, context:dict):
+    config_cache_stats = config_cache.stats()
+    try:
+        return handle_request(event_body, context)
+    finally:
+        # the container is frozen after returning, the chat history must be written by then
+        if not flush_chat_history(timeout=CHAT_HISTORY_FLUSH_TIMEOUT):
+            logger.error("Chat history was not written before the timeout")
+        request_stats = config_cache.stats_since(config_cache_stats)
+        logger.info(
+            f"config cache: {request_stats.get('ddb_reads', 0)} DynamoDB reads, "
+            f"{request_stats.get('hits', 0) + request_stats.get('negative_hits', 0)} reads saved"
+        )
+
+
+def handle_request(event_body:dict, context:dict):
     # logger.info(event_body)
     stream = context['stream']
     request_timestamp = context['request_timestamp']
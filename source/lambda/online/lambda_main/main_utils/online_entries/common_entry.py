@@ -1,4 +1,9 @@
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from difflib import SequenceMatcher
 from typing import Annotated, Any, TypedDict
 
 from common_logic.common_utils.constant import LLMTaskType,ChatbotMode,MessageType
@@ -74,6 +79,130 @@ def get_common_system_prompt():
     system_prompt = f"你是一个亚马逊云科技的AI助理，你的名字是亚麻小Q。今天是{date_str},{weekday}. "
     return system_prompt
 
+#########################
+# speculative execution #
+#########################
+# branches started on the raw query while query_preprocess rewrites it,
+# keyed by (message_id, node name) -> (query, start time, future)
+speculative_executor = ThreadPoolExecutor(max_workers=4)
+speculative_branches = {}
+# message_id -> (cancel event, futures of all its branches), claimed or not
+speculative_messages = {}
+speculative_branches_lock = threading.Lock()
+# seconds the end of an invocation waits for its discarded branches that already started,
+# the container is frozen after the handler returns and they would resume in the next invocation
+SPECULATIVE_DISCARD_TIMEOUT = float(os.environ.get("speculative_discard_timeout", 10))
+
+
+def start_speculative_branches(state: ChatbotState):
+    """Start the branches that only depend on the query before it is rewritten.
+    intention detection runs in agent mode, all knowledge retrieval in agent and rag mode,
+    since agent mode falls back to it when no clear intention is detected.
+    """
+    chatbot_config = state["chatbot_config"]
+    if not chatbot_config["speculative_execution_config"]["enabled"]:
+        return
+    chatbot_mode = chatbot_config["chatbot_mode"]
+    query = state["query"]
+    branches = {}
+    if chatbot_mode == ChatbotMode.agent:
+        query_key = chatbot_config["intention_config"].get("query_key", "query")
+        branches["intention_detection"] = (invoke_intention_detection, {**state, query_key: query})
+    if chatbot_mode in (ChatbotMode.agent, ChatbotMode.rag_mode):
+        branches["all_knowledge_retrieve"] = (invoke_all_knowledge_retrieve, dict(state))
+    if not branches:
+        return
+    cancel_event = threading.Event()
+    futures = []
+    with speculative_branches_lock:
+        speculative_messages[state["message_id"]] = (cancel_event, futures)
+    for node_name, (fn, branch_state) in branches.items():
+        future = speculative_executor.submit(run_speculative_branch, fn, branch_state, cancel_event)
+        with speculative_branches_lock:
+            futures.append(future)
+            speculative_branches[(state["message_id"], node_name)] = (query, time.time(), future)
+
+
+def run_speculative_branch(fn, state, cancel_event):
+    # the branch may have waited for a worker until its message was discarded
+    if cancel_event.is_set():
+        return None, time.time()
+    return fn(state), time.time()
+
+
+def take_speculative_result(state: ChatbotState, node_name: str, query: str):
+    """Claim the speculative result of a node.
+    The result is reused when the query the node runs on now equals, or is close enough to,
+    the query the branch was started with.
+
+    return: (hit, result), result is None on a miss
+    """
+    with speculative_branches_lock:
+        branch = speculative_branches.pop((state["message_id"], node_name), None)
+    if branch is None:
+        return False, None
+    speculative_query, start_time, future = branch
+    threshold = state["chatbot_config"]["speculative_execution_config"]["similarity_threshold"]
+    if query != speculative_query and SequenceMatcher(None, query, speculative_query).ratio() < threshold:
+        future.cancel()
+        logger.info(f"speculative {node_name} discarded, query changed: {speculative_query} -> {query}")
+        return False, None
+    claim_time = time.time()
+    try:
+        result, finish_time = future.result()
+    except Exception as e:
+        logger.warning(f"speculative {node_name} failed, run it again: {e}")
+        return False, None
+    # the part of the branch that ran before the node was reached is the latency saved
+    logger.info(f"speculative {node_name} reused, saved {min(claim_time, finish_time) - start_time:.2f}s")
+    return True, result
+
+
+def discard_speculative_branches(message_id: str):
+    """Discard the unclaimed branches of a message and wait for the ones still running,
+    so that no speculative work crosses the end of the invocation.
+    """
+    with speculative_branches_lock:
+        keys = [key for key in speculative_branches if key[0] == message_id]
+        branches = [speculative_branches.pop(key) for key in keys]
+        cancel_event, futures = speculative_messages.pop(message_id, (None, []))
+    if cancel_event is not None:
+        cancel_event.set()
+    for (_, node_name), (_, _, future) in zip(keys, branches):
+        future.cancel()
+        logger.info(f"speculative {node_name} not needed by the route, discarded")
+    # including the branches take_speculative_result discarded on a changed query
+    running = [future for future in futures if not future.done()]
+    if not running:
+        return
+    _, not_done = wait(running, timeout=SPECULATIVE_DISCARD_TIMEOUT)
+    if not_done:
+        logger.warning(
+            f"{len(not_done)} speculative branches of {message_id} still running after {SPECULATIVE_DISCARD_TIMEOUT}s"
+        )
+
+
+def invoke_intention_detection(state: ChatbotState):
+    return invoke_lambda(
+        lambda_module_path="lambda_intention_detection.intention",
+        lambda_name="Online_Intention_Detection",
+        handler_name="lambda_handler",
+        event_body=state,
+    )
+
+
+def invoke_all_knowledge_retrieve(state: ChatbotState):
+    retriever_params = {
+        **state["chatbot_config"]["rag_config"]["retriever_config"],
+        "query": state["query"],
+    }
+    return invoke_lambda(
+        event_body=retriever_params,
+        lambda_name="Online_Function_Retriever",
+        lambda_module_path="functions.lambda_retriever.retriever",
+        handler_name="lambda_handler",
+    )
+
 ####################
 # nodes in lambdas #
 ####################
@@ -81,6 +210,7 @@ def get_common_system_prompt():
 
 @node_monitor_wrapper
 def query_preprocess_lambda(state: ChatbotState):
+    start_speculative_branches(state)
     output: str = invoke_lambda(
         event_body=state,
         lambda_name="Online_Query_Preprocess",
@@ -93,12 +223,10 @@ def query_preprocess_lambda(state: ChatbotState):
 
 @node_monitor_wrapper
 def intention_detection_lambda(state: ChatbotState):
-    intention_fewshot_examples = invoke_lambda(
-        lambda_module_path="lambda_intention_detection.intention",
-        lambda_name="Online_Intention_Detection",
-        handler_name="lambda_handler",
-        event_body=state,
-    )
+    query_key = state["chatbot_config"]["intention_config"].get("query_key", "query")
+    hit, intention_fewshot_examples = take_speculative_result(state, "intention_detection", state[query_key])
+    if not hit:
+        intention_fewshot_examples = invoke_intention_detection(state)
 
     # send trace
     send_trace(
@@ -280,14 +408,9 @@ def tool_execute_lambda(state: ChatbotState):
 @node_monitor_wrapper
 def rag_all_index_lambda(state: ChatbotState):
     # call retrivever
-    retriever_params = state["chatbot_config"]["rag_config"]["retriever_config"]
-    retriever_params["query"] = state["query"]
-    output: str = invoke_lambda(
-        event_body=retriever_params,
-        lambda_name="Online_Function_Retriever",
-        lambda_module_path="functions.lambda_retriever.retriever",
-        handler_name="lambda_handler",
-    )
+    hit, output = take_speculative_result(state, "all_knowledge_retrieve", state["query"])
+    if not hit:
+        output = invoke_all_knowledge_retrieve(state)
     contexts = [doc["page_content"] for doc in output["result"]["docs"]]
     return {"contexts": contexts}
 
@@ -679,24 +802,27 @@ def common_entry(event_body):
     valid_tool_calling_names = tool_manager.get_names_from_tools_with_parameters()
 
     # invoke graph and get results
-    response = app.invoke(
-        {
-            "stream": stream,
-            "chatbot_config": chatbot_config,
-            "query": query,
-            "enable_trace": enable_trace,
-            "trace_infos": [],
-            "message_id": message_id,
-            "chat_history": chat_history,
-            "agent_chat_history": [],
-            "ws_connection_id": ws_connection_id,
-            "debug_infos": {},
-            "extra_response": {},
-            "agent_recursion_limit": chatbot_config['agent_recursion_limit'],
-            "current_agent_recursion_num": 0,
-            "valid_tool_calling_names": valid_tool_calling_names
-        }
-    )
+    try:
+        response = app.invoke(
+            {
+                "stream": stream,
+                "chatbot_config": chatbot_config,
+                "query": query,
+                "enable_trace": enable_trace,
+                "trace_infos": [],
+                "message_id": message_id,
+                "chat_history": chat_history,
+                "agent_chat_history": [],
+                "ws_connection_id": ws_connection_id,
+                "debug_infos": {},
+                "extra_response": {},
+                "agent_recursion_limit": chatbot_config['agent_recursion_limit'],
+                "current_agent_recursion_num": 0,
+                "valid_tool_calling_names": valid_tool_calling_names
+            }
+        )
+    finally:
+        discard_speculative_branches(message_id)
 
     return {"answer": response["answer"], **response["extra_response"]}
 
@@ -1,6 +1,7 @@
 import collections.abc
 import copy
 import os
+from functools import lru_cache
 from common_logic.common_utils.constant import ChatbotMode
 
 # update nest dict
@@ -13,16 +14,21 @@ def update_nest_dict(d, u):
     return d
 
 
+@lru_cache()
+def load_default_llm_config(default_llm_config_str):
+    """default_llm_config from env, or default_llm_config_str, parsed once per container.
+    Callers must copy it before editing it."""
+    return eval(
+        os.environ.get("default_llm_config", default_llm_config_str)
+    )
+
+
 def parse_common_entry_config(chatbot_config):
     chatbot_config = copy.deepcopy(chatbot_config)
     default_llm_config_str = "{'model_id': 'anthropic.claude-3-sonnet-20240229-v1:0', 'model_kwargs': {'temperature': 0.0, 'max_tokens': 4096}}"
     # get default_llm_kwargs from env
-    default_llm_config = eval(
-        os.environ.get("default_llm_config", default_llm_config_str)
-    )
-
     default_llm_config = {
-        **default_llm_config,
+        **load_default_llm_config(default_llm_config_str),
         **chatbot_config.get("default_llm_config", {}),
     }
 
@@ -46,6 +52,12 @@ def parse_common_entry_config(chatbot_config):
         "query_process_config": {
             "conversation_query_rewrite_config": {**copy.deepcopy(default_llm_config)}
         },
+        # run intention detection and retrieval on the raw query while it is rewritten,
+        # results are reused if the rewritten query is at least similarity_threshold similar
+        "speculative_execution_config": {
+            "enabled": False,
+            "similarity_threshold": 0.9,
+        },
         "intention_config": {
             "retrievers": [
                 {
@@ -136,9 +148,8 @@ def parse_common_entry_config(chatbot_config):
             }
         },
     }
-    chatbot_config = update_nest_dict(
-        copy.deepcopy(default_chatbot_config), chatbot_config
-    )
+    # default_chatbot_config is built for this call, it needs no copy
+    chatbot_config = update_nest_dict(default_chatbot_config, chatbot_config)
 
     # add default tools
     tools: list = chatbot_config["agent_config"]["tools"]
@@ -157,12 +168,8 @@ def parse_retail_entry_config(chatbot_config):
     chatbot_config = copy.deepcopy(chatbot_config)
     default_llm_config_str = "{'model_id': 'anthropic.claude-3-sonnet-20240229-v1:0', 'model_kwargs': {'temperature': 0.1, 'max_tokens': 4096}}"
     # get default_llm_kwargs from env
-    default_llm_config = eval(
-        os.environ.get("default_llm_config", default_llm_config_str)
-    )
-
     default_llm_config = {
-        **default_llm_config,
+        **load_default_llm_config(default_llm_config_str),
         **chatbot_config.get("default_llm_config", {}),
     }
 
@@ -370,9 +377,8 @@ def parse_retail_entry_config(chatbot_config):
             }
         },
     }
-    chatbot_config = update_nest_dict(
-        copy.deepcopy(default_chatbot_config), chatbot_config
-    )
+    # default_chatbot_config is built for this call, it needs no copy
+    chatbot_config = update_nest_dict(default_chatbot_config, chatbot_config)
 
     # add default tools
     tools: list = chatbot_config["agent_config"]["tools"]
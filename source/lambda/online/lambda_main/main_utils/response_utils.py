@@ -3,7 +3,7 @@ import logging
 import time
 import traceback
 from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory
-from common_logic.common_utils.websocket_utils import send_to_ws_client
+from common_logic.common_utils.websocket_utils import BufferedWebsocketSender, send_to_ws_client
 from common_logic.common_utils.constant import StreamMessageType
 logger = logging.getLogger("response_utils")
 
@@ -20,15 +20,13 @@ def write_chat_history_to_ddb(
         entry_type,
         additional_kwargs=None,
         ):
-    ddb_obj.add_user_message(
-                f"user_{message_id}", custom_message_id, entry_type, query, additional_kwargs
-            )
-    ddb_obj.add_ai_message(
-        f"ai_{message_id}",
+    # written in the background, the lambda handler flushes the history before returning
+    ddb_obj.add_turn(
+        message_id,
         custom_message_id,
         entry_type,
+        query,
         answer,
-        input_message_id=f"user_{message_id}",
         additional_kwargs=additional_kwargs
     )
 
@@ -91,29 +89,33 @@ def stream_response(event_body:dict, response:dict):
 
         filter_sentence_fn = lambda x: x
 
-        for i, chunk in enumerate(answer):
-            if i == 0 and log_first_token_time:
-                first_token_time = time.time()
-                
-                logger.info(
-                    f"{custom_message_id} running time of first token whole {entry_type} entry: {first_token_time-request_timestamp}s"
-                )
-            chunk = filter_sentence_fn(chunk)
-            send_to_ws_client(message={
-                    "message_type": StreamMessageType.CHUNK,
-                    "message_id": f"ai_{message_id}",
-                    "custom_message_id": custom_message_id,
-                    "message": {
-                        "role": "assistant",
-                        "content": chunk,
-                        # "knowledge_sources": sources,
-                    },
-                    "chunk_id": i,
-                },
-                ws_connection_id=ws_connection_id
-            )
-
-            answer_str += chunk
+        # chunks are coalesced and sent from a background thread, generation never waits on the socket
+        ws_sender = BufferedWebsocketSender(
+            ws_connection_id,
+            message_template={
+                "message_type": StreamMessageType.CHUNK,
+                "message_id": f"ai_{message_id}",
+                "custom_message_id": custom_message_id,
+            },
+            request_timestamp=request_timestamp
+        )
+        try:
+            for i, chunk in enumerate(answer):
+                if i == 0 and log_first_token_time:
+                    first_token_time = time.time()
+
+                    logger.info(
+                        f"{custom_message_id} running time of first token whole {entry_type} entry: {first_token_time-request_timestamp}s"
+                    )
+                chunk = filter_sentence_fn(chunk)
+                ws_sender.push(chunk)
+
+                answer_str += chunk
+        except BaseException:
+            # keep the generation error, a stored send error would replace it
+            ws_sender.close(raise_error=False)
+            raise
+        ws_sender.close()
 
         if log_first_token_time:
             logger.info(
@@ -0,0 +1,138 @@
+"""Tests of the write-behind chat history against the local DynamoDB stub.
+
+Checks that a turn written with add_turn in one TransactWriteItems leaves the
+same messages and session as add_user_message and add_ai_message did, that
+throttled or conflicting transactions are retried and that invalid ones are
+not, and compares the time write_chat_history_to_ddb holds the response with
+a fixed DynamoDB latency.
+
+    cd source/lambda/online && python lambda_main/test/chat_history_writer_test.py
+"""
+import os
+import sys
+import time
+
+sys.path.extend([".", "lambda_main/test"])
+
+from ddb_local_stub import DynamoDBStub
+
+stub = DynamoDBStub().start()
+os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = stub.endpoint_url
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+# retries are left to the chat history writer
+os.environ["AWS_MAX_ATTEMPTS"] = "1"
+
+from common_logic.common_utils import ddb_utils
+from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory, flush_chat_history
+from lambda_main.main_utils.response_utils import write_chat_history_to_ddb
+
+SESSIONS_TABLE = "sessions"
+MESSAGES_TABLE = "messages"
+
+stub.create_table(SESSIONS_TABLE, "sessionId", "userId")
+stub.create_table(
+    MESSAGES_TABLE, "messageId", "sessionId", indexes={"bySessionId": ("sessionId", "createTimestamp")}
+)
+ddb_utils.chat_history_writer.base_delay = 0.001
+
+
+def make_history(session_id):
+    return DynamoDBChatMessageHistory(
+        sessions_table_name=SESSIONS_TABLE,
+        messages_table_name=MESSAGES_TABLE,
+        session_id=session_id,
+        user_id="user",
+        client_type="test_client",
+    )
+
+
+def previous_write(history, query, answer, message_id, additional_kwargs):
+    history.add_user_message(f"user_{message_id}", "custom", "common", query, additional_kwargs)
+    history.add_ai_message(
+        f"ai_{message_id}", "custom", "common", answer,
+        input_message_id=f"user_{message_id}", additional_kwargs=additional_kwargs,
+    )
+
+
+def without_timestamps(item):
+    timestamps = {"createTimestamp", "lastModifiedTimestamp", "startTime"}
+    return {key: value for key, value in item.items() if key not in timestamps and key != "sessionId"}
+
+
+def test_turn_matches_previous_writes():
+    previous, new = make_history("previous"), make_history("new")
+    for turn in range(2):
+        kwargs = {"intent": "qa", "turn": turn}
+        previous_write(previous, f"question {turn}", f"answer {turn}", f"p{turn}", kwargs)
+        stub.reset_calls()
+        write_chat_history_to_ddb(f"question {turn}", f"answer {turn}", new, f"p{turn}", "custom", "common", kwargs)
+        assert flush_chat_history(timeout=5)
+        assert dict(stub.calls) == {"TransactWriteItems": 1}, stub.calls
+
+    assert [without_timestamps(m) for m in previous.messages] == [without_timestamps(m) for m in new.messages]
+    previous_session, new_session = previous.session, new.session
+    assert without_timestamps(previous_session) == without_timestamps(new_session)
+    # the session keeps its start time over turns
+    assert new_session["startTime"] == new_session["createTimestamp"] < new_session["lastModifiedTimestamp"]
+    messages = new.messages
+    assert [m["role"] for m in messages] == ["human", "ai", "human", "ai"], messages
+
+
+def test_retry_and_failure():
+    history = make_history("retry")
+    writer = ddb_utils.chat_history_writer
+    retries, failures = writer.stats["retries"], writer.stats["failures"]
+    stub.fail_next(
+        "TransactWriteItems", "TransactionCanceledException", count=2,
+        CancellationReasons=[{"Code": "TransactionConflict"}, {"Code": "None"}, {"Code": "None"}],
+    )
+    stub.fail_next("TransactWriteItems", "ProvisionedThroughputExceededException")
+    history.add_turn("r1", "custom", "common", "question", "answer")
+    assert flush_chat_history(timeout=5)
+    assert writer.stats["retries"] == retries + 3
+    assert len(history.messages) == 2
+
+    stub.fail_next(
+        "TransactWriteItems", "TransactionCanceledException",
+        CancellationReasons=[{"Code": "ValidationError"}, {"Code": "None"}, {"Code": "None"}],
+    )
+    history.add_turn("r2", "custom", "common", "question", "answer")
+    assert flush_chat_history(timeout=5)
+    assert writer.stats["failures"] == failures + 1
+    assert writer.stats["retries"] == retries + 3
+    assert len(history.messages) == 2
+
+
+def time_response_hold(write, latency, repeat=20):
+    stub.latency = latency
+    start = time.perf_counter()
+    for i in range(repeat):
+        write(i)
+    held = (time.perf_counter() - start) / repeat
+    flush_chat_history(timeout=30)
+    stub.latency = 0
+    return held
+
+
+if __name__ == "__main__":
+    test_turn_matches_previous_writes()
+    test_retry_and_failure()
+    print("tests passed")
+
+    history = make_history("timing")
+    latency = 0.01
+    previous_held = time_response_hold(
+        lambda i: previous_write(history, "question", "answer", f"t{i}", {}), latency
+    )
+    stub.reset_calls()
+    new_held = time_response_hold(
+        lambda i: write_chat_history_to_ddb("question", "answer", history, f"n{i}", "custom", "common", {}), latency
+    )
+    print(
+        f"DynamoDB latency {latency * 1000:.0f}ms: response held {previous_held * 1000:.1f}ms by "
+        f"the previous writes, {new_held * 1000:.2f}ms by write-behind, requests per turn: "
+        f"{sum(stub.calls.values()) / 20:.0f}"
+    )
+    stub.stop()
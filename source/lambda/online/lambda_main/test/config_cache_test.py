@@ -0,0 +1,173 @@
+"""Tests of the config-plane cache against the local DynamoDB stub.
+
+Checks that workspaces and prompt templates are read from DynamoDB once per
+ttl, that a prompt written through the prompt_management lambda, or a
+workspace re-ingested by a job, is seen once its version stamp is read again,
+that missing workspaces are never cached, and reports
+the DynamoDB reads of the config lookups of a request with and without the
+cache.
+
+    cd source/lambda/online && python lambda_main/test/config_cache_test.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.extend([".", "lambda_main/test", "../prompt_management"])
+
+from ddb_local_stub import DynamoDBStub
+
+stub = DynamoDBStub().start()
+os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = stub.endpoint_url
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ["prompt_table_name"] = os.environ["PROMPT_TABLE_NAME"] = "prompt"
+STAMP_TTL = 0.2
+os.environ["config_cache_stamp_ttl"] = str(STAMP_TTL)
+
+stub.create_table("prompt", "userId", "sortKey")
+stub.create_table("workspace", "workspace_id", "object_type")
+
+import boto3
+import prompt_management
+from common_logic.common_utils.cache_utils import ConfigCache, config_cache
+from common_logic.common_utils.constant import LLMTaskType
+from common_logic.common_utils.prompt_utils import get_prompt_templates_from_ddb
+from common_logic.common_utils.workspace_utils import WorkspaceManager
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+workspace_table = boto3.resource("dynamodb").Table("workspace")
+workspace_manager = WorkspaceManager(workspace_table)
+
+
+def put_prompt(user_id, task_type, prompt):
+    event = {
+        "requestContext": {
+            "authorizer": {
+                "authorizerType": "lambda_authorizer",
+                "claims": json.dumps({"cognito:username": user_id}),
+            }
+        },
+        "httpMethod": "POST",
+        "resource": "/prompt",
+        "body": json.dumps({"model_id": MODEL_ID, "task_type": task_type, "prompt": prompt}),
+    }
+    assert prompt_management.lambda_handler(event, None)["statusCode"] == 200
+
+
+def request_config_lookups(user_id):
+    """Config lookups of a rag request: retrieval workspaces, then the prompts of the llm nodes"""
+    workspaces = [workspace_manager.get_workspace(workspace_id) for workspace_id in ["docs", "faq", "missing"]]
+    prompts = [
+        get_prompt_templates_from_ddb(user_id, model_id=MODEL_ID, task_type=task_type)
+        for task_type in [LLMTaskType.CONVERSATION_SUMMARY_TYPE, LLMTaskType.RAG, LLMTaskType.CHAT]
+    ]
+    return workspaces, prompts
+
+
+def test_cache_and_invalidation():
+    workspace_manager.create_workspace_open_search("docs", "endpoint", "sagemaker", "bce", 768, ["zh"], ["pdf"])
+    workspace_manager.create_workspace_open_search("faq", "endpoint", "sagemaker", "bce", 768, ["zh"], ["faq"])
+    put_prompt("alice", LLMTaskType.RAG, {"system_prompt": "first"})
+    config_cache.clear()
+
+    stub.reset_calls()
+    workspaces, prompts = request_config_lookups("alice")
+    assert workspaces[0]["workspace_id"] == "docs" and workspaces[2] is None
+    assert prompts == [{}, {"system_prompt": "first"}, {}]
+    # 3 workspaces and their stamps, 3 prompts and the stamp of alice
+    assert stub.calls["GetItem"] == 10, stub.calls
+
+    stub.reset_calls()
+    workspaces[0]["workspace_id"] = "edited by a caller"
+    assert request_config_lookups("alice") == (
+        [workspace_manager.get_workspace("docs"), workspace_manager.get_workspace("faq"), None],
+        prompts,
+    )
+    # only the missing workspace is read again
+    assert stub.calls["GetItem"] == 1, stub.calls
+
+    put_prompt("alice", LLMTaskType.RAG, {"system_prompt": "second"})
+    put_prompt("alice", LLMTaskType.CHAT, {"system_prompt": "chat"})
+    assert request_config_lookups("alice")[1][1] == {"system_prompt": "first"}
+    time.sleep(STAMP_TTL)
+    stub.reset_calls()
+    assert request_config_lookups("alice")[1] == [{}, {"system_prompt": "second"}, {"system_prompt": "chat"}]
+    # the stamps, the missing workspace, then the prompts of alice again, the workspaces are still cached
+    assert stub.calls["GetItem"] == 8, stub.calls
+
+    # the stamp item is not listed as a prompt
+    listed = prompt_management.lambda_handler(
+        {
+            "requestContext": {
+                "authorizer": {
+                    "authorizerType": "lambda_authorizer",
+                    "claims": json.dumps({"cognito:username": "alice"}),
+                }
+            },
+            "httpMethod": "GET",
+            "resource": "/prompt",
+        },
+        None,
+    )
+    assert json.loads(listed["body"])["Count"] == 2, listed
+
+
+def test_workspace_invalidation():
+    config_cache.clear()
+    generation = workspace_manager.get_workspace("docs")["updated_at"]
+    # touch_workspace of the ingestion job after re-ingesting the index
+    workspace_table.update_item(
+        Key={"workspace_id": "docs", "object_type": "workspace"},
+        UpdateExpression="SET updated_at = :uat",
+        ExpressionAttributeValues={":uat": "2100-01-01T00:00:00.000000Z"},
+    )
+    assert workspace_manager.get_workspace("docs")["updated_at"] == generation
+    time.sleep(STAMP_TTL)
+    assert workspace_manager.get_workspace("docs")["updated_at"] == "2100-01-01T00:00:00.000000Z"
+
+    # a workspace created after a lookup found nothing is seen at once
+    assert workspace_manager.get_workspace("created_later") is None
+    workspace_manager.create_workspace_open_search("created_later", "endpoint", "sagemaker", "bce", 768, ["zh"], ["pdf"])
+    assert workspace_manager.get_workspace("created_later")["workspace_id"] == "created_later"
+
+
+def test_negative_ttl():
+    cache = ConfigCache(ttl=60, negative_ttl=0.1)
+    reads = []
+
+    def load():
+        reads.append(1)
+        return None
+
+    assert cache.get("workspace", "missing", load) is None
+    assert cache.get("workspace", "missing", load) is None
+    time.sleep(0.1)
+    assert cache.get("workspace", "missing", load) is None
+    assert len(reads) == 2
+    assert cache.stats()["negative_hits"] == 1
+
+
+if __name__ == "__main__":
+    test_cache_and_invalidation()
+    test_workspace_invalidation()
+    test_negative_ttl()
+    print("tests passed")
+
+    num_requests = 20
+    users = [f"user_{i}" for i in range(5)]
+    config_cache.clear()
+    stub.reset_calls()
+    stats = config_cache.stats()
+    for i in range(num_requests):
+        request_config_lookups(users[i % len(users)])
+    request_stats = config_cache.stats_since(stats)
+    lookups = request_stats["misses"] + request_stats["hits"] + request_stats["negative_hits"]
+    print(
+        f"{num_requests} requests of {len(users)} users, {lookups / num_requests:.0f} config lookups per request: "
+        f"{lookups / num_requests:.0f} DynamoDB reads per request without the cache, "
+        f"{stub.calls['GetItem'] / num_requests:.2f} with it"
+    )
+    stub.stop()
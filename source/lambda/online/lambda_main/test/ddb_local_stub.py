@@ -0,0 +1,313 @@
+"""In-process DynamoDB-compatible stub for tests and benchmarks.
+
+Serves the DynamoDB JSON protocol over HTTP, so that boto3 clients and
+resources run unchanged against it, e.g. with AWS_ENDPOINT_URL_DYNAMODB set
+to stub.endpoint_url before boto3 is used. Supported operations and
+expressions are the subset used by the online lambdas: GetItem, PutItem,
+UpdateItem (SET with if_not_exists), DeleteItem, Query (on a table or global
+secondary index, with Limit, ScanIndexForward, ExclusiveStartKey,
+ProjectionExpression, a single comparison FilterExpression and pages of
+1 MB), BatchGetItem, BatchWriteItem and TransactWriteItems.
+
+Every request is counted per operation in stub.calls, and the items returned
+by queries in stub.items_read. stub.latency adds a
+fixed delay per request, stub.fail_next() makes the next requests of an
+operation fail, and stub.unprocessed_next() leaves items of the next
+BatchWriteItem unprocessed.
+"""
+import collections
+import json
+import re
+import threading
+import time
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUERY_PAGE_BYTES = 1024 * 1024
+
+
+class DynamoDBError(Exception):
+    def __init__(self, code, message="", **fields):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.fields = fields
+
+
+def _key_value(attribute):
+    """Comparable python value of a typed attribute value"""
+    (type_name, value), = attribute.items()
+    if type_name == "N":
+        return Decimal(value)
+    return value
+
+
+class Table:
+    def __init__(self, name, hash_key, range_key=None, indexes=None):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        # index name -> (hash key, range key)
+        self.indexes = indexes or {}
+        self.items = {}
+
+    def key_of(self, item):
+        key = (_key_value(item[self.hash_key]),)
+        if self.range_key:
+            key += (_key_value(item[self.range_key]),)
+        return key
+
+
+class DynamoDBStub:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.calls = collections.Counter()
+        self.items_read = 0
+        self._failures = collections.defaultdict(collections.deque)
+        self._unprocessed = collections.deque()
+        self._lock = threading.RLock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def create_table(self, name, hash_key, range_key=None, indexes=None):
+        self.tables[name] = Table(name, hash_key, range_key, indexes)
+        return self.tables[name]
+
+    def fail_next(self, operation, code, count=1, **fields):
+        """Fail the next count requests of operation with the error code and extra error fields"""
+        for _ in range(count):
+            self._failures[operation].append(DynamoDBError(code, f"injected {code}", **fields))
+
+    def unprocessed_next(self, num_items):
+        """Leave the last num_items requests of the next BatchWriteItem unprocessed"""
+        self._unprocessed.append(num_items)
+
+    def reset_calls(self):
+        self.calls.clear()
+        self.items_read = 0
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, Nagle would hold the body for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                operation = self.headers["X-Amz-Target"].split(".")[-1]
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+                if stub.latency:
+                    time.sleep(stub.latency)
+                try:
+                    status, payload = 200, stub.handle(operation, body)
+                except DynamoDBError as e:
+                    status = 400
+                    payload = {
+                        "__type": f"com.amazonaws.dynamodb.v20120810#{e.code}",
+                        "message": e.message,
+                        **e.fields,
+                    }
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/x-amz-json-1.0")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, operation, body):
+        with self._lock:
+            self.calls[operation] += 1
+            if self._failures[operation]:
+                raise self._failures[operation].popleft()
+            handler = getattr(self, f"_op_{operation}", None)
+            if handler is None:
+                raise DynamoDBError("UnknownOperationException", operation)
+            return handler(body)
+
+    def _table(self, name):
+        if name not in self.tables:
+            raise DynamoDBError("ResourceNotFoundException", f"table {name} not found")
+        return self.tables[name]
+
+    @staticmethod
+    def _project(item, request):
+        expression = request.get("ProjectionExpression")
+        if not expression:
+            return item
+        names = request.get("ExpressionAttributeNames", {})
+        attributes = [names.get(name.strip(), name.strip()) for name in expression.split(",")]
+        return {name: item[name] for name in attributes if name in item}
+
+    def _op_GetItem(self, body):
+        table = self._table(body["TableName"])
+        item = table.items.get(table.key_of(body["Key"]))
+        return {"Item": self._project(item, body)} if item else {}
+
+    def _op_PutItem(self, body):
+        table = self._table(body["TableName"])
+        table.items[table.key_of(body["Item"])] = body["Item"]
+        return {}
+
+    def _op_DeleteItem(self, body):
+        table = self._table(body["TableName"])
+        table.items.pop(table.key_of(body["Key"]), None)
+        return {}
+
+    def _op_UpdateItem(self, body):
+        table = self._table(body["TableName"])
+        key = table.key_of(body["Key"])
+        item = dict(table.items.get(key, body["Key"]))
+        names = body.get("ExpressionAttributeNames", {})
+        values = body.get("ExpressionAttributeValues", {})
+        expression = body["UpdateExpression"].strip()
+        if not expression.upper().startswith("SET "):
+            raise DynamoDBError("ValidationException", f"unsupported update expression {expression}")
+        for clause in re.split(r",\s*(?![^()]*\))", expression[4:]):
+            name, value = [part.strip() for part in clause.split("=", 1)]
+            name = names.get(name, name)
+            match = re.fullmatch(r"if_not_exists\(\s*([#\w]+)\s*,\s*(:\w+)\s*\)", value)
+            if match:
+                if name not in item:
+                    item[name] = values[match.group(2)]
+            else:
+                item[name] = values[value]
+        table.items[key] = item
+        return {"Attributes": item} if body.get("ReturnValues", "NONE") != "NONE" else {}
+
+    def _op_Query(self, body):
+        table = self._table(body["TableName"])
+        hash_key, range_key = table.hash_key, table.range_key
+        if body.get("IndexName"):
+            hash_key, range_key = table.indexes[body["IndexName"]]
+        names = body.get("ExpressionAttributeNames", {})
+        values = body["ExpressionAttributeValues"]
+        conditions = re.split(r"\s+and\s+", body["KeyConditionExpression"], flags=re.IGNORECASE)
+        filters = []
+        for condition in conditions:
+            match = re.fullmatch(r"\s*([#\w]+)\s*(=|<=|>=|<|>)\s*(:\w+)\s*", condition)
+            if not match:
+                raise DynamoDBError("ValidationException", f"unsupported key condition {condition}")
+            filters.append((names.get(match.group(1), match.group(1)), match.group(2), _key_value(values[match.group(3)])))
+        compare = {
+            "=": lambda a, b: a == b,
+            "<>": lambda a, b: a != b,
+            "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b,
+            ">": lambda a, b: a > b,
+            ">=": lambda a, b: a >= b,
+        }
+        items = [
+            item
+            for item in table.items.values()
+            if all(name in item and compare[op](_key_value(item[name]), value) for name, op, value in filters)
+        ]
+        if range_key:
+            items.sort(key=lambda item: _key_value(item[range_key]), reverse=not body.get("ScanIndexForward", True))
+
+        def position(item):
+            return table.key_of(item) + ((_key_value(item[range_key]),) if range_key else ())
+
+        if body.get("ExclusiveStartKey"):
+            start = body["ExclusiveStartKey"]
+            start_position = table.key_of(start) + ((_key_value(start[range_key]),) if range_key else ())
+            positions = [position(item) for item in items]
+            items = items[positions.index(start_position) + 1:] if start_position in positions else []
+        response = {}
+        limit = body.get("Limit")
+        if limit is None or limit > len(items):
+            limit = len(items)
+        # like DynamoDB, a page ends once 1 MB of items is read
+        size = 0
+        for i, item in enumerate(items[:limit]):
+            size += len(json.dumps(item))
+            if size >= QUERY_PAGE_BYTES:
+                limit = i + 1
+                break
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            key_names = {table.hash_key, table.range_key, hash_key, range_key} - {None}
+            response["LastEvaluatedKey"] = {name: last[name] for name in key_names}
+        self.items_read += len(items)
+        scanned_count = len(items)
+        # a filter applies to the items read, after Limit
+        if body.get("FilterExpression"):
+            match = re.fullmatch(r"\s*([#\w]+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)\s*", body["FilterExpression"])
+            if not match:
+                raise DynamoDBError("ValidationException", f"unsupported filter {body['FilterExpression']}")
+            name, op, value = names.get(match.group(1), match.group(1)), match.group(2), _key_value(values[match.group(3)])
+            items = [item for item in items if name in item and compare[op](_key_value(item[name]), value)]
+        if body.get("Select") == "COUNT":
+            return {"Count": len(items), "ScannedCount": scanned_count, **response}
+        response["Items"] = [self._project(item, body) for item in items]
+        response["Count"] = len(items)
+        response["ScannedCount"] = scanned_count
+        return response
+
+    def _op_BatchGetItem(self, body):
+        responses = {}
+        for table_name, request in body["RequestItems"].items():
+            table = self._table(table_name)
+            found = [table.items.get(table.key_of(key)) for key in request["Keys"]]
+            responses[table_name] = [self._project(item, request) for item in found if item]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def _op_BatchWriteItem(self, body):
+        requests = [
+            (table_name, request)
+            for table_name, table_requests in body["RequestItems"].items()
+            for request in table_requests
+        ]
+        num_unprocessed = self._unprocessed.popleft() if self._unprocessed else 0
+        processed = requests[: len(requests) - num_unprocessed]
+        unprocessed = collections.defaultdict(list)
+        for table_name, request in requests[len(processed):]:
+            unprocessed[table_name].append(request)
+        for table_name, request in processed:
+            table = self._table(table_name)
+            if "PutRequest" in request:
+                item = request["PutRequest"]["Item"]
+                table.items[table.key_of(item)] = item
+            else:
+                table.items.pop(table.key_of(request["DeleteRequest"]["Key"]), None)
+        return {"UnprocessedItems": dict(unprocessed)}
+
+    def _op_TransactWriteItems(self, body):
+        # apply to copies first, a transaction is all or nothing
+        saved = {name: dict(table.items) for name, table in self.tables.items()}
+        try:
+            for action in body["TransactItems"]:
+                (action_type, request), = action.items()
+                if action_type == "Put":
+                    self._op_PutItem(request)
+                elif action_type == "Update":
+                    self._op_UpdateItem(request)
+                elif action_type == "Delete":
+                    self._op_DeleteItem(request)
+                else:
+                    raise DynamoDBError("ValidationException", f"unsupported action {action_type}")
+        except Exception:
+            for name, items in saved.items():
+                self.tables[name].items = items
+            raise
+        return {}
@@ -0,0 +1,176 @@
+"""Benchmark of windowed chat history loading against the local DynamoDB stub.
+
+messages_as_langchain is compared with the previous full-session query over
+sessions of 10, 1,000 and 10,000 messages: cold (nothing cached in the
+container) and warm (the session is cached and one turn was added since).
+The stub serves pages of 1 MB like DynamoDB, the previous query read only the
+first page of a long session. The items read are reported besides the time,
+since the stub itself filters the whole session on every query.
+
+    cd source/lambda/online && python lambda_main/test/history_window_benchmark.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.extend([".", "lambda_main/test"])
+
+from ddb_local_stub import DynamoDBError, DynamoDBStub
+
+stub = DynamoDBStub().start()
+os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = stub.endpoint_url
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from common_logic.common_utils.constant import MessageType
+from common_logic.common_utils.ddb_utils import DynamoDBChatMessageHistory, chat_history_cache
+
+MESSAGES_TABLE = "messages"
+WINDOW = 20
+LATENCY = 0.002
+
+table = stub.create_table(
+    MESSAGES_TABLE,
+    "messageId",
+    "sessionId",
+    indexes={
+        "bySessionId": ("sessionId", None),
+        "bySessionIdAndTimestamp": ("sessionId", "createTimestamp"),
+    },
+)
+
+
+def make_history(session_id, window=WINDOW):
+    return DynamoDBChatMessageHistory(
+        sessions_table_name="sessions",
+        messages_table_name=MESSAGES_TABLE,
+        session_id=session_id,
+        user_id="user",
+        client_type="test_client",
+        history_window=window,
+    )
+
+
+def add_message(session_id, index):
+    role = MessageType.HUMAN_MESSAGE_TYPE if index % 2 == 0 else MessageType.AI_MESSAGE_TYPE
+    timestamp = f"2024-01-01T00:00:00.{index:06d}Z"
+    item = {
+        "messageId": f"{session_id}_{index}",
+        "sessionId": session_id,
+        "role": role,
+        "customMessageId": "",
+        "inputMessageId": "",
+        "entryType": "common",
+        "content": f"message {index} " + "lorem ipsum dolor sit amet " * 25,
+        "createTimestamp": timestamp,
+        "lastModifiedTimestamp": timestamp,
+        "additional_kwargs": json.dumps({"intent": "qa"}),
+    }
+    typed = {name: {"S": value} for name, value in item.items()}
+    table.items[table.key_of(typed)] = typed
+
+
+def previous_messages_as_langchain(history):
+    """messages_as_langchain before the history window"""
+    response = history.messages_table.query(
+        KeyConditionExpression="sessionId = :session_id",
+        ExpressionAttributeValues={":session_id": history.session_id},
+        IndexName=history.MESSAGE_BY_SESSION_ID_INDEX_NAME,
+    )
+    items = sorted(response.get("Items", []), key=lambda x: x["createTimestamp"])
+    return [history._as_langchain(item) for item in items]
+
+
+def timed(load, repeat):
+    stub.reset_calls()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        messages = load()
+    return messages, (time.perf_counter() - start) / repeat, stub.items_read / repeat
+
+
+def test_window_matches_full_history():
+    session_id = "exact"
+    for i in range(7):
+        add_message(session_id, i)
+    # a window starting with an answer drops it
+    assert [m["additional_kwargs"]["message_id"] for m in make_history(session_id, 4).messages_as_langchain] == [
+        "exact_4", "exact_5", "exact_6"
+    ]
+    chat_history_cache.clear()
+    full = make_history(session_id, 0).messages_as_langchain
+    assert full == previous_messages_as_langchain(make_history(session_id))
+    assert full[0]["role"] == MessageType.HUMAN_MESSAGE_TYPE
+
+    # the cached window is extended with the new messages only
+    history = make_history(session_id, 4)
+    history.messages_as_langchain[-1]["content"] = "edited by a chain"
+    add_message(session_id, 7)
+    stub.reset_calls()
+    messages = history.messages_as_langchain
+    assert stub.calls["Query"] == 1
+    assert [m["additional_kwargs"]["message_id"] for m in messages] == [f"exact_{i}" for i in range(4, 8)]
+    assert messages == full[4:] + previous_messages_as_langchain(history)[7:]
+
+    # tables without the index read the whole session
+    chat_history_cache.clear()
+    history.MESSAGE_BY_SESSION_ID_AND_TIMESTAMP_INDEX_NAME = "missing"
+    original_query = stub._op_Query
+
+    def query(body):
+        if body.get("IndexName") == "missing":
+            raise DynamoDBError("ValidationException", "The table does not have the specified index")
+        return original_query(body)
+
+    stub._op_Query = query
+    try:
+        assert history.messages_as_langchain == messages
+    finally:
+        stub._op_Query = original_query
+    chat_history_cache.clear()
+
+
+if __name__ == "__main__":
+    test_window_matches_full_history()
+    print("tests passed")
+
+    stub.latency = LATENCY
+    print(f"window {WINDOW} messages, DynamoDB latency {LATENCY * 1000:.0f}ms")
+    for num_messages in [10, 1000, 10000]:
+        session_id = f"session_{num_messages}"
+        for i in range(num_messages):
+            add_message(session_id, i)
+        history = make_history(session_id)
+        repeat = 3 if num_messages > 1000 else 10
+
+        previous, previous_time, previous_items = timed(lambda: previous_messages_as_langchain(history), repeat)
+
+        def cold():
+            chat_history_cache.clear()
+            return history.messages_as_langchain
+
+        windowed, cold_time, cold_items = timed(cold, repeat)
+        assert windowed == cold()
+        next_index = num_messages
+
+        def warm():
+            global next_index
+            add_message(session_id, next_index)
+            add_message(session_id, next_index + 1)
+            next_index += 2
+            return history.messages_as_langchain
+
+        warm_messages, warm_time, warm_items = timed(warm, repeat)
+        chat_history_cache.clear()
+        assert warm_messages == history.messages_as_langchain
+
+        print(
+            f"  {num_messages:>6} messages: previous {previous_time * 1000:7.1f}ms "
+            f"({previous_items:.0f} items read, last window "
+            f"{'complete' if previous[-WINDOW:] == windowed else 'wrong'}), "
+            f"windowed cold {cold_time * 1000:5.1f}ms ({cold_items:.0f} items read), "
+            f"warm {warm_time * 1000:5.1f}ms ({warm_items:.0f} items read)"
+        )
+    stub.stop()
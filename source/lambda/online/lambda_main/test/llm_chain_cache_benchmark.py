@@ -0,0 +1,106 @@
+"""Micro-benchmark of per-call LLM chain construction and chatbot config parsing.
+
+Chains are built for a Bedrock and a SageMaker model as lambda_llm_generate
+does on every call: uncached with a new boto3 client each time as before,
+uncached with the shared boto3 client, and from the chain cache.
+parse_common_entry_config is timed with the default llm config parsed on every
+call as before, and parsed once. Nothing is sent to AWS.
+
+    cd source/lambda/online && python lambda_main/test/llm_chain_cache_benchmark.py
+"""
+import os
+import sys
+import time
+import warnings
+
+sys.path.extend(["."])
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+warnings.filterwarnings("ignore")
+
+from common_logic.common_utils.constant import LLMModelType, LLMTaskType
+from lambda_llm_generate.llm_generate_utils import LLMChain
+from lambda_llm_generate.llm_generate_utils import llm_models
+from lambda_main.main_utils.parse_config import load_default_llm_config, parse_common_entry_config
+
+LLM_CONFIGS = {
+    "bedrock rag": {
+        "model_id": LLMModelType.CLAUDE_3_SONNET,
+        "intent_type": LLMTaskType.RAG,
+        "model_kwargs": {"temperature": 0.01, "max_tokens": 1000},
+        "stream": True,
+        "system_prompt": "You are a customer service agent.\n<docs>\n{context}\n</docs>",
+    },
+    "sagemaker chat": {
+        "model_id": LLMModelType.INTERNLM2_CHAT_20B,
+        "intent_type": LLMTaskType.CHAT,
+        "model_kwargs": {"temperature": 0.1},
+        "stream": False,
+        "endpoint_name": "internlm2-chat-20b",
+    },
+}
+
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def build_uncached(llm_config, shared_clients):
+    if not shared_clients:
+        llm_models._boto3_clients.clear()
+    chain_cls = LLMChain.model_map[LLMChain._get_chain_id(llm_config["model_id"], llm_config["intent_type"])]
+    kwargs = {k: v for k, v in llm_config.items() if k not in ("model_id", "intent_type", "model_kwargs")}
+    return chain_cls.create_chain(model_kwargs=dict(llm_config["model_kwargs"]), **kwargs)
+
+
+def test_cached_chains():
+    LLMChain.chain_cache.clear()
+    for llm_config in LLM_CONFIGS.values():
+        chain = LLMChain.get_chain(**llm_config)
+        assert LLMChain.get_chain(**llm_config) is chain
+        changed = {**llm_config, "model_kwargs": {**llm_config["model_kwargs"], "temperature": 0.5}}
+        assert LLMChain.get_chain(**changed) is not chain
+    # key order does not matter
+    config = LLM_CONFIGS["bedrock rag"]
+    reordered = dict(reversed(list(config.items())))
+    reordered["model_kwargs"] = dict(reversed(list(config["model_kwargs"].items())))
+    assert LLMChain.get_chain(**reordered) is LLMChain.get_chain(**config)
+    # arguments that are not json serializable are built every time
+    assert LLMChain.get_chain(**config, callback=object()) is not LLMChain.get_chain(**config, callback=object())
+
+
+if __name__ == "__main__":
+    test_cached_chains()
+    print("tests passed")
+
+    repeat = 50
+    for name, llm_config in LLM_CONFIGS.items():
+        before = best_time(lambda: build_uncached(llm_config, shared_clients=False), repeat)
+        shared = best_time(lambda: build_uncached(llm_config, shared_clients=True), repeat)
+        LLMChain.get_chain(**llm_config)
+        cached = best_time(lambda: LLMChain.get_chain(**llm_config), repeat)
+        print(
+            f"{name:<15} get_chain: {before * 1000:7.2f}ms with a new client, "
+            f"{shared * 1000:6.2f}ms with the shared client, {cached * 1000:6.3f}ms cached"
+        )
+
+    chatbot_config = {"chatbot_mode": "chat", "use_history": True}
+
+    def parse_every_call():
+        load_default_llm_config.cache_clear()
+        parse_common_entry_config(chatbot_config)
+
+    before = best_time(parse_every_call, 500)
+    after = best_time(lambda: parse_common_entry_config(chatbot_config), 500)
+    print(
+        f"parse_common_entry_config: {before * 1000:.3f}ms parsing the default llm config every call, "
+        f"{after * 1000:.3f}ms parsing it once"
+    )
@@ -0,0 +1,118 @@
+"""Latency benchmark of speculative execution in common_entry with stubbed nodes.
+
+Every lambda call is replaced by a sleep of a fixed latency, so the graph runs
+without any endpoint, LLM or DynamoDB access. Each scenario is run with
+speculative execution disabled and enabled.
+
+    cd source/lambda/online && python lambda_main/test/speculative_benchmark.py
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.extend([".", "../job/dep/llm_bot_dep"])
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from lambda_main.main_utils.online_entries import common_entry
+
+# seconds each stubbed lambda takes
+LATENCY = {
+    "lambda_query_preprocess.query_preprocess": 0.6,
+    "lambda_intention_detection.intention": 0.4,
+    "functions.lambda_retriever.retriever": 0.5,
+    "lambda_llm_generate.llm_generate": 0.3,
+}
+AGENT_LATENCY = 0.8
+REWRITTEN_QUERY = None
+# stubbed lambda calls running now
+running_calls = []
+running_calls_lock = threading.Lock()
+
+
+def stub_invoke_lambda(event_body, lambda_module_path=None, **kwargs):
+    with running_calls_lock:
+        running_calls.append(lambda_module_path)
+    try:
+        time.sleep(LATENCY[lambda_module_path])
+    finally:
+        with running_calls_lock:
+            running_calls.remove(lambda_module_path)
+    if lambda_module_path == "lambda_query_preprocess.query_preprocess":
+        return REWRITTEN_QUERY or event_body["query"]
+    if lambda_module_path == "lambda_intention_detection.intention":
+        return [{"query": "ec2 price", "score": 0.9, "name": "QA", "intent": "QA", "kwargs": {}}]
+    if lambda_module_path == "functions.lambda_retriever.retriever":
+        return {"result": {"docs": [{"page_content": "Amazon EC2 provides compute capacity."}]}}
+    return "answer"
+
+
+class StubAgent:
+    def invoke(self, state):
+        time.sleep(AGENT_LATENCY)
+        return {
+            "parse_tool_calling_ok": True,
+            "current_tool_calls": [{"name": "stub_final_response", "kwargs": {"response": "answer"}}],
+            "current_agent_recursion_num": state["current_agent_recursion_num"] + 1,
+        }
+
+
+def run(chatbot_mode, speculative, intention_query_key="query", repeat=3):
+    elapsed = 0
+    for i in range(repeat):
+        event_body = {
+            "query": "什么是aws ec2",
+            "stream": False,
+            "custom_message_id": f"benchmark-{chatbot_mode}-{speculative}-{i}",
+            "ws_connection_id": None,
+            "chat_history": [],
+            "chatbot_config": {
+                "chatbot_mode": chatbot_mode,
+                "user_id": "benchmark",
+                "enable_trace": False,
+                "speculative_execution_config": {"enabled": speculative},
+                "intention_config": {"query_key": intention_query_key},
+            },
+        }
+        start = time.perf_counter()
+        common_entry.common_entry(event_body)
+        elapsed += time.perf_counter() - start
+        # the container may be frozen once the handler returns
+        assert not running_calls, running_calls
+    return elapsed / repeat
+
+
+def test_discarded_branches_end_with_the_invocation():
+    """A discarded retrieval that outlasts the route is waited for, one that did not start never runs"""
+    retriever_latency = LATENCY["functions.lambda_retriever.retriever"]
+    LATENCY["functions.lambda_retriever.retriever"] = 2.5
+    try:
+        run("agent", speculative=True, repeat=1)
+    finally:
+        LATENCY["functions.lambda_retriever.retriever"] = retriever_latency
+
+    calls = []
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert common_entry.run_speculative_branch(calls.append, {}, cancel_event)[0] is None
+    assert not calls
+
+
+if __name__ == "__main__":
+    common_entry.invoke_lambda = stub_invoke_lambda
+    common_entry.get_prompt_templates_from_ddb = lambda *args, **kwargs: {}
+    common_entry.app_agent = StubAgent()
+
+    test_discarded_branches_end_with_the_invocation()
+    print("tests passed")
+
+    scenarios = [
+        ("rag, rewrite unchanged", "rag", "query", None),
+        ("agent, retrieval discarded", "agent", "query", None),
+        ("agent, rewrite changed", "agent", "query_rewrite", "Amazon EC2 的定价模式有哪些"),
+    ]
+    for name, chatbot_mode, query_key, rewritten_query in scenarios:
+        REWRITTEN_QUERY = rewritten_query
+        sequential = run(chatbot_mode, speculative=False, intention_query_key=query_key)
+        speculative = run(chatbot_mode, speculative=True, intention_query_key=query_key)
+        print(f"{name:<28} sequential {sequential:5.2f}s  speculative {speculative:5.2f}s  saved {sequential - speculative:5.2f}s")
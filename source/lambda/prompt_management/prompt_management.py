@@ -1,10 +1,11 @@
 import json
 import os
+import uuid
 
 import boto3
 from botocore.paginate import TokenEncoder
 from common_logic.common_utils.logger_utils import get_logger
-from common_logic.common_utils.prompt_utils import get_all_templates
+from common_logic.common_utils.prompt_utils import PROMPT_VERSION_SORT_KEY, get_all_templates
 
 DEFAULT_MAX_ITEMS = 50
 DEFAULT_SIZE = 50
@@ -33,6 +34,17 @@ def get_query_parameter(event, parameter_name, default_value=None):
     return default_value
 
 
+def __bump_prompt_version(user_id):
+    # online lambdas cache the prompts of a user until this stamp changes
+    prompt_table.put_item(
+        Item={
+            "userId": user_id,
+            "sortKey": PROMPT_VERSION_SORT_KEY,
+            "version": uuid.uuid4().hex,
+        }
+    )
+
+
 def __put(event, user_id):
     body = json.loads(event["body"])
     model_id = body.get("model_id")
@@ -46,6 +58,7 @@ def __put(event, user_id):
                     "prompt": body.get("prompt"),
                 }
             )
+    __bump_prompt_version(user_id)
     return {"message":"OK"}
 
 
@@ -67,7 +80,11 @@ def __list(event, user_id):
         TableName=prompt_table_name,
         PaginationConfig=config,
         KeyConditionExpression="userId = :user_id",
-        ExpressionAttributeValues={":user_id": {"S": user_id}},
+        FilterExpression="sortKey <> :version_sort_key",
+        ExpressionAttributeValues={
+            ":user_id": {"S": user_id},
+            ":version_sort_key": {"S": PROMPT_VERSION_SORT_KEY},
+        },
         ScanIndexForward=False,
     )
 
@@ -118,6 +135,7 @@ def __delete_prompt(event, user_id):
     response = prompt_table.delete_item(
             Key={"userId": user_id, "sortKey": sort_key}
         )
+    __bump_prompt_version(user_id)
     return {"message":"OK"}
 
 
@@ -17,7 +17,7 @@ import cv2
 import numpy as np
 import time
 
-from utils import preprocess, multiclass_nms, postprocess
+from utils import preprocess, multiclass_nms, postprocess, get_session_options
 import onnxruntime
 import GPUtil
 if len(GPUtil.getGPUs()):
@@ -29,7 +29,7 @@ else:
 
 class LayoutPredictor(object):
     def __init__(self):
-        self.ort_session = onnxruntime.InferenceSession(os.path.join(os.environ['MODEL_PATH'], model), providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(os.path.join(os.environ['MODEL_PATH'], model), sess_options=get_session_options(), providers=provider)
         #_ = self.ort_session.run(['output'], {'images': np.zeros((1,3,640,640), dtype='float32')})[0]
         self.categorys = ['text', 'title', 'figure', 'table']
     def __call__(self, img):
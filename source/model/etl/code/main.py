@@ -5,6 +5,9 @@ import logging
 import os
 import re
 import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 from ocr import TextSystem
@@ -12,17 +15,25 @@ from table import TableSystem
 from layout import LayoutPredictor
 import numpy as np
 from markdownify import markdownify as md
-from utils import check_and_read
+from utils import check_and_read, get_pdf_page_count, read_pdf_page
 from figure_llm import figureUnderstand
 from xycut import recursive_xy_cut
 import time
 from PIL import Image
 import cv2
 import io
+import GPUtil
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# On CPU the pages of a pdf are processed by PAGE_WORKERS processes, each with its own
+# ONNX sessions limited to PAGE_INTRA_OP_THREADS threads, pages run one by one with 1 worker
+PAGE_INTRA_OP_THREADS = int(os.environ.get('PAGE_INTRA_OP_THREADS', 2))
+PAGE_WORKERS = int(os.environ.get(
+    'PAGE_WORKERS',
+    1 if len(GPUtil.getGPUs()) else max(1, (os.cpu_count() or 1) // PAGE_INTRA_OP_THREADS)))
+
 class StructureSystem(object):
     def __init__(self):
         self.mode = 'structure'
@@ -67,17 +78,36 @@ class StructureSystem(object):
                 if min_s>final_s:
                     final_s = min_s
         time_dict['layout'] += elapse
-        res_list = []
+        h, w = ori_im.shape[:2]
+        regions = []
         for region in layout_res:
-            res = ''
             if region['bbox'] is not None:
                 x1, y1, x2, y2 = region['bbox']
                 x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
                 x1, y1, x2, y2 = max(x1, 0), max(y1, 0), max(x2, 0), max(y2, 0)
-                roi_img = ori_im[y1:y2, x1:x2, :]
             else:
                 x1, y1, x2, y2 = 0, 0, w, h
-                roi_img = ori_im
+            regions.append((region, [x1, y1, x2, y2]))
+
+        # text of all non-table regions is detected per region and recognized in one batched pass
+        text_bboxes = [bbox for region, bbox in regions if region['label'] != 'table']
+        ocr_start = time.time()
+        text_results = iter(self.text_system.ocr_regions(ori_im, text_bboxes, lang, final_s))
+        # detection and recognition of the text regions are not timed apart
+        time_dict['det'] += time.time() - ocr_start
+
+        # remove style char,
+        # when using the recognition model trained on the PubtabNet dataset,
+        # it will recognize the text format in the table, such as <b>
+        style_token = [
+            '<strike>', '<strike>', '<sup>', '</sub>', '<b>',
+            '</b>', '<sub>', '</sup>', '<overline>',
+            '</overline>', '<underline>', '</underline>', '<i>',
+            '</i>'
+        ]
+        res_list = []
+        for region, (x1, y1, x2, y2) in regions:
+            roi_img = ori_im[y1:y2, x1:x2, :]
             if region['label'] == 'table':
                 res, table_time_dict = self.table_system(
                     roi_img, return_ocr_result_in_table, lang)
@@ -86,31 +116,16 @@ class StructureSystem(object):
                 time_dict['det'] += table_time_dict['det']
                 time_dict['rec'] += table_time_dict['rec']
             else:
-                wht_im = np.ones(ori_im.shape, dtype=ori_im.dtype)
-                wht_im[y1:y2, x1:x2, :] = roi_img
-                top = min(y2-y1, y1)
-                left = min(x2-x1, x1)
-                cur_wht_im = wht_im[y1-top:min(y2+(y2-y1), wht_im.shape[0]), x1-left:min(x2+(x2-x1), wht_im.shape[1])]
-                filter_boxes, filter_rec_res = self.text_system(
-                    cur_wht_im, lang, final_s)
-
-                # remove style char,
-                # when using the recognition model trained on the PubtabNet dataset,
-                # it will recognize the text format in the table, such as <b>
-                style_token = [
-                    '<strike>', '<strike>', '<sup>', '</sub>', '<b>',
-                    '</b>', '<sub>', '</sup>', '<overline>',
-                    '</overline>', '<underline>', '</underline>', '<i>',
-                    '</i>'
-                ]
+                filter_boxes, filter_rec_res = next(text_results)
                 res = []
                 for box, rec_res in zip(filter_boxes, filter_rec_res):
                     rec_str, rec_conf = rec_res
                     for token in style_token:
                         if token in rec_str:
                             rec_str = rec_str.replace(token, '')
-                    if not self.recovery:
-                        box += [x1+left, y1+top]
+                    if self.recovery:
+                        # coordinates relative to the region
+                        box -= [x1, y1]
                     res.append({
                         'text': rec_str,
                         'confidence': float(rec_conf),
@@ -126,7 +141,92 @@ class StructureSystem(object):
         time_dict['all'] = end - start
         return res_list, time_dict
 
-structure_engine = StructureSystem()
+def predict_page(engine, img, lang, auto_dpi):
+    """
+    Regions of a page in reading order.
+
+    Args:
+        engine (StructureSystem): The structure engine.
+        img (np.ndarray): The page image.
+
+    Returns:
+        list: The regions sorted by recursive xy cut.
+    """
+    result, _ = engine(img, lang=lang, auto_dpi=auto_dpi)
+    if result == []:
+        return []
+    boxes = [row["bbox"] for row in result]
+    res = []
+    recursive_xy_cut(np.asarray(boxes).astype(int), np.arange(len(boxes)), res)
+    return [result[idx] for idx in res]
+
+
+# engine of a page worker process
+page_engine = None
+
+
+def init_page_worker(intra_op_threads):
+    global page_engine
+    os.environ['ORT_INTRA_OP_THREADS'] = str(intra_op_threads)
+    cv2.setNumThreads(intra_op_threads)
+    page_engine = StructureSystem()
+
+
+def predict_worker_page(img, lang, auto_dpi):
+    """Process a page image in a page worker"""
+    regions = predict_page(page_engine, img, lang, auto_dpi)
+    for region in regions:
+        # only figures are kept as images, the other crops are not sent back
+        if region['type'] != 'figure':
+            region['img'] = None
+    return regions
+
+
+def predict_pdf_page(file_path, page_index, lang, auto_dpi):
+    """Render and process a pdf page in a page worker"""
+    return predict_worker_page(read_pdf_page(file_path, page_index), lang, auto_dpi)
+
+
+def page_worker_ready(_):
+    return os.getpid()
+
+
+page_pool = None
+
+
+def get_page_pool():
+    """
+    Page worker processes, started on first use and kept for the next requests.
+
+    Workers are forked before this process creates any ONNX session, so that
+    each worker creates its own sessions and no runtime thread pool is forked.
+    """
+    global page_pool
+    if page_pool is None:
+        page_pool = ProcessPoolExecutor(
+            max_workers=PAGE_WORKERS,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=init_page_worker,
+            initargs=(PAGE_INTRA_OP_THREADS,),
+        )
+        logger.info("Started %d page workers with %d threads each", PAGE_WORKERS, PAGE_INTRA_OP_THREADS)
+    return page_pool
+
+
+def reset_page_pool():
+    """Drop a broken pool, e.g. after a worker ran out of memory, new workers are started on next use"""
+    global page_pool
+    if page_pool is not None:
+        page_pool.shutdown(wait=False)
+        page_pool = None
+
+
+if PAGE_WORKERS > 1:
+    structure_engine = None
+    # start the workers and load their models before the first request
+    list(get_page_pool().map(page_worker_ready, range(PAGE_WORKERS)))
+else:
+    structure_engine = StructureSystem()
 figure_understand = figureUnderstand()
 s3 = boto3.client("s3")
 def upload_images_to_s3(
@@ -190,18 +290,38 @@ def structure_predict(file_path: Path, lang: str, auto_dpi, figure_rec) -> str:
         str: The formatted document containing the extracted information.
     """
 
-    # img_list, flag_gif, flag_pdf are returned from check_and_read
-    img_list, _, _ = check_and_read(file_path)
-
     all_res = []
-    for index, img in enumerate(img_list):
-        result, _ = structure_engine(img, lang=lang, auto_dpi=auto_dpi)
-        if result != []:
-            boxes = [row["bbox"] for row in result]
-            res = []
-            recursive_xy_cut(np.asarray(boxes).astype(int), np.arange(len(boxes)), res)
-            result_sorted = [result[idx] for idx in res]
-            all_res += result_sorted
+    start = time.time()
+    if structure_engine is None:
+        # pages are processed concurrently by the page workers, map returns them in page order
+        try:
+            if str(file_path).lower().endswith('.pdf'):
+                page_count = get_pdf_page_count(file_path)
+                page_results = get_page_pool().map(
+                    predict_pdf_page,
+                    [file_path] * page_count,
+                    range(page_count),
+                    [lang] * page_count,
+                    [auto_dpi] * page_count)
+            else:
+                # img_list, flag_gif, flag_pdf are returned from check_and_read
+                img_list, _, _ = check_and_read(file_path)
+                page_results = get_page_pool().map(
+                    predict_worker_page,
+                    img_list,
+                    [lang] * len(img_list),
+                    [auto_dpi] * len(img_list))
+            for regions in page_results:
+                all_res += regions
+        except BrokenProcessPool:
+            reset_page_pool()
+            raise
+    else:
+        # img_list, flag_gif, flag_pdf are returned from check_and_read
+        img_list, _, _ = check_and_read(file_path)
+        for img in img_list:
+            all_res += predict_page(structure_engine, img, lang, auto_dpi)
+    logger.info("Extracted %d regions in %.1fs", len(all_res), time.time() - start)
     doc = ""
     prev_region_text = ""
     figure = {}
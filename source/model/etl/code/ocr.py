@@ -9,6 +9,7 @@ from PIL import Image, ImageDraw
 import cv2
 from imaug import create_operators, transform
 from postprocess import build_post_process
+from utils import get_session_options
 import GPUtil
 if len(GPUtil.getGPUs()):
     provider = [("CUDAExecutionProvider", {"cudnn_conv_algo_search": "HEURISTIC"}), "CPUExecutionProvider"]
@@ -31,7 +32,7 @@ class TextClassifier():
         }
         self.postprocess_op = build_post_process(postprocess_params)
 
-        self.ort_session = onnxruntime.InferenceSession(self.weights_path, providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(self.weights_path, sess_options=get_session_options(), providers=provider)
 
     def resize_norm_img(self, img):
         imgC, imgH, imgW = self.cls_image_shape
@@ -118,7 +119,7 @@ class TextDetector():
         self.preprocess_op = create_operators(pre_process_list)
         self.preprocess_op_identity = create_operators(pre_process_list_identity)
         self.postprocess_op = build_post_process(postprocess_params)
-        self.ort_session = onnxruntime.InferenceSession(self.weights_path, providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(self.weights_path, sess_options=get_session_options(), providers=provider)
         _ = self.ort_session.run(None, {"x": np.zeros([1, 3, 64, 64], dtype='float32')})
 
     # load_pytorch_weights
@@ -244,7 +245,7 @@ class TextRecognizer():
 
         self.postprocess_op = build_post_process(postprocess_params)
 
-        self.ort_session = onnxruntime.InferenceSession(self.weights_path, providers=provider)
+        self.ort_session = onnxruntime.InferenceSession(self.weights_path, sess_options=get_session_options(), providers=provider)
 
     def resize_norm_img(self, img, max_wh_ratio):
         imgC, imgH, imgW = self.rec_image_shape
@@ -318,18 +319,25 @@ def sorted_boxes(dt_boxes):
     return:
         sorted boxes(array) with shape [4, 2]
     """
+    return [dt_boxes[i] for i in sorted_box_indices(dt_boxes)]
+
+def sorted_box_indices(dt_boxes):
+    """
+    Indices of text boxes in the order of sorted_boxes
+    args:
+        dt_boxes(array):detected text boxes with shape [N, 4, 2]
+    return:
+        list of box indices
+    """
     num_boxes = dt_boxes.shape[0]
-    sorted_boxes = sorted(dt_boxes, key=lambda x: (x[0][1], x[0][0]))
-    _boxes = list(sorted_boxes)
+    order = sorted(range(num_boxes), key=lambda i: (dt_boxes[i][0][1], dt_boxes[i][0][0]))
 
     for i in range(num_boxes - 1):
-        if abs(_boxes[i + 1][0][1] - _boxes[i][0][1]) < 10 and (
-            _boxes[i + 1][0][0] < _boxes[i][0][0]
+        if abs(dt_boxes[order[i + 1]][0][1] - dt_boxes[order[i]][0][1]) < 10 and (
+            dt_boxes[order[i + 1]][0][0] < dt_boxes[order[i]][0][0]
         ):
-            tmp = _boxes[i]
-            _boxes[i] = _boxes[i + 1]
-            _boxes[i + 1] = tmp
-    return _boxes
+            order[i], order[i + 1] = order[i + 1], order[i]
+    return order
 class TextSystem:
     def __init__(self):
         #self.text_detector = TextDetector()
@@ -415,4 +423,65 @@ class TextSystem:
             if score >= self.drop_score:
                 filter_boxes.append(box)
                 filter_rec_res.append(rec_reuslt)
-        return filter_boxes, filter_rec_res
\ No newline at end of file
+        return filter_boxes, filter_rec_res
+
+    def ocr_regions(self, img, regions, lang='ch', scale=None):
+        """
+        OCR of several regions of a page with one recognition pass.
+
+        Text is detected in every region as by __call__, on the region surrounded
+        by a blank margin of its own size, so that small regions are detected
+        near their native resolution and no box spans neighbouring regions,
+        e.g. columns separated by a narrow gutter. The crops of all regions are
+        then recognized together, TextRecognizer sorts them by width into batches.
+
+        Args:
+            img (np.ndarray): The page image.
+            regions (list): [x1, y1, x2, y2] of every region in page coordinates.
+            lang (str): The OCR language.
+            scale (float): Detection scale, see TextDetector.
+
+        Returns:
+            list: (filter_boxes, filter_rec_res) of every region, boxes in page coordinates.
+        """
+        region_boxes = []
+        img_crop_list = []
+        for x1, y1, x2, y2 in regions:
+            canvas, origin = self.region_canvas(img, x1, y1, x2, y2)
+            dt_boxes = None if canvas is None else self.text_detector[lang](canvas, scale)
+            if dt_boxes is None or len(dt_boxes) == 0:
+                region_boxes.append([])
+                continue
+            dt_boxes = sorted_boxes(dt_boxes)
+            for box in dt_boxes:
+                img_crop_list.append(self.get_rotate_crop_image(canvas, copy.deepcopy(box)))
+            region_boxes.append([box + origin for box in dt_boxes])
+
+        rec_res = iter(self.text_recognizer[lang](img_crop_list) if img_crop_list else [])
+        results = []
+        for boxes in region_boxes:
+            filter_boxes, filter_rec_res = [], []
+            for box in boxes:
+                rec_result = next(rec_res)
+                if rec_result[1] >= self.drop_score:
+                    filter_boxes.append(box)
+                    filter_rec_res.append(rec_result)
+            results.append((filter_boxes, filter_rec_res))
+        return results
+
+    @staticmethod
+    def region_canvas(img, x1, y1, x2, y2):
+        """
+        The region on a blank canvas extending it by its own size on every side,
+        clipped to the page, and the page coordinates of the canvas origin.
+        Only the canvas is allocated, not a page-sized one.
+        """
+        h, w = img.shape[:2]
+        x2, y2 = min(x2, w), min(y2, h)
+        if x2 <= x1 or y2 <= y1:
+            return None, None
+        top, left = min(y2 - y1, y1), min(x2 - x1, x1)
+        bottom, right = min(y2 + (y2 - y1), h), min(x2 + (x2 - x1), w)
+        canvas = np.ones((bottom - y1 + top, right - x1 + left) + img.shape[2:], dtype=img.dtype)
+        canvas[top:top + y2 - y1, left:left + x2 - x1] = img[y1:y2, x1:x2]
+        return canvas, np.array([x1 - left, y1 - top], dtype=np.float32)
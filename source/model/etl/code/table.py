@@ -7,12 +7,8 @@ from imaug import create_operators, transform
 import numpy as np
 import os
 import onnxruntime as ort
+from utils import get_session_options
 
-sess_options = ort.SessionOptions()
-
-sess_options.intra_op_num_threads = 8
-sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
 def sorted_boxes(dt_boxes):
     """
     Sort text boxes in order from top to bottom, left to right
@@ -46,7 +42,7 @@ class TableStructurer(object):
         self.preprocess_op = create_operators(pre_process_list)
         self.postprocess_op = build_post_process(postprocess_params)
         
-        sess = ort.InferenceSession(os.environ['MODEL_PATH'] + 'table_sim.onnx', providers=['CPUExecutionProvider']) #, sess_options=sess_options, providers=[("CUDAExecutionProvider", {"cudnn_conv_algo_search": "DEFAULT"})]
+        sess = ort.InferenceSession(os.environ['MODEL_PATH'] + 'table_sim.onnx', sess_options=get_session_options(), providers=['CPUExecutionProvider']) #, providers=[("CUDAExecutionProvider", {"cudnn_conv_algo_search": "DEFAULT"})]
         _ = sess.run(None, {'x': np.zeros((1, 3, 488, 488), dtype='float32')})
         self.predictor, self.input_tensor, self.output_tensors, self.config = sess, sess.get_inputs()[0], None, None
 
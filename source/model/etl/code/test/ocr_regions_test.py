@@ -0,0 +1,66 @@
+"""Check of TextSystem.ocr_regions on a rendered two-column page.
+
+The page holds two columns of words separated by a gutter of a few pixels,
+and a caption in small type. ocr_regions must return, for every region, the
+lines that TextSystem returns on that region alone on its blank canvas,
+without words of the neighbouring column, with auto_dpi scale or without.
+Run it on CPU, where crops are recognized one at a time: GPU batches pad the
+crops of a batch to the same width, which may change a character.
+
+    cd source/model/etl/code && MODEL_PATH=/opt/ml/model/ python test/ocr_regions_test.py
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ocr import TextSystem
+
+GUTTER = 6
+LEFT_WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot"]
+RIGHT_WORDS = ["golf", "hotel", "india", "juliet", "kilo", "lima"]
+
+
+def render_page():
+    page = np.full((1600, 1200, 3), 255, dtype=np.uint8)
+    column_width = (1200 - 2 * 60 - GUTTER) // 2
+    left = [60, 80, 60 + column_width, 1200]
+    right = [60 + column_width + GUTTER, 80, 1200 - 60, 1200]
+    for bbox, words in [(left, LEFT_WORDS), (right, RIGHT_WORDS)]:
+        for i, word in enumerate(words):
+            y = bbox[1] + 60 + i * 150
+            # the lines run up to the gutter, a page level box would join both columns
+            text = f"{word} {word} {word}"
+            (width, _), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1.6, 3)
+            x = bbox[2] - width - 2 if bbox is left else bbox[0] + 2
+            cv2.putText(page, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (0, 0, 0), 3)
+    caption = [400, 1300, 800, 1330]
+    cv2.putText(page, "figure 1 small caption", (405, 1322), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (0, 0, 0), 1)
+    return page, [left, right, caption]
+
+
+def region_texts(result):
+    _, rec_res = result
+    return [text for text, _ in rec_res]
+
+
+if __name__ == "__main__":
+    text_system = TextSystem()
+    page, regions = render_page()
+    for scale in [None, 1.0]:
+        results = text_system.ocr_regions(page, regions, "en", scale)
+        for bbox, result in zip(regions, results):
+            canvas, _ = text_system.region_canvas(page, *bbox)
+            expected = text_system(canvas, "en", scale)
+            assert region_texts(result) == [text for text, _ in expected[1]], (scale, bbox, result)
+        left_text, right_text, caption_text = (" ".join(region_texts(result)) for result in results)
+        assert all(word in left_text for word in LEFT_WORDS), left_text
+        assert not any(word in left_text for word in RIGHT_WORDS), left_text
+        assert all(word in right_text for word in RIGHT_WORDS), right_text
+        assert not any(word in right_text for word in LEFT_WORDS), right_text
+        assert "caption" in caption_text, caption_text
+        print(f"scale {scale}: {[len(result[0]) for result in results]} lines per region")
+    print("tests passed")
@@ -0,0 +1,82 @@
+"""CPU benchmark of page-parallel structure extraction on a multi-page pdf.
+
+The sample pdf is repeated up to the requested number of pages, then
+structure_predict runs once per worker count in a fresh process, since the
+page workers are configured when main is imported. Pages per second are
+reported, with whether the document matches the one of the first run (float
+reductions over other thread counts may shift a box by a pixel).
+
+    cd source/model/etl/code && MODEL_PATH=/opt/ml/model/ \
+        python test/page_parallel_benchmark.py [sample.pdf] [num_pages] [workers ...]
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_SAMPLE = os.path.join(CODE_DIR, "..", "..", "..", "..", "api_test", "test_data", "summary.pdf")
+
+
+def make_pdf(sample_path, num_pages, output_path):
+    import fitz
+
+    with fitz.open(sample_path) as sample, fitz.open() as pdf:
+        while pdf.page_count < num_pages:
+            pdf.insert_pdf(sample, to_page=min(sample.page_count, num_pages - pdf.page_count) - 1)
+        pdf.save(output_path)
+
+
+def run_child(pdf_path):
+    sys.path.insert(0, CODE_DIR)
+    from main import PAGE_INTRA_OP_THREADS, PAGE_WORKERS, structure_predict
+    from utils import get_pdf_page_count
+
+    # the first call pays for lazy initialisation of the sessions
+    structure_predict(pdf_path, "zh", True, False)
+    start = time.perf_counter()
+    doc, _ = structure_predict(pdf_path, "zh", True, False)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "workers": PAGE_WORKERS,
+        "threads": PAGE_INTRA_OP_THREADS,
+        "pages": get_pdf_page_count(pdf_path),
+        "seconds": elapsed,
+        "doc_hash": hashlib.sha256(doc.encode("utf-8")).hexdigest(),
+    }))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        run_child(sys.argv[2])
+        sys.exit(0)
+
+    sample_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SAMPLE
+    num_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    cores = os.cpu_count() or 1
+    worker_counts = [int(arg) for arg in sys.argv[3:]] or sorted({1, max(1, cores // 4), max(1, cores // 2)})
+    pdf_path = f"/tmp/page_parallel_benchmark_{num_pages}.pdf"
+    make_pdf(sample_path, num_pages, pdf_path)
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    print(f"{num_pages} pages, {cores} cores")
+    sequential_hash = None
+    for workers in worker_counts:
+        env = dict(os.environ)
+        env["PAGE_WORKERS"] = str(workers)
+        # a single process keeps the runtime default of one thread per core
+        env["PAGE_INTRA_OP_THREADS"] = str(max(1, cores // workers))
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", pdf_path],
+            cwd=CODE_DIR, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if sequential_hash is None:
+            sequential_hash = result["doc_hash"]
+        print(
+            f"  {result['workers']:>2} workers x {result['threads']:>2} threads: "
+            f"{result['pages'] / result['seconds']:.2f} pages/s ({result['seconds']:.1f}s), "
+            f"{'same' if result['doc_hash'] == sequential_hash else 'different'} document"
+        )
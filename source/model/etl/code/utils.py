@@ -5,6 +5,7 @@ import os
 
 import cv2
 import numpy as np
+import onnxruntime
 
 # from transformers import StoppingCriteria
 
@@ -161,21 +162,57 @@ def check_and_read(img_path):
         return imgvalue, True, False
     elif os.path.basename(img_path)[-3:].lower() == "pdf":
         import fitz
-        from PIL import Image
 
         imgs = []
         with fitz.open(img_path) as pdf:
             for pg in range(0, pdf.page_count):
-                page = pdf[pg]
-                mat = fitz.Matrix(3, 3)
-                pm = page.get_pixmap(matrix=mat, alpha=False)
-
-                # if width or height > 2000 pixels, don't enlarge the image
-                # if pm.width > 2000 or pm.height > 2000:
-                #     pm = page.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
-
-                img = Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
-                img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-                imgs.append(img)
+                imgs.append(render_pdf_page(pdf[pg]))
             return imgs, False, True
     return None, False, False
+
+
+def render_pdf_page(page):
+    """Render a fitz page at 3x zoom into a BGR image"""
+    import fitz
+    from PIL import Image
+
+    mat = fitz.Matrix(3, 3)
+    pm = page.get_pixmap(matrix=mat, alpha=False)
+
+    # if width or height > 2000 pixels, don't enlarge the image
+    # if pm.width > 2000 or pm.height > 2000:
+    #     pm = page.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
+
+    img = Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
+    return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+
+
+def read_pdf_page(pdf_path, page_index):
+    """Render a single page of a pdf, so that pages can be read by separate processes"""
+    import fitz
+
+    with fitz.open(pdf_path) as pdf:
+        return render_pdf_page(pdf[page_index])
+
+
+def get_pdf_page_count(pdf_path):
+    import fitz
+
+    with fitz.open(pdf_path) as pdf:
+        return pdf.page_count
+
+
+def get_session_options():
+    """
+    ONNX Runtime session options shared by all models.
+
+    ORT_INTRA_OP_THREADS bounds the threads of every session, so that several
+    processes running sessions side by side do not oversubscribe the cores.
+    """
+    sess_options = onnxruntime.SessionOptions()
+    intra_op_threads = int(os.environ.get("ORT_INTRA_OP_THREADS", 0))
+    if intra_op_threads > 0:
+        sess_options.intra_op_num_threads = intra_op_threads
+        sess_options.inter_op_num_threads = 1
+        sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    return sess_options
@@ -1,4 +1,5 @@
 import csv
+import gzip
 import itertools
 import json
 import logging
@@ -177,6 +178,19 @@ def parse_log_to_document_list(log_content: str) -> List[Document]:
     return [doc]
 
 
+def parse_jsonl_to_document_list(jsonl_content: str) -> List[Document]:
+    # Every line holds the page content and metadata of one document
+    docs = []
+    for line in jsonl_content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        docs.append(
+            Document(page_content=record["page_content"], metadata=record["metadata"])
+        )
+    return docs
+
+
 def csdc_unstructured_loader(file_path: str) -> List[Document]:
     """
     Loads a document from a file path.
@@ -283,16 +297,24 @@ def csdc_unstructured_loader(file_path: str) -> List[Document]:
     )
     # construct the s3 prefix with latest log file
     s3_prefix = s3_prefix + latest_log_file
-    # download the log file to local
-    s3.download_file(chunk_bucket, s3_prefix, file_name + ".log")
+    if latest_log_file.endswith(".jsonl.gz"):
+        # gzipped JSON lines written by the artifact writer of the glue job, one record per document
+        s3.download_file(chunk_bucket, s3_prefix, file_name + ".jsonl.gz")
+        with gzip.open(file_name + ".jsonl.gz", "rt", encoding="utf-8") as f:
+            file_content = f.read()
+            logger.debug("file_content: {}".format(file_content))
+        doc = parse_jsonl_to_document_list(file_content)
+    else:
+        # one text file per document, written by jobs before the artifact writer
+        s3.download_file(chunk_bucket, s3_prefix, file_name + ".log")
 
-    # read content from file_path
-    with open(file_name + ".log", "r") as f:
-        file_content = f.read()
-        logger.debug("file_content: {}".format(file_content))
+        # read content from file_path
+        with open(file_name + ".log", "r") as f:
+            file_content = f.read()
+            logger.debug("file_content: {}".format(file_content))
 
-    # transform to Document object
-    doc = parse_log_to_document_list(file_content)
+        # transform to Document object
+        doc = parse_log_to_document_list(file_content)
     logger.debug("csdc unstructured load data: {} and type: {}".format(doc, type(doc)))
     # return to raw extracted file contents to match with the function as any loader class. TODO: return the result of splitter (SplittingType.SEMANTIC) to integrate into current benchmark
     return doc